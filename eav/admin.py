@@ -28,8 +28,9 @@ from django.utils.safestring import mark_safe
 from django.contrib.contenttypes.models import ContentType
 
 
-from .models import Attribute, Value, EnumValue, EnumGroup
+from .models import Attribute, AttributeSet, Value, EnumValue, EnumGroup
 from .forms import BaseDynamicEntityForm
+from .schema import schema
 
 
 class BaseEntityAdmin(ModelAdmin):
@@ -80,8 +81,13 @@ class BaseEntityAdmin(ModelAdmin):
         to the changelist view.  Override to customize.
         """
         base_list_display = list(self.list_display)
-        attribute_class = self.attribute_class or Attribute
-        for attribute in attribute_class.objects.filter(display_in_list=True):
+        if self.attribute_class:
+            attributes = self.attribute_class.objects \
+                                             .filter(display_in_list=True)
+        else:
+            attributes = [a for a in schema.get_attributes() \
+                          if a.display_in_list]
+        for attribute in attributes:
             func_name = "eav_%s" % attribute.slug
             if func_name in self.list_display:
                 continue
@@ -167,11 +173,17 @@ class PartitionedAttributeAdmin(AttributeAdmin):
 class EnumGroupAdmin(ModelAdmin):
     filter_horizontal = ('enums', )
 
+class AttributeSetAdmin(ModelAdmin):
+    list_display = ('name', 'slug')
+    prepopulated_fields = {'slug': ('name',)}
+    filter_horizontal = ('attributes', )
+
 def register_admin():
     """
     Don't automatically register the generic EAV models unless asked.
     """
     admin.site.register(Attribute, AttributeAdmin)
+    admin.site.register(AttributeSet, AttributeSetAdmin)
     admin.site.register(Value)
     admin.site.register(EnumValue)
     admin.site.register(EnumGroup, EnumGroupAdmin)
@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+#
+#    This software is derived from EAV-Django originally written and
+#    copyrighted by Andrey Mikhaylenko <http://pypi.python.org/pypi/eav-django>
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+'''
+####
+flat
+####
+
+This module maintains the optional flat table of a registered model: a
+denormalized copy of its eav values, with one row per entity and one typed,
+indexed column per attribute. It is enabled by setting
+:attr:`~eav.registry.EavConfig.flat_table` on the model's config class::
+
+    class PatientEavConfig(EavConfig):
+        flat_table = True
+
+    eav.register(Patient, PatientEavConfig)
+
+The table is created, given columns for new attributes, and filled from the
+values of the model's storage backend (see :mod:`eav.storage`) by the
+``rebuild_eav_flat`` management command. After that it is kept up to date
+by :meth:`Entity.save() <eav.models.Entity.save>`,
+:meth:`Attribute.save_value() <eav.models.Attribute.save_value>`,
+:meth:`~eav.managers.EntityManager.bulk_create_with_eav`,
+:meth:`~eav.managers.EntityQuerySet.update_eav` and entity deletion, and
+eav filters and ordering on attributes that have a column use it instead
+of the :class:`~eav.models.Value` table.
+
+Object attributes are not copied to the flat table, nor attributes whose
+slug is ``entity_id`` or too long to be a column name on the database.
+Filters with the ``isnull`` lookup read the storage backend, which tells
+missing values apart from rows the flat table may not have.
+
+Deleting an attribute drops its column, inside the deleting transaction
+(see :func:`attribute_delete_handler`).
+
+Adding or dropping columns increments the shared version of the
+:data:`~eav.schema.schema`, so that other processes read the table's
+columns again.
+
+Classes and Functions
+---------------------
+'''
+
+from django.db import models, connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_models
+try:
+    from django.db.backends.utils import truncate_name
+except ImportError:
+    from django.db.backends.util import truncate_name
+
+from .schema import schema
+
+#: The column of the flat tables holding the entity's primary key
+ENTITY_COLUMN = 'entity_id'
+
+
+class FlatTable(object):
+    '''
+    The flat table of *model_cls*, named after the model's table with an
+    ``_eav`` suffix. Use :func:`get_flat_table` to get it.
+    '''
+
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        self.config_cls = model_cls._eav_config_cls
+        self.name = '%s_eav' % model_cls._meta.db_table
+        self._columns = {}
+
+    def get_attributes(self, using=DEFAULT_DB_ALIAS):
+        '''
+        Returns the attributes of the model that can have a column.
+        '''
+        return [a for a in self.config_cls.get_attribute_list() \
+                if self.can_have_column(a, using)]
+
+    def can_have_column(self, attribute, using=DEFAULT_DB_ALIAS):
+        '''
+        Returns whether *attribute* can have a column: it isn't an object
+        attribute, and its slug is a valid column name other than
+        :data:`ENTITY_COLUMN`.
+        '''
+        from .models import Attribute
+        max_length = connections[using].ops.max_name_length()
+        return attribute.datatype != Attribute.TYPE_OBJECT and \
+               attribute.slug != ENTITY_COLUMN and \
+               (max_length is None or len(attribute.slug) <= max_length)
+
+    def get_index_name(self, slug, using=DEFAULT_DB_ALIAS):
+        '''
+        Returns the name of the index on the column *slug*, shortened to
+        the database's limit.
+        '''
+        return truncate_name('%s_%s' % (self.name, slug),
+                             connections[using].ops.max_name_length())
+
+    def get_value_field(self, attribute):
+        '''
+        Returns the :class:`~eav.models.Value` field that the column of
+        *attribute* copies.
+        '''
+        from .models import Value
+        return Value._meta.get_field('value_%s' % attribute.datatype)
+
+    def get_columns(self, using=DEFAULT_DB_ALIAS):
+        '''
+        Returns the set of the table's column names, which is empty if it
+        doesn't exist. It is read from the database once per schema version.
+        '''
+        version, columns = self._columns.get(using, (None, None))
+        if version != schema.version:
+            connection = connections[using]
+            cursor = connection.cursor()
+            if self.name in connection.introspection.get_table_list(cursor):
+                description = connection.introspection \
+                                        .get_table_description(cursor,
+                                                               self.name)
+                columns = frozenset(d[0] for d in description)
+            else:
+                columns = frozenset()
+            self._columns[using] = (schema.version, columns)
+        return columns
+
+    def has_column(self, attribute, using=DEFAULT_DB_ALIAS):
+        '''
+        Returns whether the table has a column for *attribute*.
+        '''
+        return attribute.slug != ENTITY_COLUMN and \
+               attribute.slug in self.get_columns(using)
+
+    def _db_value(self, attribute, value, connection):
+        if value is None or value == '':
+            return None
+        if hasattr(value, 'pk'):
+            value = value.pk
+        return self.get_value_field(attribute) \
+                   .get_db_prep_save(value, connection=connection)
+
+    def sync_columns(self, fill=True, using=DEFAULT_DB_ALIAS):
+        '''
+        Creates the table if it doesn't exist, and adds an indexed column for
+        each attribute that doesn't have one, filled with
+        :meth:`fill_columns` unless *fill* is False, when the table is
+        rebuilt next. Returns the list of the attributes whose columns were
+        added.
+        '''
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        columns = self.get_columns(using)
+        if not columns:
+            pk = self.model_cls._meta.pk
+            if isinstance(pk, models.AutoField):
+                pk = models.IntegerField()
+            cursor.execute('CREATE TABLE %s (%s %s NOT NULL PRIMARY KEY)' % (
+                           qn(self.name), qn(ENTITY_COLUMN),
+                           pk.db_type(connection=connection)))
+
+        added = []
+        for attribute in self.get_attributes(using):
+            if attribute.slug in columns:
+                continue
+            field = self.get_value_field(attribute)
+            if field.rel:
+                field = field.rel.get_related_field()
+                if isinstance(field, models.AutoField):
+                    field = models.IntegerField()
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NULL' % (
+                           qn(self.name), qn(attribute.slug),
+                           field.db_type(connection=connection)))
+            cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+                           qn(self.get_index_name(attribute.slug, using)),
+                           qn(self.name), qn(attribute.slug)))
+            added.append(attribute)
+        if fill:
+            self.fill_columns(added, using)
+        transaction.commit_unless_managed(using=using)
+        if added or not columns:
+            self._columns_changed(using)
+        return added
+
+    def drop_column(self, slug, using=DEFAULT_DB_ALIAS):
+        '''
+        Drops the column *slug* and its index, if the table has it.
+        '''
+        if slug == ENTITY_COLUMN or slug not in self.get_columns(using):
+            return
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        if connection.vendor == 'sqlite':
+            # SQLite doesn't drop a column that is indexed
+            cursor.execute('DROP INDEX %s' % qn(self.get_index_name(slug,
+                                                                    using)))
+        cursor.execute('ALTER TABLE %s DROP COLUMN %s' % (qn(self.name),
+                                                         qn(slug)))
+        transaction.commit_unless_managed(using=using)
+        self._columns_changed(using)
+
+    def _columns_changed(self, using):
+        self._columns.pop(using, None)
+        schema.clear(using=using)
+        from .managers import filter_plans
+        filter_plans.clear()
+
+    def _pivot_sql(self, attributes, entity_pk, connection):
+        '''
+        Returns the pivot of the values of *attributes* by the storage
+        backend (see :meth:`~eav.storage.BaseStorage.pivot_sql`), with its
+        booleans as the column expects them.
+        '''
+        from .models import Attribute
+        from .storage import get_storage
+        joins, j_params, value_columns = get_storage(self.model_cls) \
+                                .pivot_sql(attributes, entity_pk, connection)
+        columns = []
+        for attribute, (value, params) in zip(attributes, value_columns):
+            params = list(params)
+            if attribute.datatype == Attribute.TYPE_BOOLEAN:
+                # the pivot gives 1 or 0
+                value = 'CASE %s WHEN 1 THEN %%s WHEN 0 THEN %%s END' % value
+                params.extend([True, False])
+            columns.append((value, params))
+        return joins, j_params, columns
+
+    def fill_columns(self, attributes, using=DEFAULT_DB_ALIAS):
+        '''
+        Copies the values of *attributes* to their columns, with an
+        ``INSERT ... SELECT`` adding the rows of the entities that have
+        values and no row yet, and an ``UPDATE`` per attribute.
+        '''
+        if not attributes:
+            return
+        from .storage import get_storage
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = qn(self.name)
+        row_pk = '%s.%s' % (table, qn(ENTITY_COLUMN))
+        cursor = connection.cursor()
+
+        ids_sql, ids_params = get_storage(self.model_cls) \
+                                .entity_ids_sql(connection)
+        cursor.execute('INSERT INTO %s (%s) SELECT %s.%s FROM (%s) %s '
+                       'WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s = %s.%s)'
+                       % (table, qn(ENTITY_COLUMN), qn('eav_entity'),
+                          qn('entity_id'), ids_sql, qn('eav_entity'), table,
+                          row_pk, qn('eav_entity'), qn('entity_id')),
+                       ids_params)
+
+        opts = self.model_cls._meta
+        entity_pk = '%s.%s' % (qn('eav_entity'), qn(opts.pk.column))
+        for attribute in attributes:
+            joins, j_params, columns = self._pivot_sql([attribute],
+                                                       entity_pk, connection)
+            value, params = columns[0]
+            cursor.execute('UPDATE %s SET %s = (SELECT %s FROM %s %s %s '
+                           'WHERE %s = %s GROUP BY %s)' % (
+                                table, qn(attribute.slug), value,
+                                qn(opts.db_table), qn('eav_entity'), joins,
+                                entity_pk, row_pk, entity_pk),
+                           params + j_params)
+
+    def rebuild(self, using=DEFAULT_DB_ALIAS):
+        '''
+        Replaces the rows of the table with the current values of all the
+        entities, with one ``DELETE`` and one ``INSERT ... SELECT`` pivoting
+        the values of the model's storage backend (see
+        :meth:`~eav.storage.BaseStorage.pivot_sql`).
+        '''
+        from .storage import get_storage
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        attributes = [a for a in self.get_attributes(using) \
+                      if self.has_column(a, using)]
+        entity_pk = '%s.%s' % (qn('eav_entity'), qn('entity_id'))
+        joins, j_params, value_columns = self._pivot_sql(attributes,
+                                                         entity_pk,
+                                                         connection)
+
+        columns = [qn(ENTITY_COLUMN)]
+        values = [entity_pk]
+        params = []
+        for attribute, (value, value_params) in zip(attributes,
+                                                    value_columns):
+            params.extend(value_params)
+            columns.append(qn(attribute.slug))
+            values.append(value)
+        ids_sql, ids_params = get_storage(self.model_cls) \
+                                .entity_ids_sql(connection)
+        params.extend(ids_params)
+        params.extend(j_params)
+
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s' % qn(self.name))
+        cursor.execute('INSERT INTO %s (%s) SELECT %s FROM (%s) %s %s '
+                       'GROUP BY %s' % (
+                            qn(self.name), ', '.join(columns),
+                            ', '.join(values), ids_sql, qn('eav_entity'),
+                            joins, entity_pk), params)
+        transaction.commit_unless_managed(using=using)
+
+    def set_values(self, entity_pk, values, using=DEFAULT_DB_ALIAS):
+        '''
+        Writes *values*, a list of (attribute, value) pairs, to the row of
+        the entity *entity_pk*, creating it if needed. None clears a value.
+        '''
+        connection = connections[using]
+        values = [(a, v) for a, v in values if self.has_column(a, using)]
+        if not values:
+            return
+        qn = connection.ops.quote_name
+        columns = [qn(a.slug) for a, v in values]
+        params = [self._db_value(a, v, connection) for a, v in values]
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s WHERE %s = %%s' % (
+                       qn(self.name),
+                       ', '.join(['%s = %%s' % c for c in columns]),
+                       qn(ENTITY_COLUMN)), params + [entity_pk])
+        if not cursor.rowcount:
+            cursor.execute('INSERT INTO %s (%s, %s) VALUES (%%s, %s)' % (
+                           qn(self.name), qn(ENTITY_COLUMN),
+                           ', '.join(columns),
+                           ', '.join(['%s'] * len(columns))),
+                           [entity_pk] + params)
+
+    def insert_rows(self, rows, using=DEFAULT_DB_ALIAS):
+        '''
+        Inserts a row for each of *rows*, pairs of a new entity's primary key
+        and a list of (attribute, value) pairs, with one ``executemany()``.
+        '''
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        attributes = [a for a in self.get_attributes(using) \
+                      if self.has_column(a, using)]
+        if not rows or not self.get_columns(using):
+            return
+        params = []
+        for entity_pk, values in rows:
+            values = dict((a.pk, v) for a, v in values)
+            params.append([entity_pk] + \
+                          [self._db_value(a, values.get(a.pk), connection) \
+                           for a in attributes])
+        connection.cursor().executemany(
+            'INSERT INTO %s (%s) VALUES (%s)' % (
+                qn(self.name),
+                ', '.join([qn(ENTITY_COLUMN)] + \
+                          [qn(a.slug) for a in attributes]),
+                ', '.join(['%s'] * (len(attributes) + 1))), params)
+
+    def update_where(self, attribute, value, pk_sql, pk_params,
+                     using=DEFAULT_DB_ALIAS):
+        '''
+        Sets the column of *attribute* to *value* for the entities whose
+        primary keys are selected by *pk_sql*, with one ``UPDATE`` and one
+        ``INSERT ... SELECT`` for the entities without a row.
+        '''
+        if not self.has_column(attribute, using):
+            return
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = qn(self.name)
+        value = self._db_value(attribute, value, connection)
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s = %%s WHERE %s IN (%s)' % (
+                       table, qn(attribute.slug), qn(ENTITY_COLUMN), pk_sql),
+                       [value] + list(pk_params))
+        if value is None:
+            return
+        entity_pk = '%s.%s' % (qn(self.model_cls._meta.db_table),
+                               qn(self.model_cls._meta.pk.column))
+        cursor.execute('INSERT INTO %s (%s, %s) SELECT %s, %%s FROM %s '
+                       'WHERE %s IN (%s) AND NOT EXISTS '
+                       '(SELECT 1 FROM %s WHERE %s = %s)' % (
+                            table, qn(ENTITY_COLUMN), qn(attribute.slug),
+                            entity_pk, qn(self.model_cls._meta.db_table),
+                            entity_pk, pk_sql,
+                            table, qn(ENTITY_COLUMN), entity_pk),
+                       [value] + list(pk_params))
+
+    def delete_row(self, entity_pk, using=DEFAULT_DB_ALIAS):
+        '''
+        Deletes the row of the entity *entity_pk*.
+        '''
+        if not self.get_columns(using):
+            return
+        qn = connections[using].ops.quote_name
+        connections[using].cursor().execute(
+            'DELETE FROM %s WHERE %s = %%s' % (qn(self.name),
+                                                qn(ENTITY_COLUMN)),
+            [entity_pk])
+
+    def column_sql(self, attribute, entity_pk, using=DEFAULT_DB_ALIAS):
+        '''
+        Returns a correlated subquery selecting the column of *attribute*
+        for the entity whose primary key column is *entity_pk*.
+        '''
+        qn = connections[using].ops.quote_name
+        return 'SELECT %s FROM %s WHERE %s = %s' % (
+                    qn(attribute.slug), qn(self.name), qn(ENTITY_COLUMN),
+                    entity_pk)
+
+    def filter_sql(self, attribute, lookup, value, using=DEFAULT_DB_ALIAS):
+        '''
+        Returns the SQL and parameters of a query selecting the primary keys
+        of the entities whose *attribute* matches the field *lookup* (like
+        ``'exact'`` or ``'icontains'``) with *value*.
+        '''
+        from django.db.models.sql.where import WhereNode, Constraint, AND
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        field = self.get_value_field(attribute)
+        where = WhereNode()
+        where.add((Constraint(self.name, attribute.slug, field), lookup,
+                   value), AND)
+        sql, params = where.as_sql(qn=qn, connection=connection)
+        return 'SELECT %s FROM %s WHERE %s' % (qn(ENTITY_COLUMN),
+                                                qn(self.name), sql), params
+
+
+class FlatSubquery(object):
+    '''
+    A ``pk__in`` filter value selecting entity primary keys from a flat
+    table with :meth:`FlatTable.filter_sql`.
+    '''
+
+    def __init__(self, flat_table, attribute, lookup, value):
+        self.flat_table = flat_table
+        self.attribute = attribute
+        self.lookup = lookup
+        self.value = value
+
+    def prepare(self):
+        return self
+
+    def relabel_aliases(self, change_map):
+        # Django only passes *connection* to as_sql() for values having this
+        # method; the flat table is never aliased.
+        pass
+
+    def as_sql(self, qn, connection):
+        sql, params = self.flat_table.filter_sql(self.attribute, self.lookup,
+                                                 self.value, connection.alias)
+        return '(%s)' % sql, params
+
+
+_flat_tables = {}
+
+
+def get_flat_table(model_cls):
+    '''
+    Returns the :class:`FlatTable` of *model_cls*, or None if it isn't
+    registered with a flat table.
+    '''
+    config_cls = getattr(model_cls, '_eav_config_cls', None)
+    if not config_cls or not getattr(config_cls, 'flat_table', False):
+        return None
+    flat_table = _flat_tables.get(model_cls)
+    if flat_table is None or flat_table.config_cls is not config_cls:
+        flat_table = _flat_tables[model_cls] = FlatTable(model_cls)
+    return flat_table
+
+
+def delete_handler(sender, *args, **kwargs):
+    '''
+    Post delete handler deleting the flat table row of an entity.
+    '''
+    flat_table = get_flat_table(sender)
+    if flat_table is not None:
+        flat_table.delete_row(kwargs['instance'].pk,
+                              using=kwargs.get('using') or DEFAULT_DB_ALIAS)
+
+
+def attribute_delete_handler(sender, instance, **kwargs):
+    '''
+    Post delete handler of :class:`~eav.models.Attribute` dropping its
+    column from the flat tables, so that an attribute created with the same
+    slug starts from an empty column of its own datatype.
+
+    .. note::
+       The ``ALTER TABLE`` runs inside the transaction deleting the
+       attribute. PostgreSQL commits or rolls it back with that
+       transaction, but MySQL, and SQLite through Django 1.4, commit the
+       transaction before a DDL statement. Delete attributes in a
+       transaction of their own there.
+    '''
+    using = kwargs.get('using') or DEFAULT_DB_ALIAS
+    for model_cls in get_models():
+        flat_table = get_flat_table(model_cls)
+        if flat_table is not None and instance.slug not in \
+           [a.slug for a in flat_table.get_attributes(using)]:
+            flat_table.drop_column(instance.slug, using)
@@ -33,6 +33,49 @@ from django.forms import BooleanField, CharField, DateTimeField, FloatField, \
 from django.contrib.admin.widgets import AdminSplitDateTime
 from django.utils.translation import ugettext_lazy as _
 
+from .schema import schema
+
+
+class FieldPrototypeCache(object):
+    '''
+    Memoizes the fields :class:`BaseDynamicEntityForm` builds for each list
+    of attributes, so that creating a form doesn't have to look at the
+    attributes again. Use the
+    :data:`field_prototypes` instance.
+
+    It is cleared when the :data:`~eav.schema.schema` changes.
+    '''
+
+    def __init__(self):
+        self._prototypes = {}
+        self._version = schema.version
+
+    def clear(self):
+        '''
+        Discards all the prototypes.
+        '''
+        self._prototypes = {}
+        self._version = schema.version
+
+    def get(self, form_cls, entity):
+        '''
+        Returns the field prototypes of *form_cls* for *entity*, as
+        described in :meth:`BaseDynamicEntityForm.get_field_prototypes`.
+        '''
+        # syncs the schema before its version is checked
+        attributes = entity.get_all_attributes()
+        if self._version != schema.version:
+            self.clear()
+        # the attributes of an entity may depend on the entity itself (see
+        # EavConfig.get_attributes), so they are the key
+        key = (form_cls, tuple(a.pk for a in attributes))
+        try:
+            return self._prototypes[key]
+        except KeyError:
+            prototypes = form_cls.get_field_prototypes(attributes)
+            self._prototypes[key] = prototypes
+            return prototypes
+
 
 class BaseDynamicEntityForm(ModelForm):
     '''
@@ -64,9 +107,28 @@ class BaseDynamicEntityForm(ModelForm):
         # reset form fields
         self.fields = deepcopy(self.base_fields)
 
-        for attribute in self.entity.get_all_attributes():
-            value = getattr(self.entity, attribute.slug)
+        values = self.entity.get_value_cache()
+        for slug, field_class, defaults in \
+                field_prototypes.get(self.__class__, self.entity):
+            self.fields[slug] = field_class(**defaults)
 
+            # fill initial data (if attribute was already defined)
+            value = values.get(slug)
+            if value is not None and value.value is not None:
+                if issubclass(field_class, ChoiceField):
+                    self.initial[slug] = value.value.pk
+                else:
+                    self.initial[slug] = value.value
+
+    @classmethod
+    def get_field_prototypes(cls, attributes):
+        '''
+        Returns a list of ``(slug, field class, keyword arguments)`` tuples
+        describing the form fields of *attributes*. Object attributes have
+        no field.
+        '''
+        prototypes = []
+        for attribute in attributes:
             defaults = {
                 'label': attribute.name.capitalize(),
                 'required': attribute.required,
@@ -79,26 +141,22 @@ class BaseDynamicEntityForm(ModelForm):
                 # for enum enough standard validator
                 defaults['validators'] = []
 
-                enums = attribute.get_choices() \
-                                 .values_list('id', 'value')
+                group_id = attribute.enum_group_id
+                enums = [(pk, schema.get_enum(group_id, pk).value) \
+                         for pk in sorted(schema.get_enum_ids(group_id))]
 
-                choices = [('', '-----')] + list(enums)
+                choices = [('', '-----')] + enums
 
                 defaults.update({'choices': choices})
-                if value:
-                    defaults.update({'initial': value.pk})
 
             elif datatype == attribute.TYPE_DATE:
                 defaults.update({'widget': AdminSplitDateTime})
             elif datatype == attribute.TYPE_OBJECT:
                 continue
 
-            MappedField = self.FIELD_CLASSES[datatype]
-            self.fields[attribute.slug] = MappedField(**defaults)
-
-            # fill initial data (if attribute was already defined)
-            if value and not datatype == attribute.TYPE_ENUM: #enum done above
-                self.initial[attribute.slug] = value
+            prototypes.append((attribute.slug, cls.FIELD_CLASSES[datatype],
+                               defaults))
+        return prototypes
 
     def save(self, commit=True):
         """
@@ -121,7 +179,8 @@ class BaseDynamicEntityForm(ModelForm):
             value = self.cleaned_data.get(attribute.slug)
             if attribute.datatype == attribute.TYPE_ENUM:
                 if value:
-                    value = attribute.enum_group.enums.get(pk=value)
+                    value = schema.get_enum(attribute.enum_group_id,
+                                            int(value))
                 else:
                     value = None
 
@@ -132,3 +191,7 @@ class BaseDynamicEntityForm(ModelForm):
             instance.save()
 
         return instance
+
+
+#: The process-wide :class:`FieldPrototypeCache`
+field_prototypes = FieldPrototypeCache()
@@ -41,9 +41,14 @@ class EAVIndex(indexes.ModelSearchIndex):
         Bit of a hack; set values on object for later extraction.
         """
         eavs = obj.eav.get_attributes_and_values()
+        # only the attributes of the object's attribute set are indexed
+        slugs = set(obj.eav.get_all_attribute_slugs())
         for fieldname, field in self.fields.items():
             if getattr(field, 'eav', False):
-                setattr(obj, field.model_attr, eavs.get(field.model_attr, None))
+                value = None
+                if field.model_attr in slugs:
+                    value = eavs.get(field.model_attr, None)
+                setattr(obj, field.model_attr, value)
         return super(EAVIndex, self).full_prepare(obj)
         
             
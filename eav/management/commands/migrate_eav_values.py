@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+#
+#    This software is derived from EAV-Django originally written and
+#    copyrighted by Andrey Mikhaylenko <http://pypi.python.org/pypi/eav-django>
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_model, get_models
+from django.contrib.contenttypes.models import ContentType
+from django.utils import simplejson
+
+from eav.models import Attribute, Value, ValueDocument, TYPED_VALUE_MODELS, \
+                       get_value_model, uses_typed_values
+from eav.storage import JsonStorage, get_storage, _bulk_batch_size
+from eav.value_cache import get_value_cache
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = 'Moves the eav values of the given registered models, or of all ' \
+           'of them, to the tables their config uses: to the JSON ' \
+           'documents if storage_class is JsonStorage, else to the typed ' \
+           'value tables if typed_values is set, else to the Value table. ' \
+           'Each batch is moved in its own transaction.'
+
+    requires_model_validation = False
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" '
+                         'database.'),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=1000,
+                    help='The number of values, or documents, moved per '
+                         'transaction. Defaults to 1000.'),
+    )
+
+    def handle(self, *args, **options):
+        using = options.get('database')
+        batch_size = options.get('batch_size')
+        if args:
+            models = []
+            for label in args:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError('Expected app_label.ModelName, got %r'
+                                       % label)
+                model_cls = get_model(app_label, model_name)
+                if model_cls is None:
+                    raise CommandError('Unknown model: %s' % label)
+                if not hasattr(model_cls, '_eav_config_cls'):
+                    raise CommandError('%s is not registered with eav'
+                                       % label)
+                models.append(model_cls)
+        else:
+            models = [m for m in get_models() \
+                      if hasattr(m, '_eav_config_cls')]
+
+        for model_cls in models:
+            if isinstance(get_storage(model_cls), JsonStorage):
+                sources = [Value] + TYPED_VALUE_MODELS.values()
+                target = ValueDocument._meta.db_table
+                move_batch = self.move_batch_to_documents
+            else:
+                if uses_typed_values(model_cls):
+                    sources = [Value]
+                    target = 'typed value tables'
+                else:
+                    sources = TYPED_VALUE_MODELS.values()
+                    target = Value._meta.db_table
+                sources = sources + [ValueDocument]
+                move_batch = self.move_batch
+            moved = 0
+            for source in sources:
+                while True:
+                    with transaction.commit_on_success(using=using):
+                        count = move_batch(model_cls, source, batch_size,
+                                           using)
+                    if not count:
+                        break
+                    moved += count
+            value_cache = get_value_cache(model_cls)
+            if moved and value_cache is not None:
+                value_cache.invalidate_all(using)
+            if int(options.get('verbosity', 1)):
+                self.stdout.write('%s: %d row(s) moved to %s\n' % (
+                    model_cls._meta.object_name, moved, target))
+
+    def move_batch(self, model_cls, source, batch_size, using):
+        '''
+        Moves the first *batch_size* values, or documents, of the entities
+        of *model_cls* from the *source* model to the value models their
+        config uses, and returns the number of rows read.
+
+        Values the target models already have for the same entity and
+        attribute, written after the config changed, are kept, and the
+        source values are dropped.
+        '''
+        ct = ContentType.objects.db_manager(using).get_for_model(model_cls)
+        rows = source.objects.using(using).filter(entity_ct=ct)
+        if source is ValueDocument:
+            batch = list(rows.order_by('pk')[:batch_size])
+            storage = JsonStorage(model_cls)
+            values = []
+            for document in batch:
+                data = simplejson.loads(document.data)
+                values.extend(storage._to_values(document.entity_id, data))
+        else:
+            batch = values = list(rows.select_related('attribute') \
+                                      .order_by('pk')[:batch_size])
+        moved = {}
+        for value in values:
+            fields = value._value_fields()
+            if all(getattr(value, f.attname) is None for f in fields):
+                continue
+            value_model = get_value_model(model_cls, value.attribute.datatype)
+            new_value = value_model(entity_ct=ct, entity_id=value.entity_id,
+                                    attribute=value.attribute)
+            for field in fields:
+                setattr(new_value, field.attname, getattr(value, field.attname))
+            moved.setdefault(value_model, []).append(new_value)
+        for value_model, values in moved.iteritems():
+            existing = set(value_model.objects.using(using).filter(
+                                entity_ct=ct,
+                                entity_id__in=set(v.entity_id for v in values),
+                                attribute__in=set(v.attribute_id \
+                                                  for v in values)) \
+                              .values_list('entity_id', 'attribute_id'))
+            values = [v for v in values \
+                      if (v.entity_id, v.attribute_id) not in existing]
+            value_model.objects.using(using).bulk_create(values,
+                batch_size=_bulk_batch_size(value_model, values, None, using))
+        source.objects.using(using).filter(pk__in=[v.pk for v in batch]) \
+                                   .delete()
+        return len(batch)
+
+    def move_batch_to_documents(self, model_cls, source, batch_size, using):
+        '''
+        Merges the first *batch_size* values of the entities of *model_cls*
+        in the *source* value model into their JSON documents, and returns
+        the number of values read.
+
+        Values the documents already have, written after the config
+        changed, are kept, and the source values are dropped.
+        '''
+        storage = get_storage(model_cls)
+        ct = ContentType.objects.db_manager(using).get_for_model(model_cls)
+        batch = list(source.objects.using(using).filter(entity_ct=ct) \
+                           .select_related('attribute').order_by('pk') \
+                           [:batch_size])
+        patches = {}
+        for value in batch:
+            attribute = value.attribute
+            key = str(attribute.pk)
+            if attribute.datatype == Attribute.TYPE_OBJECT:
+                if value.generic_value_id is None:
+                    continue
+                patch = {key: value.generic_value_id,
+                         storage.ct_key(attribute): value.generic_value_ct_id}
+            elif attribute.datatype == Attribute.TYPE_ENUM:
+                if value.value_enum_id is None:
+                    continue
+                patch = {key: value.value_enum_id}
+            elif value.value is None or value.value == '':
+                continue
+            else:
+                patch = storage._patch([(attribute, value.value)])
+            patches.setdefault(value.entity_id, {}).update(patch)
+        documents = dict(storage._documents(patches.keys(), using))
+        for entity_id, patch in patches.iteritems():
+            data = documents.get(entity_id, {})
+            for key in patch.keys():
+                if data.get(key.split('_')[0]) is not None:
+                    del patch[key]
+            if patch:
+                storage._write_patch(entity_id, patch, using)
+        source.objects.using(using).filter(pk__in=[v.pk for v in batch]) \
+                                   .delete()
+        return len(batch)
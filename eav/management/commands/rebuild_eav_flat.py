@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+#
+#    This software is derived from EAV-Django originally written and
+#    copyrighted by Andrey Mikhaylenko <http://pypi.python.org/pypi/eav-django>
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_model, get_models
+
+from eav.flat import get_flat_table
+from eav.schema import schema
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = 'Creates the eav flat tables of the given models, or of all the ' \
+           'models registered with one, adds columns for new attributes, ' \
+           'and refills them from the eav values.'
+
+    requires_model_validation = False
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" '
+                         'database.'),
+        make_option('--columns-only', action='store_true',
+                    dest='columns_only', default=False,
+                    help='Only add and fill the missing columns, without '
+                         'rebuilding the tables.'),
+    )
+
+    def handle(self, *args, **options):
+        using = options.get('database')
+        if args:
+            models = []
+            for label in args:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError('Expected app_label.ModelName, got %r'
+                                       % label)
+                model_cls = get_model(app_label, model_name)
+                if model_cls is None:
+                    raise CommandError('Unknown model: %s' % label)
+                if get_flat_table(model_cls) is None:
+                    raise CommandError('%s is not registered with eav with '
+                                       'a flat table' % label)
+                models.append(model_cls)
+        else:
+            models = [m for m in get_models() \
+                      if get_flat_table(m) is not None]
+
+        for model_cls in models:
+            flat_table = get_flat_table(model_cls)
+            with transaction.commit_on_success(using=using):
+                added = flat_table.sync_columns(
+                            fill=options.get('columns_only'), using=using)
+                if not options.get('columns_only'):
+                    flat_table.rebuild(using=using)
+            schema.publish()
+            if int(options.get('verbosity', 1)):
+                self.stdout.write('%s: %d column(s) added%s\n' % (
+                    flat_table.name, len(added),
+                    '' if options.get('columns_only') else ', rebuilt'))
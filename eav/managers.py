@@ -26,10 +26,37 @@ Functions and Classes
 ---------------------
 '''
 from functools import wraps
+from hashlib import md5
+from itertools import islice
 
-from django.db import models
+from django.db import models, connections, transaction
+from django.db.models.query import ValuesQuerySet, ValuesListQuerySet
+from django.db.models.sql import InsertQuery
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.utils.datastructures import SortedDict
+from django.utils.translation import ugettext_lazy as _
 
-from .models import Attribute, Value
+from .models import Attribute, Value, Entity, PREFETCH_BATCH_SIZE
+from .schema import schema
+from .flat import get_flat_table, FlatSubquery
+from .storage import get_storage, _bulk_batch_size
+from .value_cache import get_value_cache
+
+#: ``transaction.atomic`` where available (Django >= 1.6)
+atomic = getattr(transaction, 'atomic', transaction.commit_on_success)
+
+#: The default batch size of :meth:`EntityManager.bulk_create_with_eav`
+BULK_BATCH_SIZE = 1000
+
+#: How many instances :class:`EntityQuerySet` reads from the database before
+#: loading their EAV values, when :meth:`EntityQuerySet.prefetch_eav` is used.
+PREFETCH_CHUNK_SIZE = 500
+
+#: The default number of instances :meth:`EntityQuerySet.iter_eav` reads per
+#: query.
+ITER_CHUNK_SIZE = 2000
 
 
 def eav_filter(func):
@@ -52,7 +79,11 @@ def eav_filter(func):
         for key, value in kwargs.items():
             # modify kwargs (warning: recursion ahead)
             new_key, new_value = expand_eav_filter(self.model, key, value)
-            new_kwargs.update({new_key: new_value})
+            if new_key in new_kwargs:
+                # several eav filters expand to the same key, e.g. 'pk__in'
+                new_args.append(models.Q(**{new_key: new_value}))
+            else:
+                new_kwargs[new_key] = new_value
 
         return func(self, *new_args, **new_kwargs)
     return wrapper
@@ -61,64 +92,311 @@ def eav_filter(func):
 def expand_q_filters(q, root_cls):
     '''
     Takes a Q object and a model class.
-    Recursivley passes each filter / value in the Q object tree leaf nodes
-    through expand_eav_filter
+    Returns a copy of the Q object tree, with each filter / value in its leaf
+    nodes passed through expand_eav_filter. The connectors and negations of
+    the tree are kept, so each eav leaf stays an independent semi-join (or
+    anti-join, when negated) on the entity's primary key.
     '''
-    new_children = []
+    new_q = models.Q()
+    new_q.connector = q.connector
+    new_q.negated = q.negated
     for qi in q.children:
         if type(qi) is tuple:
             # this child is a leaf node: in Q this is a 2-tuple of:
             # (filter parameter, value)
-            key, value = expand_eav_filter(root_cls, *qi)
-            new_children.append(models.Q(**{key: value}))
+            new_q.children.append(expand_eav_filter(root_cls, *qi))
         else:
             # this child is another Q node: recursify!
-            new_children.append(expand_q_filters(qi, root_cls))
-    q.children = new_children
-    return q
+            new_q.children.append(expand_q_filters(qi, root_cls))
+    return new_q
 
 
-def expand_eav_filter(model_cls, key, value):
+class FilterPlanCache(object):
     '''
-    Accepts a model class and a key, value.
-    Recurisively replaces any eav filter with a subquery.
+    Memoizes how each filter key of each model is translated by
+    :func:`expand_eav_filter`, so that only the value has to be bound when
+    the same filter is used again. Use the :data:`filter_plans` instance.
 
-    For example::
+    It is cleared when the :data:`~eav.schema.schema` changes and when a
+    model is registered or unregistered. *hits* and *misses* count the
+    lookups since the process started.
+    '''
 
-        key = 'eav__height'
-        value = 5
+    def __init__(self):
+        self._plans = {}
+        self._version = schema.version
+        self.hits = 0
+        self.misses = 0
 
-    Would return::
+    def clear(self):
+        '''
+        Discards all the compiled plans.
+        '''
+        self._plans = {}
+        self._version = schema.version
 
-        key = 'eav_values__in'
-        value = Values.objects.filter(value_int=5, attribute__slug='height')
+    def get(self, model_cls, key):
+        '''
+        Returns the plan of the filter *key* on *model_cls*: None if it isn't
+        an eav filter, or a tuple of the relation path leading to the entity
+        and a function binding a value to the filter, which returns the
+        subquery selecting the primary keys of the matching entities.
+        '''
+        if self._version != schema.version:
+            self.clear()
+        try:
+            plan = self._plans[(model_cls, key)]
+        except KeyError:
+            self.misses += 1
+            plan = compile_eav_filter(model_cls, key)
+            self._plans[(model_cls, key)] = plan
+        else:
+            self.hits += 1
+        return plan
+
+    @property
+    def hit_rate(self):
+        '''
+        The fraction of lookups answered from the cache, or None if there
+        wasn't any.
+        '''
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else None
+
+
+def compile_eav_filter(model_cls, key):
+    '''
+    Resolves the filter *key* on *model_cls*, following relations, and
+    returns its plan as described in :meth:`FilterPlanCache.get`.
     '''
     fields = key.split('__')
     config_cls = getattr(model_cls, '_eav_config_cls', None)
     if len(fields) > 1 and config_cls and \
        fields[0] == config_cls.eav_attr:
         slug = fields[1]
-        gr_name = config_cls.generic_relation_attr
-        datatype = Attribute.objects.get(slug=slug).datatype
+        attribute = schema.get_attribute(slug, config_cls.parent)
+        lookup = '__'.join(fields[2:])
 
-        lookup = '__%s' % fields[2] if len(fields) > 2 else ''
-        kwargs = {str('value_%s%s' % (datatype, lookup)): value,
-                  'attribute__slug': slug}
-        value = Value.objects.filter(**kwargs)
+        flat_table = get_flat_table(model_cls)
+        # isnull is left to the storage backend, so that it means the same
+        # with and without a flat table
+        if flat_table is not None and '__' not in lookup and \
+           lookup != 'isnull' and flat_table.has_column(attribute):
+            def bind(value):
+                return FlatSubquery(flat_table, attribute, lookup or 'exact',
+                                    value)
+            return '', bind
 
-        return '%s__in' % gr_name, value
+        return '', get_storage(model_cls).filter_value(attribute, lookup)
 
     try:
         field, m, direct, m2m = model_cls._meta.get_field_by_name(fields[0])
     except models.FieldDoesNotExist:
-        return key, value
+        return None
+
+    if direct and not getattr(field, 'rel', None):
+        return None
+    else:
+        related_model = field.rel.to if direct else field.model
+        plan = compile_eav_filter(related_model, '__'.join(fields[1:]))
+        if plan is None:
+            return None
+        path, bind = plan
+        return '%s__%s' % (fields[0], path), bind
+
 
-    if direct:
+#: The process-wide :class:`FilterPlanCache`
+filter_plans = FilterPlanCache()
+
+
+def expand_eav_filter(model_cls, key, value):
+    '''
+    Accepts a model class and a key, value.
+    Recurisively replaces any eav filter with a subquery on the entity's
+    primary key.
+
+    For example::
+
+        key = 'eav__height'
+        value = 5
+
+    Would return::
+
+        key = 'pk__in'
+        value = Value.objects.filter(entity_ct=<ct>, attribute=<height>,
+                                     value_int=5).values('entity_id')
+
+    Each eav condition is a semi-join on its own, so conditions on several
+    attributes can be combined freely, and no ``distinct()`` is needed. The
+    subquery is built by the model's storage backend (see
+    :meth:`~eav.storage.BaseStorage.filter_value`), unless the model has a
+    flat table with a column for the attribute (see :mod:`eav.flat`), which
+    it reads instead.
+
+    The translation of *key* is cached in :data:`filter_plans`.
+    '''
+    plan = filter_plans.get(model_cls, key)
+    if plan is None:
         return key, value
+
+    path, bind = plan
+    return '%spk__in' % path, bind(value)
+
+
+def eav_value_sql(model_cls, attribute, connection, alias=None):
+    '''
+    Returns the SQL, in parentheses, and parameters of a correlated subquery
+    selecting the value of *attribute* for each row of *model_cls*'s table,
+    or NULL if the entity has none. Enum values select the
+    :class:`~eav.models.EnumValue` text, object values the object id.
+    *alias* is the table's alias in the outer query, if it has one.
+
+    The value is read from the model's flat table if it has a column for
+    *attribute*.
+    '''
+    qn = connection.ops.quote_name
+    table = model_cls._meta.db_table
+    if alias is None or alias == table:
+        alias = qn(table)
+    entity_pk = '%s.%s' % (alias, qn(model_cls._meta.pk.column))
+    flat_table = get_flat_table(model_cls)
+    if flat_table is not None and \
+       flat_table.has_column(attribute, connection.alias):
+        sql = flat_table.column_sql(attribute, entity_pk, connection.alias)
+        params = []
     else:
-        sub_key = '__'.join(fields[1:])
-        key, value = expand_eav_filter(field.model, sub_key, value)
-        return '%s__%s' % (fields[0], key), value
+        sql, params = get_storage(model_cls).value_sql(attribute, entity_pk,
+                                                       connection)
+    if attribute.datatype == Attribute.TYPE_ENUM:
+        enum_value = Value._meta.get_field('value_enum').rel.to
+        sql = 'SELECT %s FROM %s WHERE %s IN (%s)' % (
+            qn(enum_value._meta.get_field('value').column),
+            qn(enum_value._meta.db_table),
+            qn(enum_value._meta.pk.column), sql)
+    return '(%s)' % sql, params
+
+
+class EavValueColumn(object):
+    '''
+    The value of an eav attribute as a column of an aggregate, rendered as
+    the correlated subquery of :func:`eav_value_sql`. Aggregates don't take
+    query parameters in Django 1.4, so the content type and attribute
+    primary keys are rendered inline.
+    '''
+
+    def __init__(self, model_cls, attribute, alias=None):
+        self.model_cls = model_cls
+        self.attribute = attribute
+        self.alias = alias
+
+    def as_sql(self, qn, connection):
+        sql, params = eav_value_sql(self.model_cls, self.attribute, connection,
+                                    self.alias)
+        return sql % tuple(int(p) for p in params)
+
+
+class EavAggregate(object):
+    '''
+    Stands in for an aggregate over an eav path, such as
+    ``Avg('eav__height')``, when it is passed to ``annotate()`` or
+    ``aggregate()`` by :class:`EntityQuerySet`. Django resolves its
+    *lookup* (the primary key) as usual, and it then aggregates an
+    :class:`EavValueColumn` instead.
+    '''
+    lookup = 'pk'
+
+    def __init__(self, aggregate, model_cls, attribute):
+        self.aggregate = aggregate
+        self.name = aggregate.name
+        self.extra = aggregate.extra
+        self.model_cls = model_cls
+        self.attribute = attribute
+        if attribute.datatype == Attribute.TYPE_OBJECT:
+            self.source = Value._meta.get_field('generic_value_id')
+        elif attribute.datatype == Attribute.TYPE_ENUM:
+            self.source = Value._meta.get_field('value_enum') \
+                               .rel.to._meta.get_field('value')
+        else:
+            self.source = Value._meta.get_field('value_%s' % \
+                                                attribute.datatype)
+
+    @property
+    def default_alias(self):
+        return self.aggregate.default_alias
+
+    def add_to_query(self, query, alias, col, source, is_summary):
+        klass = getattr(query.aggregates_module, self.name)
+        # *col* is the entity's primary key, in the alias of its table
+        column = EavValueColumn(self.model_cls, self.attribute, col[0])
+        query.aggregates[alias] = klass(column, source=self.source,
+                                        is_summary=is_summary, **self.extra)
+
+
+def _related_instances(instances, name):
+    '''
+    Returns the instances related to each of *instances* through the relation
+    *name*, using whatever select_related() or prefetch_related() already
+    loaded.
+    '''
+    related = []
+    for instance in instances:
+        obj = getattr(instance, name, None)
+        if obj is None:
+            continue
+        if hasattr(obj, 'all'):
+            related.extend(obj.all())
+        else:
+            related.append(obj)
+    return related
+
+
+def prefetch_eav_values(instances, lookups):
+    '''
+    Loads the EAV values of *instances*, and of registered models related to
+    them, with one query per content type.
+
+    Each of *lookups* is either an attribute slug (``'age'``), or a path
+    through relations ending with an attribute slug or with the related
+    model's eav attribute name, to load all of its values (``'patient__age'``,
+    ``'patient__eav__age'``, ``'patient__eav'``). An empty lookup loads all
+    the values of *instances* themselves.
+    '''
+    # the slugs to load for each model, None meaning all of them
+    slugs = {}
+    # the instances to load them for, by id() since several instances of
+    # the same model may have the same primary key
+    targets = {}
+    for lookup in lookups:
+        objs = instances
+        parts = lookup.split('__') if lookup else []
+        slug = None
+        while parts and objs:
+            part = parts.pop(0)
+            config_cls = getattr(objs[0], '_eav_config_cls', None)
+            if config_cls and part == config_cls.eav_attr:
+                slug = parts[0] if parts else None
+                break
+            if config_cls and not parts:
+                slug = part
+                break
+            objs = _related_instances(objs, part)
+
+        for obj in objs:
+            config_cls = getattr(obj, '_eav_config_cls', None)
+            if not config_cls or config_cls.manager_only:
+                continue
+            model_slugs = slugs.get(obj.__class__, set())
+            if model_slugs is not None and slug is not None:
+                model_slugs.add(slug)
+            slugs[obj.__class__] = None if slug is None else model_slugs
+            targets[id(obj)] = obj
+
+    entities = {}
+    for obj in targets.itervalues():
+        entity = getattr(obj, obj._eav_config_cls.eav_attr)
+        entities.setdefault(obj.__class__, []).append(entity)
+    for model_cls, model_entities in entities.iteritems():
+        Entity.prefetch_values(model_entities, slugs[model_cls])
 
 
 class EntityManager(models.Manager):
@@ -132,7 +410,7 @@ class EntityManager(models.Manager):
         Pass *args* and *kwargs* through :func:`eav_filter`, then pass to
         the ``models.Manager`` filter method.
         '''
-        return super(EntityManager, self).filter(*args, **kwargs).distinct()
+        return super(EntityManager, self).filter(*args, **kwargs)
 
     @eav_filter
     def exclude(self, *args, **kwargs):
@@ -140,7 +418,7 @@ class EntityManager(models.Manager):
         Pass *args* and *kwargs* through :func:`eav_filter`, then pass to
         the ``models.Manager`` exclude method.
         '''
-        return super(EntityManager, self).exclude(*args, **kwargs).distinct()
+        return super(EntityManager, self).exclude(*args, **kwargs)
 
     @eav_filter
     def get(self, *args, **kwargs):
@@ -160,6 +438,17 @@ class EntityManager(models.Manager):
         if not config_cls or config_cls.manager_only:
             return super(EntityManager, self).create(**kwargs)
 
+        obj = self._build_instance(kwargs)
+        obj.save()
+        return obj
+
+    def _build_instance(self, kwargs):
+        '''
+        Returns a new, unsaved instance built from *kwargs*, with the eav
+        attributes in *kwargs* (prefixed with the eav attribute name) set on
+        its entity.
+        '''
+        config_cls = self.model._eav_config_cls
         prefix = '%s__' % config_cls.eav_attr
 
         new_kwargs = {}
@@ -174,9 +463,119 @@ class EntityManager(models.Manager):
         obj_eav = getattr(obj, config_cls.eav_attr)
         for key, value in eav_kwargs.iteritems():
             setattr(obj_eav, key, value)
-        obj.save()
         return obj
 
+    def bulk_create_with_eav(self, objs, batch_size=BULK_BATCH_SIZE):
+        '''
+        Creates many entities and their eav values with a few bulk inserts.
+
+        *objs* is a list of unsaved model instances, with eav attributes set
+        on their entity, or of dicts of keyword arguments as accepted by
+        :meth:`create`, e.g. ``{'name': 'Bob', 'eav__age': 5}``.
+
+        All eav values are validated in memory first, and a
+        ``ValidationError`` is raised before anything is written if any of
+        them is invalid. The entities are then inserted with
+        ``bulk_create()``, and all their values are written by the storage
+        backend (see :meth:`~eav.storage.BaseStorage.create_values`), in
+        batches of *batch_size*, in a single transaction.
+
+        Returns the list of created instances, with their primary keys set.
+
+        .. note::
+           Like ``bulk_create()``, this doesn't call ``save()`` and doesn't
+           send any signals.
+
+        .. note::
+           On databases where ``bulk_create()`` doesn't return primary keys,
+           other than SQLite, the entities without one are inserted one by
+           one to get theirs.
+        '''
+        config_cls = getattr(self.model, '_eav_config_cls', None)
+        if not config_cls or config_cls.manager_only:
+            objs = [self.model(**o) if isinstance(o, dict) else o \
+                    for o in objs]
+            return self.bulk_create(objs, batch_size=batch_size)
+
+        instances = [self._build_instance(o) if isinstance(o, dict) else o \
+                     for o in objs]
+        entities = [getattr(o, config_cls.eav_attr) for o in instances]
+        for entity in entities:
+            entity.validate_attributes()
+
+        with atomic(using=self.db):
+            for i in range(0, len(instances), batch_size):
+                self._bulk_insert_with_pks(instances[i:i + batch_size])
+
+            rows = get_storage(self.model).create_values(entities,
+                                                         batch_size,
+                                                         using=self.db)
+
+            flat_table = get_flat_table(self.model)
+            if flat_table is not None:
+                flat_table.insert_rows(rows, using=self.db)
+        return instances
+
+    def _bulk_insert_with_pks(self, instances):
+        '''
+        Inserts *instances*, setting the primary keys of those that didn't
+        have one.
+
+        They are inserted with ``bulk_create()`` when the database returns
+        the keys, or on SQLite, where they are read back as the highest keys
+        of the table: new rowids are always above the existing ones, and the
+        transaction holds the write lock from the insert on. On PostgreSQL,
+        each batch is one multi-row ``INSERT ... RETURNING``.
+
+        .. note::
+           Other databases can't return the keys of a multi-row insert, so
+           the instances without a key are inserted there one by one, with
+           a round trip each.
+        '''
+        connection = connections[self.db]
+        with_pk = [o for o in instances if o.pk is not None]
+        without_pk = [o for o in instances if o.pk is None]
+        if with_pk:
+            self.bulk_create(with_pk, batch_size=_bulk_batch_size(self.model,
+                                                    with_pk, None, self.db))
+        if not without_pk:
+            return
+
+        if connection.vendor == 'sqlite' or getattr(connection.features,
+                                'can_return_ids_from_bulk_insert', False):
+            self.bulk_create(without_pk, batch_size=_bulk_batch_size(
+                                    self.model, without_pk, None, self.db))
+            if without_pk[0].pk is None:
+                pks = self.get_query_set().order_by('-pk') \
+                          .values_list('pk', flat=True)[:len(without_pk)]
+                for obj, pk in zip(without_pk, reversed(list(pks))):
+                    obj.pk = pk
+        elif connection.vendor == 'postgresql':
+            fields = [f for f in self.model._meta.local_fields \
+                      if not isinstance(f, models.AutoField)]
+            batch_size = _bulk_batch_size(self.model, without_pk, None,
+                                          self.db)
+            cursor = connection.cursor()
+            for i in range(0, len(without_pk), batch_size):
+                batch = without_pk[i:i + batch_size]
+                query = InsertQuery(self.model)
+                query.insert_values(fields, batch)
+                compiler = query.get_compiler(using=self.db)
+                compiler.return_id = False
+                [(insert_sql, params)] = compiler.as_sql()
+                cursor.execute('%s RETURNING %s' % (insert_sql,
+                        connection.ops.quote_name(self.model._meta.pk.column)),
+                    params)
+                # the rows are returned in the order of the VALUES list
+                for obj, (pk,) in zip(batch, cursor.fetchall()):
+                    obj.pk = pk
+        else:
+            fields = [f for f in self.model._meta.local_fields \
+                      if not isinstance(f, models.AutoField)]
+            for obj in without_pk:
+                obj.pk = self._insert([obj], fields=fields, return_id=True,
+                                      using=self.db)
+
     def get_or_create(self, **kwargs):
         '''
         Reproduces the behavior of get_or_create, eav friendly.
@@ -192,6 +591,36 @@ class EntityManager(models.Manager):
         """
         return EntityQuerySet(self.model, using=self._db)
 
+    def prefetch_eav(self, *lookups):
+        '''
+        See :meth:`EntityQuerySet.prefetch_eav`.
+        '''
+        return self.get_query_set().prefetch_eav(*lookups)
+
+    def update_eav(self, **kwargs):
+        '''
+        See :meth:`EntityQuerySet.update_eav`.
+        '''
+        return self.get_query_set().update_eav(**kwargs)
+
+    def values_eav(self, *slugs, **kwargs):
+        '''
+        See :meth:`EntityQuerySet.values_eav`.
+        '''
+        return self.get_query_set().values_eav(*slugs, **kwargs)
+
+    def iter_eav(self, *slugs, **kwargs):
+        '''
+        See :meth:`EntityQuerySet.iter_eav`.
+        '''
+        return self.get_query_set().iter_eav(*slugs, **kwargs)
+
+    def eav_facets(self, *slugs, **kwargs):
+        '''
+        See :meth:`EntityQuerySet.eav_facets`.
+        '''
+        return self.get_query_set().eav_facets(*slugs, **kwargs)
+
 
 class EntityQuerySet(models.query.QuerySet):
     """
@@ -211,3 +640,542 @@ class EntityQuerySet(models.query.QuerySet):
         Pass exclude through :func:`eav_filter`
         """
         return super(EntityQuerySet, self).exclude(*args, **kwargs)
+
+    def order_by(self, *field_names):
+        """
+        Accepts ``eav__<slug>`` (or ``-eav__<slug>``) as well as normal
+        field names, e.g.::
+
+            Patient.objects.order_by('eav__age', '-eav__city')[:10]
+
+        Each eav attribute is sorted on a correlated subquery selecting its
+        value (see :func:`eav_value_sql`), so that sorting and slicing
+        happen in the database. Entities without a value come last, in
+        both directions. Enum attributes sort on their text.
+
+        After :meth:`values`, the selected eav paths are sorted on as they
+        are, with the database's default placement of NULLs.
+        """
+        config_cls = getattr(self.model, '_eav_config_cls', None)
+        if not config_cls:
+            return super(EntityQuerySet, self).order_by(*field_names)
+
+        prefix = '%s__' % config_cls.eav_attr
+        select = SortedDict()
+        select_params = []
+        names = []
+        for name in field_names:
+            field = name.lstrip('-')
+            if not field.startswith(prefix) or \
+               field in self.query.extra_select:
+                # already selected by values()
+                names.append(name)
+                continue
+            slug = field[len(prefix):]
+            attribute = schema.get_attribute(slug, config_cls.parent)
+            sql, params = eav_value_sql(self.model, attribute,
+                                        connections[self.db],
+                                        self._get_entity_alias())
+            alias = '_eav_order_%s' % slug
+            select['%s_isnull' % alias] = '%s IS NULL' % sql
+            select[alias] = sql
+            select_params.extend(params * 2)
+            names.append('%s_isnull' % alias)
+            names.append(name[:len(name) - len(field)] + alias)
+
+        qs = self
+        if select:
+            qs = self.extra(select=select, select_params=select_params)
+        return super(EntityQuerySet, qs).order_by(*names)
+
+    def _get_entity_alias(self):
+        """
+        Returns the alias of the model's table in this QuerySet's query, or
+        None if it has none yet.
+        """
+        return self.query.tables[0] if self.query.tables else None
+
+    def _get_eav_attribute(self, lookup):
+        """
+        Returns the attribute of the eav path *lookup*, like ``'eav__age'``,
+        or None if it isn't one.
+        """
+        config_cls = getattr(self.model, '_eav_config_cls', None)
+        fields = lookup.split('__')
+        if not config_cls or len(fields) != 2 or \
+           fields[0] != config_cls.eav_attr:
+            return None
+        return schema.get_attribute(fields[1], config_cls.parent)
+
+    def _expand_eav_aggregates(self, args, kwargs):
+        """
+        Returns the keyword arguments of ``aggregate()`` or ``annotate()``,
+        with aggregates over eav paths replaced by :class:`EavAggregate`.
+        """
+        for arg in args:
+            if arg.default_alias in kwargs:
+                raise ValueError("The named annotation '%s' conflicts with "
+                                 "the default name for another annotation."
+                                 % arg.default_alias)
+            kwargs[arg.default_alias] = arg
+        for alias, aggregate in kwargs.items():
+            attribute = self._get_eav_attribute(aggregate.lookup)
+            if attribute is not None:
+                kwargs[alias] = EavAggregate(aggregate, self.model, attribute)
+        return kwargs
+
+    def aggregate(self, *args, **kwargs):
+        """
+        Accepts aggregates over eav paths as well as normal fields, e.g.::
+
+            Patient.objects.filter(eav__country='Mali') \
+                           .aggregate(Avg('eav__height'), Max('eav__age'))
+
+        They are computed by the database, on a correlated subquery
+        selecting each entity's value.
+        """
+        kwargs = self._expand_eav_aggregates(args, kwargs)
+        return super(EntityQuerySet, self).aggregate(**kwargs)
+
+    def annotate(self, *args, **kwargs):
+        """
+        Accepts aggregates over eav paths as well as normal fields. Combined
+        with :meth:`values`, this groups by eav attributes in the
+        database::
+
+            Patient.objects.values('eav__fever') \
+                           .annotate(Count('pk'), Sum('eav__weight'))
+        """
+        kwargs = self._expand_eav_aggregates(args, kwargs)
+        return super(EntityQuerySet, self).annotate(**kwargs)
+
+    def _with_eav_selects(self, fields):
+        """
+        Returns a clone of this QuerySet selecting each eav path among
+        *fields* under its own name, with an ``extra()`` select.
+        """
+        select = SortedDict()
+        select_params = []
+        for field in fields:
+            attribute = self._get_eav_attribute(field)
+            if attribute is not None and field not in select:
+                sql, params = eav_value_sql(self.model, attribute,
+                                            connections[self.db],
+                                            self._get_entity_alias())
+                select[field] = sql
+                select_params.extend(params)
+        clone = self._clone()
+        if select:
+            clone = clone.extra(select=select, select_params=select_params)
+        clone._eav_prefetch_lookups = ()
+        return clone
+
+    def values(self, *fields):
+        """
+        Accepts eav paths as well as field names, e.g.
+        ``values('name', 'eav__age')``. Rows have the values under the eav
+        path, or None.
+        """
+        return self._with_eav_selects(fields)._clone(
+                    klass=EntityValuesQuerySet, setup=True, _fields=fields)
+
+    def values_list(self, *fields, **kwargs):
+        """
+        Accepts eav paths as well as field names, like :meth:`values`.
+        """
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s'
+                    % (kwargs.keys(),))
+        if flat and len(fields) > 1:
+            raise TypeError("'flat' is not valid when values_list is called "
+                            "with more than one field.")
+        return self._with_eav_selects(fields)._clone(
+                    klass=EntityValuesListQuerySet, setup=True, flat=flat,
+                    _fields=fields)
+
+    def values_eav(self, *slugs, **kwargs):
+        """
+        Returns a list with a dict for each entity of this QuerySet, mapping
+        the names of the model fields in *include* and the eav attribute
+        *slugs* to their values, or with a tuple of those values if *tuples*
+        is True. For example::
+
+            Patient.objects.filter(eav__country='Mali') \
+                           .values_eav('age', 'fever', include=['id', 'name'])
+
+        The rows are read with a single query, joining the entities to their
+        values and pivoting them with one aggregate per attribute (see
+        :meth:`~eav.storage.BaseStorage.pivot_sql`). No model instance or
+        :class:`~eav.models.Entity` is created. Enum attributes give the
+        :class:`~eav.models.EnumValue` text, object attributes the object's
+        primary key, and missing values None.
+
+        The QuerySet's ordering and slicing are kept.
+        """
+        include = list(kwargs.pop('include', ()))
+        tuples = kwargs.pop('tuples', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_eav: %s'
+                            % (kwargs.keys(),))
+
+        config_cls = self.model._eav_config_cls
+        attributes = [schema.get_attribute(slug, config_cls.parent) \
+                      for slug in slugs]
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+
+        query = self.query.clone()
+        query.select_related = False
+        compiler = query.get_compiler(using=self.db)
+        compiler.pre_sql_setup()
+        compiler.get_columns()
+        ordering, ordering_group_by = compiler.get_ordering()
+        from_, f_params = compiler.get_from_clause()
+        table = compiler.quote_name_unless_alias(query.get_initial_alias())
+        entity_pk = '%s.%s' % (table, qn(opts.pk.column))
+        joins, j_params, value_columns = get_storage(self.model).pivot_sql(
+                                            attributes, entity_pk, connection)
+        try:
+            where, w_params = query.where.as_sql(
+                                qn=compiler.quote_name_unless_alias,
+                                connection=connection)
+        except EmptyResultSet:
+            return []
+
+        columns = []
+        grouping = [entity_pk]
+        params = []
+        grouping_params = []
+        for name in include:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+            column = '%s.%s' % (table, qn(field.column))
+            columns.append(column)
+            grouping.append(column)
+
+        value_fields = []
+        for attribute, (column, column_params) in zip(attributes,
+                                                      value_columns):
+            columns.append(column)
+            params.extend(column_params)
+            if attribute.datatype == Attribute.TYPE_OBJECT:
+                field = Value._meta.get_field('generic_value_id')
+            else:
+                field = Value._meta.get_field('value_%s' % attribute.datatype)
+            value_fields.append((attribute, field))
+
+        # extra selects, such as those eav ordering uses
+        for alias, (sql, extra_params) in query.extra_select.items():
+            columns.append('(%s) AS %s' % (sql, qn(alias)))
+            grouping.append('(%s)' % sql)
+            params.extend(extra_params)
+            grouping_params.extend(extra_params)
+
+        sql = ['SELECT %s FROM' % ', '.join(columns or [entity_pk])]
+        sql.extend(from_)
+        params.extend(f_params)
+        if query.low_mark or query.high_mark is not None:
+            # the slice, as the database's compiler writes it
+            page = self.query.clone()
+            page.select_related = False
+            page.clear_select_fields()
+            page.add_fields([opts.pk.name], False)
+            page_sql, page_params = page.get_compiler(using=self.db).as_sql()
+            sql.append('INNER JOIN (%s) eav_page ON eav_page.%s = %s' % (
+                            page_sql, qn(opts.pk.column), entity_pk))
+            params.extend(page_params)
+        sql.append(joins)
+        params.extend(j_params)
+        if where:
+            sql.append('WHERE %s' % where)
+            params.extend(w_params)
+        for column, column_params in ordering_group_by:
+            grouping.append(str(column))
+            grouping_params.extend(column_params)
+        sql.append('GROUP BY %s' % ', '.join(grouping))
+        params.extend(grouping_params)
+        if ordering:
+            sql.append('ORDER BY %s' % ', '.join(ordering))
+
+        cursor = connection.cursor()
+        cursor.execute(' '.join(sql), params)
+
+        names = include + list(slugs)
+        convert = connection.ops.convert_values
+        results = []
+        for row in cursor.fetchall():
+            values = list(row[:len(include)])
+            for (attribute, field), value in zip(value_fields,
+                                                 row[len(include):]):
+                if value is None:
+                    pass
+                elif attribute.datatype == Attribute.TYPE_ENUM:
+                    enum = schema.get_enum(attribute.enum_group_id,
+                                           int(value))
+                    value = enum.value if enum else None
+                elif attribute.datatype == Attribute.TYPE_BOOLEAN:
+                    value = bool(value)
+                else:
+                    value = convert(value, field)
+                values.append(value)
+            if tuples:
+                results.append(tuple(values))
+            else:
+                results.append(dict(zip(names, values)))
+        return results
+
+    def prefetch_eav(self, *lookups):
+        """
+        Returns a new QuerySet that loads the EAV values of its results in
+        bulk, one query per content type for each chunk of results, instead
+        of one query per instance.
+
+        With no *lookups*, all the values are loaded. Otherwise only the
+        values of the given attribute slugs are. A lookup can also follow
+        relations to other registered models that were loaded with
+        select_related() or prefetch_related(); see
+        :func:`prefetch_eav_values`.
+
+        For example::
+
+            Patient.objects.filter(name='Bob').prefetch_eav('age', 'city')
+            Encounter.objects.select_related('patient') \\
+                             .prefetch_eav('patient__eav__age')
+        """
+        clone = self._clone()
+        clone._eav_prefetch_lookups = self._eav_prefetch_lookups + \
+                                      (lookups or ('',))
+        return clone
+
+    _eav_prefetch_lookups = ()
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        c = super(EntityQuerySet, self)._clone(klass, setup, **kwargs)
+        c._eav_prefetch_lookups = self._eav_prefetch_lookups
+        return c
+
+    def iterator(self):
+        """
+        Load EAV values of each chunk of results when
+        :meth:`prefetch_eav` was used. If prefetch_related() was used as
+        well, they are loaded once it is done instead.
+        """
+        iterator = super(EntityQuerySet, self).iterator()
+        if not self._eav_prefetch_lookups or self._prefetch_related_lookups:
+            return iterator
+        return self._eav_prefetch_iterator(iterator)
+
+    def _eav_prefetch_iterator(self, iterator):
+        while True:
+            chunk = list(islice(iterator, PREFETCH_CHUNK_SIZE))
+            if not chunk:
+                return
+            prefetch_eav_values(chunk, self._eav_prefetch_lookups)
+            for obj in chunk:
+                yield obj
+
+    def _prefetch_related_objects(self):
+        super(EntityQuerySet, self)._prefetch_related_objects()
+        if self._eav_prefetch_lookups:
+            prefetch_eav_values(self._result_cache, self._eav_prefetch_lookups)
+
+    def iter_eav(self, *slugs, **kwargs):
+        """
+        Iterates over the results of this QuerySet in chunks of
+        *chunk_size* instances (:data:`ITER_CHUNK_SIZE` by default), with
+        the EAV values of each chunk loaded by one query. With *slugs*, only
+        the values of those attributes are loaded. For example::
+
+            for p in Patient.objects.filter(name__startswith='B') \
+                                    .iter_eav('age', chunk_size=1000):
+                print p.eav.age
+
+        Chunks are read in primary key order, each one starting after the
+        last primary key of the previous one, and nothing is cached, so
+        memory use doesn't grow with the number of results. Any other
+        ordering of the QuerySet is ignored.
+        """
+        chunk_size = kwargs.pop('chunk_size', ITER_CHUNK_SIZE)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to iter_eav: %s'
+                            % (kwargs.keys(),))
+        assert self.query.can_filter(), \
+               "Cannot iterate over chunks once a slice has been taken."
+        qs = self.order_by('pk')
+        qs._eav_prefetch_lookups = ()
+        lookups = slugs or ('',)
+        last_pk = None
+        while True:
+            chunk_qs = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+            chunk = list(chunk_qs[:chunk_size].iterator())
+            if not chunk:
+                return
+            prefetch_eav_values(chunk, lookups)
+            last_pk = chunk[-1].pk
+            for obj in chunk:
+                yield obj
+            if len(chunk) < chunk_size:
+                return
+            del chunk
+
+    def eav_facets(self, *slugs, **kwargs):
+        """
+        Returns the number of entities of this QuerySet having each value of
+        the eav attributes *slugs*, as a dict mapping each slug to a dict of
+        value to count. Numeric or date attributes can be counted in buckets
+        instead, by passing their bucket bounds as keywords, e.g.::
+
+            Patient.objects.filter(eav__city='Bamako') \
+                           .eav_facets('country', 'fever', age=[0, 18, 65])
+
+        gives something like::
+
+            {'country': {u'Mali': 10},
+             'fever': {u'yes': 3, u'no': 7},
+             'age': {(0, 18): 4, (18, 65): 6, (65, None): 0}}
+
+        Values below the first bound are counted under ``(None, <first
+        bound>)``, if there are any. Enum values are counted under their
+        text.
+
+        Each attribute is counted with one ``GROUP BY`` query on the
+        storage backend's values (see
+        :meth:`~eav.storage.BaseStorage.count_values`), restricted to the
+        QuerySet with a subquery on its primary keys.
+
+        If *cache_timeout* is given, the result is cached for that many
+        seconds in the default Django cache, keyed on the SQL of this
+        QuerySet, the requested facets and the schema version shared by
+        all the processes (see :mod:`eav.schema`), so that they share the
+        entries and none of them reads entries from before a schema
+        change.
+        """
+        cache_timeout = kwargs.pop('cache_timeout', None)
+        buckets = kwargs
+        if cache_timeout is not None:
+            pk_sql, pk_params = self._as_pk_subquery()
+            key = 'eav_facets:%s' % md5(repr((
+                    self.db, pk_sql, pk_params, slugs,
+                    sorted(buckets.items()),
+                    schema.get_shared_version()))).hexdigest()
+            facets = cache.get(key)
+            if facets is not None:
+                return facets
+
+        config_cls = self.model._eav_config_cls
+        storage = get_storage(self.model)
+        pks = self.order_by().values_list('pk', flat=True)
+        facets = {}
+        for slug in list(slugs) + buckets.keys():
+            attribute = schema.get_attribute(slug, config_cls.parent)
+            if slug not in buckets:
+                rows = storage.count_values(attribute, pks, using=self.db)
+                if attribute.datatype == Attribute.TYPE_ENUM:
+                    enums = [(schema.get_enum(attribute.enum_group_id,
+                                              int(value)), count) \
+                             for value, count in rows]
+                    rows = [(enum.value, count) for enum, count in enums \
+                            if enum is not None]
+                facets[slug] = dict(rows)
+                continue
+
+            bounds = sorted(buckets[slug])
+            rows = storage.count_values(attribute, pks, bounds, using=self.db)
+            limits = [None] + bounds + [None]
+            counts = dict(((limits[i], limits[i + 1]), 0) \
+                          for i in range(1, len(bounds) + 1))
+            for i, count in rows:
+                counts[(limits[i], limits[i + 1])] = count
+            facets[slug] = counts
+
+        if cache_timeout is not None:
+            cache.set(key, facets, cache_timeout)
+        return facets
+
+    def _as_pk_subquery(self):
+        """
+        Returns the SQL and parameters of a query selecting the primary keys
+        of this QuerySet's results.
+        """
+        query = self.values_list('pk', flat=True).order_by().query
+        return query.get_compiler(using=self.db).as_sql()
+
+    def update_eav(self, **kwargs):
+        """
+        Sets eav attributes on all the entities of this QuerySet, with a
+        fixed number of SQL statements whatever the number of entities.
+        Each keyword is an attribute slug, e.g.::
+
+            Patient.objects.filter(eav__country='Mali') \\
+                           .update_eav(region='West Africa')
+
+        The primary keys of the entities are read first, with one query,
+        so that setting an attribute the QuerySet is filtered on doesn't
+        change the entities the next attributes are set on. Each attribute
+        is then written by the storage backend (see
+        :meth:`~eav.storage.BaseStorage.update_values`), for
+        ``PREFETCH_BATCH_SIZE`` entities at a time: by default, existing
+        values are changed with one ``UPDATE``, and values are added to
+        entities that don't have one with one ``INSERT ... SELECT``.
+        Setting an attribute to None deletes its values with one
+        ``DELETE``.
+
+        Returns the number of entities of the QuerySet, like
+        ``QuerySet.update()``.
+
+        .. note::
+           Like ``QuerySet.update()``, this doesn't call ``save()`` and
+           doesn't send any signals. Entities already loaded keep their
+           cached values until :meth:`~eav.models.Entity.refresh` is
+           called, but the values cached in the
+           :class:`~eav.value_cache.ValueCache` of the model are all
+           discarded.
+        """
+        assert self.query.can_filter(), \
+               "Cannot update a query once a slice has been taken."
+        config_cls = self.model._eav_config_cls
+        storage = get_storage(self.model)
+        flat_table = get_flat_table(self.model)
+        value_cache = get_value_cache(self.model)
+        attributes = []
+        for slug, new_value in kwargs.iteritems():
+            attribute = schema.get_attribute(slug, config_cls.parent)
+            if new_value is not None and new_value != '':
+                try:
+                    attribute.validate_value(new_value)
+                except ValidationError, e:
+                    raise ValidationError(_(u"%(attr)s EAV field "
+                                            u"%(err)s") % \
+                                            {'attr': slug, 'err': e})
+            attributes.append((attribute, new_value))
+
+        with atomic(using=self.db):
+            pks = list(self.values_list('pk', flat=True).order_by())
+            for i in range(0, len(pks), PREFETCH_BATCH_SIZE):
+                pk_params = pks[i:i + PREFETCH_BATCH_SIZE]
+                pk_sql = ', '.join(['%s'] * len(pk_params))
+                for attribute, new_value in attributes:
+                    storage.update_values(attribute, new_value, pk_sql,
+                                          pk_params, using=self.db)
+                    if flat_table is not None:
+                        flat_table.update_where(attribute, new_value, pk_sql,
+                                                pk_params, using=self.db)
+            transaction.commit_unless_managed(using=self.db)
+        if value_cache is not None and pks:
+            value_cache.invalidate_all(self.db)
+        return len(pks)
+
+
+class EntityValuesQuerySet(EntityQuerySet, ValuesQuerySet):
+    """
+    The ``ValuesQuerySet`` returned by :meth:`EntityQuerySet.values`, which
+    keeps accepting eav paths in ``annotate()`` and ``aggregate()``.
+    """
+
+
+class EntityValuesListQuerySet(EntityQuerySet, ValuesListQuerySet):
+    """
+    The ``ValuesListQuerySet`` returned by
+    :meth:`EntityQuerySet.values_list`.
+    """
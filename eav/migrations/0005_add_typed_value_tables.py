@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+INDEXES = (
+    ('eav_value_int_attribute_value', 'eav_value_int',
+     ['attribute_id', 'value_int']),
+    ('eav_value_float_attribute_value', 'eav_value_float',
+     ['attribute_id', 'value_float']),
+    ('eav_value_date_attribute_value', 'eav_value_date',
+     ['attribute_id', 'value_date']),
+    ('eav_value_bool_attribute_value', 'eav_value_bool',
+     ['attribute_id', 'value_bool']),
+    ('eav_value_enum_attribute_value', 'eav_value_enum',
+     ['attribute_id', 'value_enum_id']),
+    ('eav_value_object_attribute_value', 'eav_value_object',
+     ['attribute_id', 'generic_value_ct_id', 'generic_value_id']),
+)
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'ValueText'
+        db.create_table('eav_value_text', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('entity_ct', self.gf('django.db.models.fields.related.ForeignKey')(related_name='valuetext_entities', to=orm['contenttypes.ContentType'])),
+            ('entity_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('attribute', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['eav.Attribute'])),
+            ('value_text', self.gf('django.db.models.fields.TextField')()),
+        ))
+        db.send_create_signal('eav', ['ValueText'])
+
+        # Adding unique constraint on 'ValueText', fields ['entity_ct', 'entity_id', 'attribute']
+        db.create_unique('eav_value_text', ['entity_ct_id', 'entity_id', 'attribute_id'])
+
+        # Adding model 'ValueFloat'
+        db.create_table('eav_value_float', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('entity_ct', self.gf('django.db.models.fields.related.ForeignKey')(related_name='valuefloat_entities', to=orm['contenttypes.ContentType'])),
+            ('entity_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('attribute', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['eav.Attribute'])),
+            ('value_float', self.gf('django.db.models.fields.FloatField')()),
+        ))
+        db.send_create_signal('eav', ['ValueFloat'])
+
+        # Adding unique constraint on 'ValueFloat', fields ['entity_ct', 'entity_id', 'attribute']
+        db.create_unique('eav_value_float', ['entity_ct_id', 'entity_id', 'attribute_id'])
+
+        # Adding model 'ValueInt'
+        db.create_table('eav_value_int', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('entity_ct', self.gf('django.db.models.fields.related.ForeignKey')(related_name='valueint_entities', to=orm['contenttypes.ContentType'])),
+            ('entity_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('attribute', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['eav.Attribute'])),
+            ('value_int', self.gf('django.db.models.fields.IntegerField')()),
+        ))
+        db.send_create_signal('eav', ['ValueInt'])
+
+        # Adding unique constraint on 'ValueInt', fields ['entity_ct', 'entity_id', 'attribute']
+        db.create_unique('eav_value_int', ['entity_ct_id', 'entity_id', 'attribute_id'])
+
+        # Adding model 'ValueDate'
+        db.create_table('eav_value_date', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('entity_ct', self.gf('django.db.models.fields.related.ForeignKey')(related_name='valuedate_entities', to=orm['contenttypes.ContentType'])),
+            ('entity_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('attribute', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['eav.Attribute'])),
+            ('value_date', self.gf('django.db.models.fields.DateTimeField')()),
+        ))
+        db.send_create_signal('eav', ['ValueDate'])
+
+        # Adding unique constraint on 'ValueDate', fields ['entity_ct', 'entity_id', 'attribute']
+        db.create_unique('eav_value_date', ['entity_ct_id', 'entity_id', 'attribute_id'])
+
+        # Adding model 'ValueBool'
+        db.create_table('eav_value_bool', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('entity_ct', self.gf('django.db.models.fields.related.ForeignKey')(related_name='valuebool_entities', to=orm['contenttypes.ContentType'])),
+            ('entity_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('attribute', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['eav.Attribute'])),
+            ('value_bool', self.gf('django.db.models.fields.BooleanField')(default=False)),
+        ))
+        db.send_create_signal('eav', ['ValueBool'])
+
+        # Adding unique constraint on 'ValueBool', fields ['entity_ct', 'entity_id', 'attribute']
+        db.create_unique('eav_value_bool', ['entity_ct_id', 'entity_id', 'attribute_id'])
+
+        # Adding model 'ValueEnum'
+        db.create_table('eav_value_enum', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('entity_ct', self.gf('django.db.models.fields.related.ForeignKey')(related_name='valueenum_entities', to=orm['contenttypes.ContentType'])),
+            ('entity_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('attribute', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['eav.Attribute'])),
+            ('value_enum', self.gf('django.db.models.fields.related.ForeignKey')(related_name='typed_values', to=orm['eav.EnumValue'])),
+        ))
+        db.send_create_signal('eav', ['ValueEnum'])
+
+        # Adding unique constraint on 'ValueEnum', fields ['entity_ct', 'entity_id', 'attribute']
+        db.create_unique('eav_value_enum', ['entity_ct_id', 'entity_id', 'attribute_id'])
+
+        # Adding model 'ValueObject'
+        db.create_table('eav_value_object', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('entity_ct', self.gf('django.db.models.fields.related.ForeignKey')(related_name='valueobject_entities', to=orm['contenttypes.ContentType'])),
+            ('entity_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('attribute', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['eav.Attribute'])),
+            ('generic_value_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('generic_value_ct', self.gf('django.db.models.fields.related.ForeignKey')(related_name='typed_values', to=orm['contenttypes.ContentType'])),
+        ))
+        db.send_create_signal('eav', ['ValueObject'])
+
+        # Adding unique constraint on 'ValueObject', fields ['entity_ct', 'entity_id', 'attribute']
+        db.create_unique('eav_value_object', ['entity_ct_id', 'entity_id', 'attribute_id'])
+        # Adding the (attribute, value) indexes, with the names used by
+        # eav/sql/value<type>.sql
+        for name, table, columns in INDEXES:
+            db.execute('CREATE INDEX %s ON %s (%s)' % (
+                db.quote_name(name), db.quote_name(table),
+                ', '.join(db.quote_name(c) for c in columns)))
+
+    def backwards(self, orm):
+        # Deleting model 'ValueText'
+        db.delete_table('eav_value_text')
+
+        # Deleting model 'ValueFloat'
+        db.delete_table('eav_value_float')
+
+        # Deleting model 'ValueInt'
+        db.delete_table('eav_value_int')
+
+        # Deleting model 'ValueDate'
+        db.delete_table('eav_value_date')
+
+        # Deleting model 'ValueBool'
+        db.delete_table('eav_value_bool')
+
+        # Deleting model 'ValueEnum'
+        db.delete_table('eav_value_enum')
+
+        # Deleting model 'ValueObject'
+        db.delete_table('eav_value_object')
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'eav.attribute': {
+            'Meta': {'ordering': "['name']", 'unique_together': "(('site', 'slug', 'parent'),)", 'object_name': 'Attribute'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'datatype': ('eav.fields.EavDatatypeField', [], {'max_length': '6'}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'display_in_list': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'enum_group': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['eav.EnumGroup']", 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']", 'null': 'True', 'blank': 'True'}),
+            'required': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'searchable': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sites.Site']"}),
+            'slug': ('eav.fields.EavSlugField', [], {'max_length': '50'})
+        },
+        'eav.enumgroup': {
+            'Meta': {'object_name': 'EnumGroup'},
+            'enums': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['eav.EnumValue']", 'symmetrical': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '100'})
+        },
+        'eav.enumvalue': {
+            'Meta': {'object_name': 'EnumValue'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'})
+        },
+        'eav.value': {
+            'Meta': {'unique_together': "(('entity_ct', 'entity_id', 'attribute'),)", 'object_name': 'Value'},
+            'attribute': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['eav.Attribute']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'entity_ct': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'value_entities'", 'to': "orm['contenttypes.ContentType']"}),
+            'entity_id': ('django.db.models.fields.IntegerField', [], {}),
+            'generic_value_ct': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'value_values'", 'null': 'True', 'to': "orm['contenttypes.ContentType']"}),
+            'generic_value_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'value_bool': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'value_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'value_enum': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'eav_values'", 'null': 'True', 'to': "orm['eav.EnumValue']"}),
+            'value_float': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'value_int': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'value_text': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'eav.valuetext': {
+            'Meta': {'unique_together': "(('entity_ct', 'entity_id', 'attribute'),)", 'object_name': 'ValueText', 'db_table': "'eav_value_text'"},
+            'attribute': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['eav.Attribute']"}),
+            'entity_ct': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'valuetext_entities'", 'to': "orm['contenttypes.ContentType']"}),
+            'entity_id': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value_text': ('django.db.models.fields.TextField', [], {})
+        },
+        'eav.valuefloat': {
+            'Meta': {'unique_together': "(('entity_ct', 'entity_id', 'attribute'),)", 'object_name': 'ValueFloat', 'db_table': "'eav_value_float'"},
+            'attribute': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['eav.Attribute']"}),
+            'entity_ct': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'valuefloat_entities'", 'to': "orm['contenttypes.ContentType']"}),
+            'entity_id': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value_float': ('django.db.models.fields.FloatField', [], {})
+        },
+        'eav.valueint': {
+            'Meta': {'unique_together': "(('entity_ct', 'entity_id', 'attribute'),)", 'object_name': 'ValueInt', 'db_table': "'eav_value_int'"},
+            'attribute': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['eav.Attribute']"}),
+            'entity_ct': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'valueint_entities'", 'to': "orm['contenttypes.ContentType']"}),
+            'entity_id': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value_int': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'eav.valuedate': {
+            'Meta': {'unique_together': "(('entity_ct', 'entity_id', 'attribute'),)", 'object_name': 'ValueDate', 'db_table': "'eav_value_date'"},
+            'attribute': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['eav.Attribute']"}),
+            'entity_ct': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'valuedate_entities'", 'to': "orm['contenttypes.ContentType']"}),
+            'entity_id': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value_date': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        'eav.valuebool': {
+            'Meta': {'unique_together': "(('entity_ct', 'entity_id', 'attribute'),)", 'object_name': 'ValueBool', 'db_table': "'eav_value_bool'"},
+            'attribute': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['eav.Attribute']"}),
+            'entity_ct': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'valuebool_entities'", 'to': "orm['contenttypes.ContentType']"}),
+            'entity_id': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value_bool': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'eav.valueenum': {
+            'Meta': {'unique_together': "(('entity_ct', 'entity_id', 'attribute'),)", 'object_name': 'ValueEnum', 'db_table': "'eav_value_enum'"},
+            'attribute': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['eav.Attribute']"}),
+            'entity_ct': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'valueenum_entities'", 'to': "orm['contenttypes.ContentType']"}),
+            'entity_id': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value_enum': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'typed_values'", 'to': "orm['eav.EnumValue']"})
+        },
+        'eav.valueobject': {
+            'Meta': {'unique_together': "(('entity_ct', 'entity_id', 'attribute'),)", 'object_name': 'ValueObject', 'db_table': "'eav_value_object'"},
+            'attribute': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['eav.Attribute']"}),
+            'entity_ct': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'valueobject_entities'", 'to': "orm['contenttypes.ContentType']"}),
+            'entity_id': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'generic_value_ct': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'typed_values'", 'to': "orm['contenttypes.ContentType']"}),
+            'generic_value_id': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'sites.site': {
+            'Meta': {'ordering': "('domain',)", 'object_name': 'Site', 'db_table': "'django_site'"},
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['eav']
\ No newline at end of file
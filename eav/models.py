@@ -20,20 +20,26 @@
 ******
 models
 ******
-This module defines the four concrete, non-abstract models:
+This module defines the five concrete, non-abstract models:
 
 * :class:`Value`
 * :class:`Attribute`
+* :class:`AttributeSet`
 * :class:`EnumValue`
 * :class:`EnumGroup`
 
-Along with the :class:`Entity` helper class.
+Along with the :class:`Entity` helper class, and the narrow
+:class:`TypedValue` models and the :class:`ValueDocument` model that can
+store values instead of :class:`Value`.
 
 Classes
 -------
 '''
 
-from django.db import models
+from django.db import models, connections, transaction, IntegrityError, \
+                      DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.core.signals import request_started, request_finished
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
@@ -44,6 +50,11 @@ from django.conf import settings
 
 from .validators import *
 from .fields import EavSlugField, EavDatatypeField
+from .schema import schema
+from .flat import get_flat_table, attribute_delete_handler
+from .storage import get_storage
+from .value_cache import get_value_cache, value_delete_handler, \
+                         publish as publish_value_revisions
 
 
 class EnumValue(models.Model):
@@ -255,7 +266,7 @@ class Attribute(models.Model):
         for validator in self.get_validators():
             validator(value)
         if self.datatype == self.TYPE_ENUM:
-            if value not in self.enum_group.enums.all():
+            if value.pk not in schema.get_enum_ids(self.enum_group_id):
                 raise ValidationError(_(u"%(enum)s is not a valid choice "
                                         u"for %(attr)s") % \
                                        {'enum': value, 'attr': self})
@@ -307,29 +318,25 @@ class Attribute(models.Model):
         If a :class:`Value` object for this *entity* and attribute doesn't
         exist, one will be created.
 
+        Returns the saved :class:`Value` object, or None if there is no
+        longer a value for this attribute and *entity*. The value is written
+        by the storage backend of *entity* (see
+        :meth:`~eav.storage.BaseStorage.save_value`); with the default one,
+        this costs a single statement on databases that support upserts.
+
         .. note::
            If *value* is None and a :class:`Value` object exists for this
             Attribute and *entity*, it will delete that :class:`Value` object.
         '''
-        ct = ContentType.objects.get_for_model(entity)
-        try:
-            value_obj = self.value_set.get(entity_ct=ct,
-                                           entity_id=entity.pk,
-                                           attribute=self)
-        except Value.DoesNotExist:
-            if value == None or value == '':
-                return
-            value_obj = Value.objects.create(entity_ct=ct,
-                                             entity_id=entity.pk,
-                                             attribute=self)
-        if value == None or value == '':
-            value_obj.delete()
-            return
+        saved = get_storage(entity.__class__).save_value(entity, self, value)
+        flat_table = get_flat_table(entity.__class__)
+        if flat_table is not None:
+            flat_table.set_values(entity.pk, [(self, value)])
+        value_cache = get_value_cache(entity.__class__)
+        if value_cache is not None:
+            value_cache.invalidate(entity.pk)
+        return saved
 
-        if value != value_obj.value:
-            value_obj.value = value
-            value_obj.save()
-            
     @classmethod
     def get_for_model(cls, model):
         ct = ContentType.objects.get_for_model(model)
@@ -359,8 +366,333 @@ class PartitionedAttribute(Attribute):
         proxy = True
         
 
+class AttributeSet(models.Model):
+    '''
+    A named set of :class:`Attribute` objects, such as the attributes of
+    one product line. When a model is registered with a config that gives
+    each entity a set (see
+    :attr:`~eav.registry.EavConfig.attribute_set_field`), only the
+    attributes of that set apply to the entity, so saving, validating and
+    editing it only deal with those.
+
+    >>> size = Attribute.objects.create(name='Size',
+    ...                                 datatype=Attribute.TYPE_INT)
+    >>> shoes = AttributeSet.objects.create(name='Shoes')
+    >>> shoes.attributes.add(size)
+    >>> shoes.slug
+    'shoes'
+    '''
+    name = models.CharField(_(u"name"), unique=True, max_length=100)
+
+    slug = EavSlugField(_(u"slug"), max_length=50, unique=True,
+                        help_text=_(u"Short unique attribute set label"))
+
+    attributes = models.ManyToManyField(Attribute,
+                                        verbose_name=_(u"attributes"),
+                                        related_name='attribute_sets',
+                                        blank=True)
+
+    def save(self, *args, **kwargs):
+        '''
+        Saves the set and auto-generates a slug field if one wasn't
+        provided.
+        '''
+        if not self.slug:
+            self.slug = EavSlugField.create_slug_from_name(self.name)
+        super(AttributeSet, self).save(*args, **kwargs)
 
-class Value(models.Model):
+    def __unicode__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = _(u'attribute set')
+        verbose_name_plural = _(u'attribute sets')
+
+
+def _upsert_support(connection):
+    '''
+    Returns whether *connection* supports ``INSERT ... ON CONFLICT DO
+    UPDATE``, and whether it supports ``RETURNING`` with it, as a pair of
+    booleans.
+    '''
+    if connection.vendor == 'postgresql':
+        upsert = connection.pg_version >= 90500
+        return upsert, upsert
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        version = Database.sqlite_version_info
+        return version >= (3, 24, 0), version >= (3, 35, 0)
+    return False, False
+
+
+class ValueManager(models.Manager):
+    '''
+    The default manager for :class:`Value` and the :class:`TypedValue`
+    models. Adds helpers that write several values of one entity with a
+    single SQL statement each.
+    '''
+
+    def _get_modified_field(self):
+        '''
+        Returns the *modified* timestamp field of the model, or None if it
+        has none.
+        '''
+        try:
+            return self.model._meta.get_field('modified')
+        except models.FieldDoesNotExist:
+            return None
+
+    def update_entity_values(self, ct, entity_id, values):
+        '''
+        Writes the current value of every :class:`Value` in *values*, all
+        belonging to the entity identified by *ct* and *entity_id*, with one
+        ``UPDATE`` statement.
+
+        Values are matched on their attribute, so *values* don't need to
+        have a primary key.
+        '''
+        if not values:
+            return
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        modified = self._get_modified_field()
+
+        cases = {}
+        for value in values:
+            for field in value._value_fields():
+                db_value = field.get_db_prep_save(getattr(value, field.attname),
+                                                  connection=connection)
+                cases.setdefault(field.column, []) \
+                     .append((value.attribute_id, db_value))
+
+        assignments = []
+        params = []
+        for column, whens in cases.iteritems():
+            assignments.append('%s = CASE %s %s ELSE %s END' % (
+                qn(column), qn('attribute_id'),
+                ' '.join(['WHEN %s THEN %s'] * len(whens)), qn(column)))
+            for when in whens:
+                params.extend(when)
+        if modified is not None:
+            now = modified.pre_save(values[0], False)
+            for value in values[1:]:
+                setattr(value, modified.attname, now)
+            assignments.append('%s = %%s' % qn(modified.column))
+            params.append(modified.get_db_prep_save(now,
+                                                    connection=connection))
+
+        attribute_ids = [v.attribute_id for v in values]
+        sql = 'UPDATE %s SET %s WHERE %s = %%s AND %s = %%s AND %s IN (%s)' % (
+            qn(self.model._meta.db_table), ', '.join(assignments),
+            qn('entity_ct_id'), qn('entity_id'), qn('attribute_id'),
+            ', '.join(['%s'] * len(attribute_ids)))
+        params.extend([ct.pk, entity_id] + attribute_ids)
+        connection.cursor().execute(sql, params)
+        transaction.commit_unless_managed(using=self.db)
+
+    def upsert_entity_value(self, value):
+        '''
+        Validates and saves the unsaved :class:`Value` or
+        :class:`TypedValue` *value*, replacing
+        the value stored for the same entity and attribute if there is one.
+
+        On PostgreSQL 9.5+ and SQLite 3.24+ this is a single
+        ``INSERT ... ON CONFLICT DO UPDATE`` statement, relying on the unique
+        entity/attribute constraint. Elsewhere the existing value is fetched
+        and updated, or a new one inserted; if a concurrent writer inserts
+        first, the insert is rolled back and the update retried.
+
+        The primary key of *value* is set, except on SQLite before 3.35,
+        which can't return it from an upsert.
+        '''
+        # the entity and attribute are given as objects, and enums are
+        # checked against the schema by clean(): skip the queries that
+        # validate those foreign keys.
+        value.clean_fields(exclude=['entity_ct', 'attribute', 'value_enum'])
+        value.clean()
+        connection = connections[self.db]
+        upsert, returning = _upsert_support(connection)
+        if not upsert:
+            return self._get_or_insert_entity_value(value)
+
+        sql, params = self._upsert_sql([value], connection)
+        if returning:
+            sql += ' RETURNING %s' % \
+                   connection.ops.quote_name(self.model._meta.pk.column)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        if returning:
+            value.pk = cursor.fetchone()[0]
+        transaction.commit_unless_managed(using=self.db)
+        return value
+
+    def upsert_entity_values(self, values):
+        '''
+        Saves the unsaved :class:`Value` or :class:`TypedValue` objects
+        *values*, all of the same datatype, replacing the values stored for
+        the same entities and attributes. Unlike
+        :meth:`upsert_entity_value`, they aren't validated and their
+        primary keys aren't set.
+
+        On PostgreSQL 9.5+ and SQLite 3.24+ this is a single
+        ``INSERT ... ON CONFLICT DO UPDATE`` statement. Elsewhere they are
+        inserted with one ``INSERT``, and if a concurrent writer inserted
+        one of them first, it is rolled back and the values are saved one
+        at a time.
+        '''
+        if not values:
+            return
+        connection = connections[self.db]
+        if _upsert_support(connection)[0]:
+            sql, params = self._upsert_sql(values, connection)
+            connection.cursor().execute(sql, params)
+            transaction.commit_unless_managed(using=self.db)
+            return
+        sid = transaction.savepoint(using=self.db)
+        try:
+            self.using(self.db).bulk_create(values)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=self.db)
+            for value in values:
+                self._get_or_insert_entity_value(value)
+        else:
+            transaction.savepoint_commit(sid, using=self.db)
+
+    def _upsert_sql(self, values, connection):
+        '''
+        Returns the SQL and parameters of the
+        ``INSERT ... ON CONFLICT DO UPDATE`` statement saving *values*.
+        '''
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        fields = [f for f in opts.local_fields \
+                  if not isinstance(f, models.AutoField)]
+        params = []
+        for value in values:
+            params.extend([f.get_db_prep_save(f.pre_save(value, True),
+                                              connection=connection) \
+                           for f in fields])
+        updated = [f.column for f in values[0]._value_fields()]
+        modified = self._get_modified_field()
+        if modified is not None:
+            updated.append(modified.column)
+        row = '(%s)' % ', '.join(['%s'] * len(fields))
+        sql = 'INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s, %s, %s) ' \
+              'DO UPDATE SET %s' % (
+            qn(opts.db_table), ', '.join([qn(f.column) for f in fields]),
+            ', '.join([row] * len(values)), qn('entity_ct_id'),
+            qn('entity_id'), qn('attribute_id'),
+            ', '.join(['%s = excluded.%s' % (qn(c), qn(c)) for c in updated]))
+        return sql, params
+
+    def _get_or_insert_entity_value(self, value, retry=True):
+        try:
+            existing = self.using(self.db).get(entity_ct=value.entity_ct_id,
+                                               entity_id=value.entity_id,
+                                               attribute=value.attribute_id)
+        except self.model.DoesNotExist:
+            sid = transaction.savepoint(using=self.db)
+            try:
+                value.save(force_insert=True, using=self.db)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=self.db)
+                if not retry:
+                    raise
+                return self._get_or_insert_entity_value(value, retry=False)
+            transaction.savepoint_commit(sid, using=self.db)
+            return value
+        value.pk = existing.pk
+        if hasattr(existing, 'created'):
+            value.created = existing.created
+        value.save(force_update=True, using=self.db)
+        return value
+
+    def delete_entity_values(self, ct, entity_id, attribute_ids):
+        '''
+        Deletes the values of the entity identified by *ct* and *entity_id*
+        for all of *attribute_ids* with one ``DELETE`` statement.
+
+        .. note::
+           Like ``QuerySet.update()``, this doesn't send any signals.
+        '''
+        if not attribute_ids:
+            return
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        sql = 'DELETE FROM %s WHERE %s = %%s AND %s = %%s AND %s IN (%s)' % (
+            qn(self.model._meta.db_table), qn('entity_ct_id'),
+            qn('entity_id'), qn('attribute_id'),
+            ', '.join(['%s'] * len(attribute_ids)))
+        connection.cursor().execute(sql, [ct.pk, entity_id] + \
+                                         list(attribute_ids))
+        transaction.commit_unless_managed(using=self.db)
+
+
+class BaseValue(models.Model):
+    '''
+    The behaviour shared by :class:`Value` and the :class:`TypedValue`
+    models: validation, and the *value* property reading and writing the
+    field of the attribute's datatype.
+    '''
+
+    def save(self, *args, **kwargs):
+        '''
+        Validate and save this value
+        '''
+        # not full_clean(): the database enforces the unique entity and
+        # attribute, validate_unique() would cost a query per save.
+        self.clean_fields()
+        self.clean()
+        super(BaseValue, self).save(*args, **kwargs)
+
+    def clean(self):
+        '''
+        Raises ``ValidationError`` if this value's attribute is *TYPE_ENUM*
+        and value_enum is not a valid choice for this value's attribute.
+        '''
+        if self.attribute.datatype == Attribute.TYPE_ENUM and \
+           self.value_enum_id:
+            enum_ids = schema.get_enum_ids(self.attribute.enum_group_id)
+            if self.value_enum_id not in enum_ids:
+                raise ValidationError(_(u"%(choice)s is not a valid " \
+                                        u"choice for %(attribute)s") % \
+                                        {'choice': self.value_enum,
+                                         'attribute': self.attribute})
+
+    def _get_value(self):
+        '''
+        Return the python object this value is holding
+        '''
+        return getattr(self, 'value_%s' % self.attribute.datatype)
+
+    def _set_value(self, new_value):
+        '''
+        Set the object this value is holding
+        '''
+        setattr(self, 'value_%s' % self.attribute.datatype, new_value)
+
+    value = property(_get_value, _set_value)
+
+    def _value_fields(self):
+        '''
+        Return the concrete model fields that hold this value, given its
+        attribute's datatype.
+        '''
+        if self.attribute.datatype == Attribute.TYPE_OBJECT:
+            names = ('generic_value_id', 'generic_value_ct')
+        else:
+            names = ('value_%s' % self.attribute.datatype,)
+        return [self._meta.get_field(name) for name in names]
+
+    def __unicode__(self):
+        return u"%s - %s: \"%s\"" % (self.entity, self.attribute.name,
+                                     self.value)
+
+    class Meta:
+        abstract = True
+
+
+class Value(BaseValue):
     '''
     Putting the **V** in *EAV*. This model stores the value for one particular
     :class:`Attribute` for some entity.
@@ -405,47 +737,168 @@ class Value(models.Model):
     attribute = models.ForeignKey(Attribute, db_index=True,
                                   verbose_name=_(u"attribute"))
 
-    def save(self, *args, **kwargs):
-        '''
-        Validate and save this value
-        '''
-        self.full_clean()
-        super(Value, self).save(*args, **kwargs)
+    objects = ValueManager()
 
-    def clean(self):
-        '''
-        Raises ``ValidationError`` if this value's attribute is *TYPE_ENUM*
-        and value_enum is not a valid choice for this value's attribute.
-        '''
-        if self.attribute.datatype == Attribute.TYPE_ENUM and \
-           self.value_enum:
-            if self.value_enum not in self.attribute.enum_group.enums.all():
-                raise ValidationError(_(u"%(choice)s is not a valid " \
-                                        u"choice for %s(attribute)") % \
-                                        {'choice': self.value_enum,
-                                         'attribute': self.attribute})
+    class Meta:
+        unique_together = ('entity_ct', 'entity_id', 'attribute')
+        verbose_name = _(u'value')
+        verbose_name_plural = _(u'values')
 
-    def _get_value(self):
-        '''
-        Return the python object this value is holding
-        '''
-        return getattr(self, 'value_%s' % self.attribute.datatype)
 
-    def _set_value(self, new_value):
-        '''
-        Set the object this value is holding
-        '''
-        setattr(self, 'value_%s' % self.attribute.datatype, new_value)
+class TypedValue(BaseValue):
+    '''
+    The abstract base of the narrow value models, which store the values of
+    entities registered with :attr:`~eav.registry.EavConfig.typed_values`
+    instead of :class:`Value`. Each one holds the values of a single
+    datatype, in a field named like the matching :class:`Value` field, and
+    has no timestamps, so its rows and indexes stay small.
+
+    Use :func:`get_value_model` to get the model storing an attribute's
+    values. Existing values are moved from :class:`Value` to these models,
+    or back, in batches by the ``migrate_eav_values`` management command.
+    '''
 
-    value = property(_get_value, _set_value)
+    entity_ct = models.ForeignKey(ContentType,
+                                  related_name='%(class)s_entities')
+    entity_id = models.IntegerField()
+    attribute = models.ForeignKey(Attribute, verbose_name=_(u"attribute"))
 
-    def __unicode__(self):
-        return u"%s - %s: \"%s\"" % (self.entity, self.attribute.name,
-                                     self.value)
+    objects = ValueManager()
+
+    @property
+    def entity(self):
+        return self.entity_ct.get_object_for_this_type(pk=self.entity_id)
 
     class Meta:
-        verbose_name = _(u'value')
-        verbose_name_plural = _(u'values')
+        abstract = True
+        unique_together = ('entity_ct', 'entity_id', 'attribute')
+
+
+class ValueText(TypedValue):
+    value_text = models.TextField()
+
+    class Meta(TypedValue.Meta):
+        db_table = 'eav_value_text'
+
+
+class ValueFloat(TypedValue):
+    value_float = models.FloatField()
+
+    class Meta(TypedValue.Meta):
+        db_table = 'eav_value_float'
+
+
+class ValueInt(TypedValue):
+    value_int = models.IntegerField()
+
+    class Meta(TypedValue.Meta):
+        db_table = 'eav_value_int'
+
+
+class ValueDate(TypedValue):
+    value_date = models.DateTimeField()
+
+    class Meta(TypedValue.Meta):
+        db_table = 'eav_value_date'
+
+
+class ValueBool(TypedValue):
+    value_bool = models.BooleanField()
+
+    class Meta(TypedValue.Meta):
+        db_table = 'eav_value_bool'
+
+
+class ValueEnum(TypedValue):
+    value_enum = models.ForeignKey(EnumValue, related_name='typed_values')
+
+    class Meta(TypedValue.Meta):
+        db_table = 'eav_value_enum'
+
+
+class ValueObject(TypedValue):
+    generic_value_id = models.IntegerField()
+    generic_value_ct = models.ForeignKey(ContentType,
+                                         related_name='typed_values')
+    value_object = generic.GenericForeignKey(ct_field='generic_value_ct',
+                                             fk_field='generic_value_id')
+
+    class Meta(TypedValue.Meta):
+        db_table = 'eav_value_object'
+
+
+class ValueDocument(models.Model):
+    '''
+    The values of one entity, as a JSON object in *data*, for the entities
+    registered with the :class:`~eav.storage.JsonStorage` backend. The
+    ``migrate_eav_values`` management command moves values into them, or
+    back, when a model switches backends.
+    '''
+
+    entity_ct = models.ForeignKey(ContentType,
+                                  related_name='value_documents')
+    entity_id = models.IntegerField()
+    data = models.TextField(default='{}')
+
+    @property
+    def entity(self):
+        return self.entity_ct.get_object_for_this_type(pk=self.entity_id)
+
+    class Meta:
+        db_table = 'eav_value_document'
+        unique_together = ('entity_ct', 'entity_id')
+
+
+#: The :class:`TypedValue` model of each :class:`Attribute` datatype.
+TYPED_VALUE_MODELS = {
+    Attribute.TYPE_TEXT: ValueText,
+    Attribute.TYPE_FLOAT: ValueFloat,
+    Attribute.TYPE_INT: ValueInt,
+    Attribute.TYPE_DATE: ValueDate,
+    Attribute.TYPE_BOOLEAN: ValueBool,
+    Attribute.TYPE_ENUM: ValueEnum,
+    Attribute.TYPE_OBJECT: ValueObject,
+}
+
+
+def get_value_model(model_cls, datatype):
+    '''
+    Returns the model storing the values of *datatype* for the entities of
+    *model_cls*: the datatype's :class:`TypedValue` model if *model_cls* is
+    registered with :attr:`~eav.registry.EavConfig.typed_values`,
+    :class:`Value` otherwise.
+    '''
+    if uses_typed_values(model_cls):
+        return TYPED_VALUE_MODELS[datatype]
+    return Value
+
+
+def uses_typed_values(model_cls):
+    '''
+    Returns whether the values of *model_cls*'s entities are stored in the
+    :class:`TypedValue` models.
+    '''
+    config_cls = getattr(model_cls, '_eav_config_cls', None)
+    return bool(config_cls and config_cls.typed_values)
+
+
+def get_value_models(model_cls, attributes):
+    '''
+    Returns the list of models storing the values of *attributes* for the
+    entities of *model_cls*, without duplicates.
+    '''
+    value_models = []
+    for attribute in attributes:
+        value_model = get_value_model(model_cls, attribute.datatype)
+        if value_model not in value_models:
+            value_models.append(value_model)
+    return value_models
+
+
+#: The largest number of entity ids put in the ``IN`` clause of one query
+#: by :meth:`Entity.prefetch_values`.
+PREFETCH_BATCH_SIZE = 500
+
 
 class Entity(object):
     '''
@@ -460,6 +913,28 @@ class Entity(object):
         '''
         self.model = instance
         self.ct = ContentType.objects.get_for_model(instance)
+        self._changes = {}
+
+    def __setattr__(self, name, value):
+        '''
+        Setting any public name other than *model* or *ct* sets the EAV
+        attribute with that slug. The new value is recorded in the change
+        set written by the next :meth:`save`.
+        '''
+        if name.startswith('_') or name in ('model', 'ct'):
+            super(Entity, self).__setattr__(name, value)
+        else:
+            self._changes[name] = value
+
+    def __delattr__(self, name):
+        '''
+        Deleting an EAV attribute is the same as setting it to None: its
+        :class:`Value` will be deleted by the next :meth:`save`.
+        '''
+        if name.startswith('_') or name in ('model', 'ct'):
+            super(Entity, self).__delattr__(name)
+        else:
+            self._changes[name] = None
 
     def __getattr__(self, name):
         '''
@@ -471,42 +946,177 @@ class Entity(object):
         attribute slug. If there is one, it returns the value of the
         class:`Value` object, otherwise it hasn't been set, so it returns
         None.
+
+        All of this entity's :class:`Value` objects are loaded with a single
+        query the first time any of them is needed; see
+        :meth:`get_value_cache`.
         '''
         if not name.startswith('_'):
+            if name in self._changes:
+                return self._changes[name]
+            value = self.get_value_cache([name]).get(name)
+            if value is not None:
+                return value.value
             try:
                 attribute = self.get_attribute_by_slug(name)
             except Attribute.DoesNotExist:
                 raise AttributeError(_(u"%(obj)s has no EAV attribute named " \
                                        u"'%(attr)s'") % \
                                      {'obj': self.model, 'attr': name})
-            try:
-                return self.get_value_by_attribute(attribute).value
-            except Value.DoesNotExist:
-                return None
+            return None
         return getattr(super(Entity, self), name)
 
     def get_all_attributes(self):
         '''
-        Return a query set of all :class:`Attribute` objects that can be set
+        Return a list of all :class:`Attribute` objects that can be set
         for this entity.
+
+        If the entity has an :class:`AttributeSet` (see
+        :meth:`~eav.registry.EavConfig.get_attribute_set`), only the
+        attributes of that set are returned. The list is kept until the
+        :data:`~eav.schema.schema` or the entity's set changes.
         '''
-        # cache result
-        if not hasattr(self, '_attributes_qs'):
-            self._attributes_qs = self.model._eav_config_cls.get_attributes(
-                                                            entity=self.model)
-        return self._attributes_qs
+        config_cls = self.model._eav_config_cls
+        version = (schema.version, config_cls.get_attribute_set(self.model))
+        if getattr(self, '_attributes_version', None) != version:
+            attributes = config_cls.get_attribute_list(entity=self.model)
+            self._attributes = attributes
+            self._attributes_by_slug = dict((a.slug, a) for a in attributes)
+            self._attributes_version = version
+        return self._attributes
 
     def get_attributes_and_values(self):
-        return dict( (v.attribute.slug, v.value) for v in self.get_values() )
+        return dict((slug, v.value) for slug, v in \
+                    self.get_value_cache().iteritems())
+
+    def get_value_cache(self, slugs=None):
+        '''
+        Returns a dict mapping attribute slugs to the :class:`Value` objects
+        set for self.model.
+
+        The values are fetched with one query the first time this is called
+        and kept until :meth:`refresh` is called. :meth:`save` keeps the
+        cache in sync with what it writes.
+
+        If the cache was filled for only some slugs (see
+        :meth:`prefetch_values`), pass the *slugs* you need: the cache is
+        only reloaded if it doesn't cover all of them.
+        '''
+        if hasattr(self, '_value_cache'):
+            loaded = self._value_cache_slugs
+            if loaded is None or (slugs is not None and loaded.issuperset(slugs)):
+                return self._value_cache
+        if self.model.pk is None:
+            return {}
+        if get_value_cache(self.model.__class__) is not None:
+            Entity.prefetch_values([self])
+        else:
+            self._set_value_cache(self.get_values())
+        return self._value_cache
+
+    def _set_value_cache(self, values, slugs=None):
+        '''
+        Fill the value cache with *values*, which hold all of the values of
+        self.model for *slugs*, or all of them if *slugs* is None.
+        '''
+        self._value_cache = dict((v.attribute.slug, v) for v in values)
+        self._value_cache_slugs = None if slugs is None else frozenset(slugs)
+
+    @staticmethod
+    def prefetch_values(entities, slugs=None):
+        '''
+        Fill the value caches of all of *entities*, which must be attached to
+        instances of the same model, with one query for all of them.
+
+        If *slugs* is given only the values of those attributes are loaded.
+
+        If the model has a :class:`~eav.value_cache.ValueCache`, all the
+        values are read from it, and those of the entities it doesn't have
+        are loaded and cached.
+        '''
+        entities = [e for e in entities if e.model.pk is not None]
+        if not entities:
+            return
+        value_cache = get_value_cache(entities[0].model.__class__)
+        if value_cache is not None:
+            cached, keys = value_cache.get_many([e.model.pk \
+                                                 for e in entities])
+            for entity in entities:
+                if entity.model.pk in cached:
+                    entity._set_value_cache(cached[entity.model.pk])
+            entities = [e for e in entities if e.model.pk in keys]
+            if not entities:
+                return
+            slugs = None
+        by_entity = entities[0]._storage.prefetch_values(entities, slugs)
+        if value_cache is not None:
+            value_cache.set_many(keys, by_entity)
+        for entity in entities:
+            entity._set_value_cache(by_entity[entity.model.pk], slugs)
+
+    def refresh(self):
+        '''
+        Discards the cached :class:`Value` objects and any unsaved changes,
+        so that values will be loaded from the database again on the next
+        attribute access.
+        '''
+        self._clear_value_cache()
+        self._changes = {}
+
+    def _clear_value_cache(self):
+        if hasattr(self, '_value_cache'):
+            del self._value_cache
+            del self._value_cache_slugs
+
+    def get_changed_slugs(self):
+        '''
+        Returns the slugs of the EAV attributes that have been set or deleted
+        since the values were last loaded or saved.
+        '''
+        return self._changes.keys()
 
     def save(self):
         '''
-        Saves all the EAV values that have been set on this entity.
+        Saves the EAV values that have been set or deleted on this entity
+        since the last load or save.
+
+        Only the changed attributes are written, by the storage backend
+        (see :meth:`~eav.storage.BaseStorage.save_values`).
         '''
-        for attribute in self.get_all_attributes():
-            if hasattr(self, attribute.slug):
-                attribute_value = getattr(self, attribute.slug)
-                attribute.save_value(self.model, attribute_value)
+        if not self._changes:
+            return
+        changes = self._pop_changes()
+        cache = self.get_value_cache([a.slug for a, v in changes])
+        if not self._storage.save_values(self, changes, cache):
+            # the storage couldn't keep the cached values complete, so
+            # reload them on next access.
+            self._clear_value_cache()
+
+        value_cache = get_value_cache(self.model.__class__)
+        if value_cache is not None:
+            if getattr(self, '_value_cache_slugs', True) is None:
+                value_cache.store(self.model.pk,
+                                  self._value_cache.values())
+            else:
+                value_cache.invalidate(self.model.pk)
+
+        flat_table = get_flat_table(self.model.__class__)
+        if flat_table is not None:
+            flat_table.set_values(self.model.pk, changes)
+
+    def _pop_changes(self):
+        '''
+        Removes the changes to attributes that apply to this entity from the
+        change set, and returns them as a list of (attribute, value) pairs.
+        Changes to other names are left alone.
+        '''
+        self.get_all_attributes()
+        changes = []
+        for slug in self._changes.keys():
+            attribute = self._attributes_by_slug.get(slug)
+            if attribute is not None:
+                changes.append((attribute, self._changes.pop(slug)))
+        return changes
 
     def validate_attributes(self):
         '''
@@ -532,32 +1142,44 @@ class Entity(object):
 
     def get_values(self):
         '''
-        Get all set :class:`Value` objects for self.model
+        Get all set :class:`Value` objects for self.model, from the storage
+        backend (see :meth:`~eav.storage.BaseStorage.get_values`).
+        '''
+        return self._storage.get_values(self)
+
+    @property
+    def _storage(self):
         '''
-        return Value.objects.filter(entity_ct=self.ct,
-                                    entity_id=self.model.pk).select_related()
+        The :class:`~eav.storage.BaseStorage` of self.model's class.
+        '''
+        return get_storage(self.model.__class__)
 
     def get_all_attribute_slugs(self):
         '''
         Returns a list of slugs for all attributes available to this entity.
         '''
-        # cache result
-        if not hasattr(self, '_attribute_slugs'):
-            self._attribute_slugs = self.get_all_attributes().values_list(
-                                                            'slug', flat=True)
-        return self._attribute_slugs
+        return [a.slug for a in self.get_all_attributes()]
 
     def get_attribute_by_slug(self, slug):
         '''
         Returns a single :class:`Attribute` with *slug*
         '''
-        return self.get_all_attributes().get(slug=slug)
+        self.get_all_attributes()
+        try:
+            return self._attributes_by_slug[slug]
+        except KeyError:
+            raise Attribute.DoesNotExist(u"No attribute with slug '%s'" % slug)
 
     def get_value_by_attribute(self, attribute):
         '''
         Returns a single :class:`Value` for *attribute*
+
+        Raises :class:`Value.DoesNotExist` if it hasn't been set.
         '''
-        return self.get_values().get(attribute=attribute)
+        value = self.get_value_cache().get(attribute.slug)
+        if value is None or value.attribute_id != attribute.pk:
+            raise Value.DoesNotExist
+        return value
 
     def __iter__(self):
         '''
@@ -567,7 +1189,7 @@ class Entity(object):
 
         >>> for i in m.eav: print i  # doctest: +SKIP
         '''
-        return iter(self.get_values())
+        return self.get_value_cache().itervalues()
 
     @staticmethod
     def post_save_handler(sender, *args, **kwargs):
@@ -579,6 +1201,20 @@ class Entity(object):
         entity = getattr(instance, instance._eav_config_cls.eav_attr)
         entity.save()
 
+    @staticmethod
+    def post_delete_handler(sender, *args, **kwargs):
+        '''
+        Post delete handler attached to self.model.  Deletes the values of
+        the deleted instance that its generic relation doesn't cascade to.
+        '''
+        instance = kwargs['instance']
+        get_storage(instance.__class__).delete_values(instance,
+                                using=kwargs.get('using', DEFAULT_DB_ALIAS))
+        value_cache = get_value_cache(instance.__class__)
+        if value_cache is not None:
+            value_cache.invalidate(instance.pk,
+                                   kwargs.get('using', DEFAULT_DB_ALIAS))
+
     @staticmethod
     def pre_save_handler(sender, *args, **kwargs):
         '''
@@ -590,6 +1226,23 @@ class Entity(object):
         entity = getattr(kwargs['instance'], instance._eav_config_cls.eav_attr)
         entity.validate_attributes()
 
+request_started.connect(schema.sync)
+request_finished.connect(schema.publish)
+request_finished.connect(publish_value_revisions)
+for value_model in [Value, ValueDocument] + TYPED_VALUE_MODELS.values():
+    post_delete.connect(value_delete_handler, sender=value_model)
+post_save.connect(schema.clear, sender=Attribute)
+post_delete.connect(schema.clear, sender=Attribute)
+post_delete.connect(attribute_delete_handler, sender=Attribute)
+post_save.connect(schema.clear, sender=EnumGroup)
+post_delete.connect(schema.clear, sender=EnumGroup)
+post_save.connect(schema.clear, sender=EnumValue)
+post_delete.connect(schema.clear, sender=EnumValue)
+m2m_changed.connect(schema.clear, sender=EnumGroup.enums.through)
+post_save.connect(schema.clear, sender=AttributeSet)
+post_delete.connect(schema.clear, sender=AttributeSet)
+m2m_changed.connect(schema.clear, sender=AttributeSet.attributes.through)
+
 if 'django_nose' in settings.INSTALLED_APPS:
     '''
     The django_nose test runner won't automatically create our Patient model
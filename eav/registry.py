@@ -27,12 +27,14 @@ Classes
 -------
 '''
 
-from django.db.models.signals import post_init, pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 
-from .managers import EntityManager
+from .managers import EntityManager, filter_plans
 from .models import Entity, Attribute, Value
+from .schema import schema
+from . import flat
 
 
 class EavConfig(object):
@@ -47,6 +49,12 @@ class EavConfig(object):
     generic_relation_attr = 'eav_values'
     generic_relation_related_name = None
     parent = None
+    flat_table = False
+    typed_values = False
+    storage_class = None
+    attribute_set_field = None
+    value_cache = False
+    value_cache_timeout = 300
 
     @classmethod
     def get_attributes(cls, entity=None):
@@ -60,6 +68,65 @@ class EavConfig(object):
             qs = qs.filter(parent__in=(ctype, None))
         return qs
 
+    @classmethod
+    def get_attribute_list(cls, entity=None):
+        '''
+        Returns the :class:`~eav.models.Attribute` objects that apply to
+        *entity* as a list.
+
+        Unless :meth:`get_attributes` is overridden, they are read from the
+        process-wide :data:`~eav.schema.schema` cache, without any query,
+        and restricted to the attribute set of *entity* if it has one (see
+        :meth:`get_attribute_set`).
+        '''
+        if cls.get_attributes.im_func is not EavConfig.get_attributes.im_func:
+            return list(cls.get_attributes(entity=entity))
+        attribute_set = None
+        if entity is not None:
+            attribute_set = cls.get_attribute_set(entity)
+        return schema.get_attributes(cls.parent, attribute_set)
+
+    @classmethod
+    def get_attribute_set(cls, entity):
+        '''
+        Returns the slug or primary key of the
+        :class:`~eav.models.AttributeSet` of *entity*, or None if all
+        attributes apply to it.
+
+        By default, it is read from the field of *entity* named by
+        *attribute_set_field*: either a ``ForeignKey`` to
+        :class:`~eav.models.AttributeSet`, or a discriminator field, such as
+        a product line, whose value is the slug of the set. Entities
+        without a value in that field, or models without such a field, get
+        all the attributes.
+        '''
+        if not cls.attribute_set_field:
+            return None
+        field = entity._meta.get_field(cls.attribute_set_field)
+        # read the key of a ForeignKey, without fetching the set
+        return getattr(entity, field.attname) or None
+
+
+class EntityDescriptor(object):
+    '''
+    Installed on registered models as their *eav_attr*. The
+    :class:`~eav.models.Entity` of an instance is created the first time
+    it is accessed, and is then stored in the instance's ``__dict__``, which
+    takes precedence over this (non-data) descriptor from then on. Instances
+    that never use their eav attributes cost nothing extra.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        entity = Entity(instance)
+        instance.__dict__[self.name] = entity
+        return entity
+
+
 class Registry(object):
     '''
     Handles registration through the
@@ -90,6 +157,7 @@ class Registry(object):
 
         reg = Registry(model_cls)
         reg._register_self()
+        filter_plans.clear()
 
     @staticmethod
     def unregister(model_cls):
@@ -105,15 +173,7 @@ class Registry(object):
         reg._unregister_self()
 
         delattr(model_cls, '_eav_config_cls')
-
-    @staticmethod
-    def attach_eav_attr(sender, *args, **kwargs):
-        '''
-        Attache EAV Entity toolkit to an instance after init.
-        '''
-        instance = kwargs['instance']
-        config_cls = instance.__class__._eav_config_cls
-        setattr(instance, config_cls.eav_attr, Entity(instance))
+        filter_plans.clear()
 
     def __init__(self, model_cls):
         '''
@@ -149,17 +209,34 @@ class Registry(object):
         '''
         Attach all signals for eav
         '''
-        post_init.connect(Registry.attach_eav_attr, sender=self.model_cls)
         pre_save.connect(Entity.pre_save_handler, sender=self.model_cls)
         post_save.connect(Entity.post_save_handler, sender=self.model_cls)
+        if self.config_cls.flat_table:
+            post_delete.connect(flat.delete_handler, sender=self.model_cls)
+        post_delete.connect(Entity.post_delete_handler, sender=self.model_cls)
 
     def _detach_signals(self):
         '''
         Detach all signals for eav
         '''
-        post_init.disconnect(Registry.attach_eav_attr, sender=self.model_cls)
         pre_save.disconnect(Entity.pre_save_handler, sender=self.model_cls)
         post_save.disconnect(Entity.post_save_handler, sender=self.model_cls)
+        post_delete.disconnect(flat.delete_handler, sender=self.model_cls)
+        post_delete.disconnect(Entity.post_delete_handler,
+                               sender=self.model_cls)
+
+    def _attach_entity(self):
+        '''
+        Install the :class:`EntityDescriptor` on *eav_attr*
+        '''
+        setattr(self.model_cls, self.config_cls.eav_attr,
+                EntityDescriptor(self.config_cls.eav_attr))
+
+    def _detach_entity(self):
+        '''
+        Remove the :class:`EntityDescriptor`
+        '''
+        delattr(self.model_cls, self.config_cls.eav_attr)
 
     def _attach_generic_relation(self):
         '''
@@ -195,6 +272,7 @@ class Registry(object):
         self._attach_manager()
 
         if not self.config_cls.manager_only:
+            self._attach_entity()
             self._attach_signals()
             self._attach_generic_relation()
 
@@ -205,5 +283,6 @@ class Registry(object):
         self._detach_manager()
 
         if not self.config_cls.manager_only:
+            self._detach_entity()
             self._detach_signals()
             self._detach_generic_relation()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+#
+#    This software is derived from EAV-Django originally written and
+#    copyrighted by Andrey Mikhaylenko <http://pypi.python.org/pypi/eav-django>
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+'''
+######
+schema
+######
+
+This module holds the process-wide cache of
+:class:`~eav.models.Attribute` objects, so that looking up attributes by
+slug or listing the attributes of an entity doesn't query the database.
+
+It also caches the choices of each :class:`~eav.models.EnumGroup`, so that
+validating an enum value is a set lookup, and the attributes of each
+:class:`~eav.models.AttributeSet`.
+
+The cache is loaded with one query the first time it is used, and is
+cleared whenever an :class:`~eav.models.Attribute`,
+:class:`~eav.models.AttributeSet`, :class:`~eav.models.EnumGroup` or
+:class:`~eav.models.EnumValue` is saved or deleted, or the choices of an
+:class:`~eav.models.EnumGroup` or the attributes of an
+:class:`~eav.models.AttributeSet` change (see the signal handlers connected
+at the bottom of :mod:`eav.models`).
+
+Each process has its own cache, so a change made by one process is also
+recorded by incrementing a version number shared through the default
+Django cache. Every process compares it with the version its cache was
+loaded at when a request starts, and at most every
+``EAV_SCHEMA_CHECK_INTERVAL`` seconds (60 by default, None to disable) when
+the cache is used, and reloads its cache only if the shared version
+changed. This needs a cache backend shared by the processes, such as
+memcached, or the database or file based backends.
+
+A change made inside a transaction increments the shared version before it
+is committed, so a process syncing in between would reload the old rows at
+the new version. The version is therefore incremented again once the
+transaction has ended: by :meth:`AttributeSchema.publish`, which is called
+when the request finishes and whenever the cache is used or synced by the
+same thread. Code making schema changes in a transaction outside of a
+request, like a management command, should call it after committing. As a
+last resort, every process also reloads its cache at most every
+``EAV_SCHEMA_MAX_AGE`` seconds (3600 by default, None to disable).
+
+Settings:
+
+* ``EAV_SCHEMA_CHECK_INTERVAL``, ``EAV_SCHEMA_MAX_AGE``: see above.
+* ``EAV_SCHEMA_VERSION_KEY``: the cache key of the shared version,
+  ``'eav_schema_version'`` by default.
+
+Classes
+-------
+'''
+
+from time import time
+from threading import local
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.contrib.contenttypes.models import ContentType
+
+#: How long the shared version is kept in the cache, in seconds: 30 days,
+#: the longest memcached accepts.
+SHARED_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+class SchemaSnapshot(object):
+    '''
+    An immutable view of all :class:`~eav.models.Attribute` objects, indexed
+    by (site, parent ContentType, slug) and by primary key.
+    '''
+
+    def __init__(self, attributes):
+        self.attributes = list(attributes)
+        self.by_pk = dict((a.pk, a) for a in self.attributes)
+        self.by_key = dict(((a.site_id, a.parent_id, a.slug), a) \
+                           for a in self.attributes)
+        self._lists = {}
+
+    def get_attributes(self, site_id, parent_id=None):
+        '''
+        Returns the attributes of site *site_id* that apply to entities of
+        the ContentType *parent_id*: the ones with that parent and the ones
+        without a parent. If *parent_id* is None, all attributes of the site
+        are returned.
+        '''
+        key = (site_id, parent_id)
+        if key not in self._lists:
+            self._lists[key] = [a for a in self.attributes \
+                                if a.site_id == site_id and \
+                                (parent_id is None or \
+                                 a.parent_id in (parent_id, None))]
+        return self._lists[key]
+
+    def get_attribute(self, slug, site_id, parent_id=None):
+        '''
+        Returns the attribute with *slug* on site *site_id*, preferring one
+        whose parent is *parent_id* over one without a parent. Returns None
+        if there is no such attribute.
+        '''
+        if parent_id is not None:
+            attribute = self.by_key.get((site_id, parent_id, slug))
+            if attribute is not None:
+                return attribute
+        attribute = self.by_key.get((site_id, None, slug))
+        if attribute is not None or parent_id is not None:
+            return attribute
+        for attribute in self.get_attributes(site_id):
+            if attribute.slug == slug:
+                return attribute
+        return None
+
+
+class AttributeSchema(object):
+    '''
+    The process-wide attribute cache. Use the :data:`schema` instance.
+
+    *version* is incremented every time the cache is cleared, so that other
+    caches derived from the schema can tell when to rebuild themselves.
+    *shared_version* is the cross-process version the cache was loaded at.
+    '''
+
+    def __init__(self):
+        self._snapshot = None
+        self._enums = {}
+        self._sets = None
+        self.version = 0
+        self.shared_version = None
+        self._checked = time()
+        self._loaded = None
+        self._pending = local()
+
+    def clear(self, *args, **kwargs):
+        '''
+        Discards the cached attributes and enum choices, and increments the
+        shared version so that the other processes discard theirs. It can
+        be connected directly to model signals.
+
+        If the database *using* is in a transaction, the shared version is
+        incremented again by :meth:`publish` once it has ended.
+        '''
+        self._clear_local(self._increment_shared_version())
+        using = kwargs.get('using') or DEFAULT_DB_ALIAS
+        if transaction.is_managed(using=using):
+            if not hasattr(self._pending, 'using'):
+                self._pending.using = set()
+            self._pending.using.add(using)
+
+    def publish(self, *args, **kwargs):
+        '''
+        Discards the cache and increments the shared version again if this
+        thread cleared it inside transactions that have all ended since, so
+        that the processes that reloaded before they were committed (or
+        rolled back) reload again. It is connected to the
+        ``request_finished`` signal, and can be connected to other signals.
+        '''
+        using = getattr(self._pending, 'using', None)
+        if using and not any(transaction.is_managed(using=alias) \
+                             for alias in using):
+            del self._pending.using
+            self._clear_local(self._increment_shared_version())
+
+    def _clear_local(self, shared_version):
+        self._snapshot = None
+        self._loaded = None
+        self._enums = {}
+        self._sets = None
+        self.version += 1
+        self.shared_version = shared_version
+
+    def _get_version_key(self):
+        return getattr(settings, 'EAV_SCHEMA_VERSION_KEY',
+                       'eav_schema_version')
+
+    def get_shared_version(self):
+        '''
+        Returns the shared version from the cache, setting it to a new
+        value if it isn't there (or was evicted).
+        '''
+        key = self._get_version_key()
+        version = cache.get(key)
+        if version is None:
+            # a fresh value, unlike any that was in the cache before
+            cache.add(key, int(time() * 1000), SHARED_VERSION_TIMEOUT)
+            version = cache.get(key)
+        return version
+
+    def _increment_shared_version(self):
+        key = self._get_version_key()
+        try:
+            return cache.incr(key)
+        except ValueError:
+            self.get_shared_version()
+            try:
+                return cache.incr(key)
+            except ValueError:
+                # the cache doesn't keep anything, e.g. the dummy backend
+                return None
+
+    def sync(self, *args, **kwargs):
+        '''
+        Discards the cache if another process changed the schema since it
+        was loaded, i.e. if the shared version changed, or if it is older
+        than ``EAV_SCHEMA_MAX_AGE`` seconds. This costs one cache read. It
+        is connected to the ``request_started`` signal, and can be
+        connected to other signals.
+        '''
+        self.publish()
+        self._checked = time()
+        shared_version = self.get_shared_version()
+        max_age = getattr(settings, 'EAV_SCHEMA_MAX_AGE', 3600)
+        if shared_version != self.shared_version or \
+           (max_age is not None and self._loaded is not None and \
+            time() - self._loaded >= max_age):
+            self._clear_local(shared_version)
+
+    def _check(self):
+        '''
+        Calls :meth:`publish`, and :meth:`sync` if it wasn't in the last
+        ``EAV_SCHEMA_CHECK_INTERVAL`` seconds.
+        '''
+        self.publish()
+        interval = getattr(settings, 'EAV_SCHEMA_CHECK_INTERVAL', 60)
+        if interval is not None and time() - self._checked >= interval:
+            self.sync()
+
+    def get_snapshot(self):
+        '''
+        Returns the current :class:`SchemaSnapshot`, loading it if needed.
+        '''
+        self._check()
+        snapshot = self._snapshot
+        if snapshot is None:
+            if self.shared_version is None:
+                self.shared_version = self.get_shared_version()
+            from .models import Attribute
+            snapshot = SchemaSnapshot(Attribute.objects \
+                                      .select_related('enum_group'))
+            self._snapshot = snapshot
+            self._loaded = time()
+        return snapshot
+
+    def get_attributes(self, model_cls=None, attribute_set=None):
+        '''
+        Returns a list of the current site's attributes that apply to
+        *model_cls*, or all of the site's attributes if *model_cls* is None.
+
+        If *attribute_set*, the slug or primary key of an
+        :class:`~eav.models.AttributeSet`, is given, only the attributes of
+        that set are returned, and none if there is no such set.
+        '''
+        parent_id = None
+        if model_cls is not None:
+            parent_id = ContentType.objects.get_for_model(model_cls).pk
+        snapshot = self.get_snapshot()
+        attributes = snapshot.get_attributes(settings.SITE_ID, parent_id)
+        if attribute_set is None:
+            return attributes
+        key = (settings.SITE_ID, parent_id, attribute_set)
+        if key not in snapshot._lists:
+            ids = self._get_sets().get(attribute_set, frozenset())
+            snapshot._lists[key] = [a for a in attributes if a.pk in ids]
+        return snapshot._lists[key]
+
+    def _get_sets(self):
+        '''
+        Returns a dict mapping the slug and the primary key of each
+        :class:`~eav.models.AttributeSet` to the frozenset of the primary
+        keys of its attributes, loaded with one query.
+        '''
+        sets = self._sets
+        if sets is None:
+            from .models import AttributeSet
+            members = {}
+            for pk, slug, attribute_id in AttributeSet.objects.values_list(
+                                            'pk', 'slug', 'attributes'):
+                ids = members.setdefault((pk, slug), set())
+                if attribute_id is not None:
+                    ids.add(attribute_id)
+            sets = {}
+            for (pk, slug), ids in members.iteritems():
+                sets[pk] = sets[slug] = frozenset(ids)
+            self._sets = sets
+        return sets
+
+    def get_attribute(self, slug, model_cls=None):
+        '''
+        Returns the current site's attribute with *slug*, preferring one
+        restricted to *model_cls* if there is one.
+
+        Raises :class:`~eav.models.Attribute.DoesNotExist` if there isn't
+        any.
+        '''
+        parent_id = None
+        if model_cls is not None:
+            parent_id = ContentType.objects.get_for_model(model_cls).pk
+        attribute = self.get_snapshot().get_attribute(slug, settings.SITE_ID,
+                                                      parent_id)
+        if attribute is None:
+            from .models import Attribute
+            raise Attribute.DoesNotExist(u"No attribute with slug '%s'" % slug)
+        return attribute
+
+    def get_attribute_by_pk(self, pk):
+        '''
+        Returns the attribute with primary key *pk*, or None.
+        '''
+        return self.get_snapshot().by_pk.get(pk)
+
+    def _get_enums(self, enum_group_id):
+        self._check()
+        enums = self._enums.get(enum_group_id)
+        if enums is None:
+            from .models import EnumValue
+            values = EnumValue.objects.filter(enumgroup=enum_group_id)
+            by_pk = dict((v.pk, v) for v in values)
+            by_value = dict((v.value, v) for v in by_pk.itervalues())
+            enums = (frozenset(by_pk), by_value, by_pk)
+            self._enums[enum_group_id] = enums
+        return enums
+
+    def get_enum_ids(self, enum_group_id):
+        '''
+        Returns a frozenset of the primary keys of the
+        :class:`~eav.models.EnumValue` objects in the
+        :class:`~eav.models.EnumGroup` *enum_group_id*.
+        '''
+        return self._get_enums(enum_group_id)[0]
+
+    def get_enum_values(self, enum_group_id):
+        '''
+        Returns a dict mapping the *value* strings of the
+        :class:`~eav.models.EnumValue` objects in the
+        :class:`~eav.models.EnumGroup` *enum_group_id* to those objects.
+        '''
+        return self._get_enums(enum_group_id)[1]
+
+    def get_enum(self, enum_group_id, pk):
+        '''
+        Returns the :class:`~eav.models.EnumValue` with primary key *pk* in
+        the :class:`~eav.models.EnumGroup` *enum_group_id*, or None if it
+        isn't one of its choices.
+        '''
+        return self._get_enums(enum_group_id)[2].get(pk)
+
+
+#: The process-wide :class:`AttributeSchema`
+schema = AttributeSchema()
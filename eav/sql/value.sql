@@ -0,0 +1,9 @@
+-- Composite indexes for finding the entities with a given value of an
+-- attribute. They are created by syncdb when South isn't used, and by
+-- migration 0003 otherwise. The values of an entity are loaded through the
+-- unique (entity_ct_id, entity_id, attribute_id) index.
+CREATE INDEX eav_value_attribute_int ON eav_value (attribute_id, value_int);
+CREATE INDEX eav_value_attribute_float ON eav_value (attribute_id, value_float);
+CREATE INDEX eav_value_attribute_date ON eav_value (attribute_id, value_date);
+CREATE INDEX eav_value_attribute_enum ON eav_value (attribute_id, value_enum_id);
+CREATE INDEX eav_value_attribute_bool ON eav_value (attribute_id, value_bool);
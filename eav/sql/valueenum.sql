@@ -0,0 +1,2 @@
+-- Index for finding the entities with a given value of an attribute.
+CREATE INDEX eav_value_enum_attribute_value ON eav_value_enum (attribute_id, value_enum_id);
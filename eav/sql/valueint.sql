@@ -0,0 +1,2 @@
+-- Index for finding the entities with a given value of an attribute.
+CREATE INDEX eav_value_int_attribute_value ON eav_value_int (attribute_id, value_int);
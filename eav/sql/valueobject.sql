@@ -0,0 +1,2 @@
+-- Index for finding the entities with a given value of an attribute.
+CREATE INDEX eav_value_object_attribute_value ON eav_value_object (attribute_id, generic_value_ct_id, generic_value_id);
@@ -0,0 +1,960 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+#
+#    This software is derived from EAV-Django originally written and
+#    copyrighted by Andrey Mikhaylenko <http://pypi.python.org/pypi/eav-django>
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+'''
+#######
+storage
+#######
+
+This module defines where the eav values of registered models are stored.
+Each registered model has a storage backend, an instance of a
+:class:`BaseStorage` subclass, which :class:`~eav.models.Entity`,
+:class:`~eav.models.Attribute`, :class:`~eav.managers.EntityManager` and
+:class:`~eav.managers.EntityQuerySet` go through to read, write and query
+values. It is chosen by :attr:`~eav.registry.EavConfig.storage_class`::
+
+    class PatientEavConfig(EavConfig):
+        storage_class = JsonStorage
+
+    eav.register(Patient, PatientEavConfig)
+
+Two backends are provided:
+
+* :class:`RowStorage`, the default, stores one row per value, in the
+  :class:`~eav.models.Value` table, or in the narrow
+  :class:`~eav.models.TypedValue` tables if
+  :attr:`~eav.registry.EavConfig.typed_values` is set.
+* :class:`JsonStorage` stores one JSON document per entity in the
+  :class:`~eav.models.ValueDocument` table, and queries it with the JSON
+  functions of SQLite (JSON1) or PostgreSQL (``jsonb``). Reading all the
+  values of an entity is one row fetch, and filters compile to predicates
+  on the extracted values.
+
+Either way, values are handed out as :class:`~eav.models.Value`-like
+objects, with *attribute* and *value* attributes.
+
+Classes and Functions
+---------------------
+'''
+
+from datetime import datetime, time
+
+from django.db import models, connections, transaction, IntegrityError, \
+                      DEFAULT_DB_ALIAS
+from django.db.models.sql.where import WhereNode, Constraint, AND
+from django.contrib.contenttypes.models import ContentType
+from django.utils import simplejson
+
+from .schema import schema
+
+
+def _bulk_batch_size(model_cls, objs, batch_size, using):
+    '''
+    Returns the number of *objs* of *model_cls* to insert per query: at most
+    *batch_size*, and no more than the database *using* accepts.
+    '''
+    fields = [f for f in model_cls._meta.local_fields \
+              if not isinstance(f, models.AutoField)]
+    limit = connections[using].ops.bulk_batch_size(fields, objs)
+    if connections[using].vendor == 'sqlite':
+        # SQLite inserts many rows as a compound SELECT, of at most 500 terms
+        limit = min(limit, 500)
+    return max(min(limit, batch_size or limit), 1)
+
+
+class BaseStorage(object):
+    '''
+    The interface of storage backends. A backend is created for each
+    registered model, *model_cls*; use :func:`get_storage` to get it.
+
+    Subclasses implement all the methods below. In their arguments,
+    *entity* is an :class:`~eav.models.Entity`, *instance* a model instance,
+    *changes* a list of (attribute, value) pairs, where None or ``''``
+    removes the value, and *pk_sql* and *pk_params* a query selecting
+    entity primary keys.
+    '''
+
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        self.config_cls = model_cls._eav_config_cls
+
+    @property
+    def ct(self):
+        return ContentType.objects.get_for_model(self.model_cls)
+
+    def get_values(self, entity):
+        '''
+        Returns all the values of *entity*.
+        '''
+        raise NotImplementedError
+
+    def prefetch_values(self, entities, slugs=None):
+        '''
+        Returns a dict mapping the primary key of each of *entities* to the
+        list of its values, of the attributes *slugs* only if given.
+        '''
+        raise NotImplementedError
+
+    def save_values(self, entity, changes, cache):
+        '''
+        Writes *changes* to *entity*, whose current values for the changed
+        attributes are in *cache*, a dict mapping slugs to values, and
+        updates *cache* to match. Returns False if the values in *cache*
+        are incomplete and should be reloaded.
+        '''
+        raise NotImplementedError
+
+    def create_values(self, entities, batch_size=None,
+                      using=DEFAULT_DB_ALIAS):
+        '''
+        Writes the pending changes of the newly created *entities* in bulk,
+        with at most *batch_size* rows per query, and returns them as a
+        list of (primary key, changes) pairs.
+        '''
+        raise NotImplementedError
+
+    def save_value(self, instance, attribute, value):
+        '''
+        Sets *attribute* to *value* on *instance*, and returns the saved
+        value, or None if it was removed.
+        '''
+        raise NotImplementedError
+
+    def update_values(self, attribute, value, pk_sql, pk_params,
+                      using=DEFAULT_DB_ALIAS):
+        '''
+        Sets *attribute* to *value* on all the entities selected by
+        *pk_sql*, and returns the number of affected entities.
+        '''
+        raise NotImplementedError
+
+    def delete_values(self, instance, using=DEFAULT_DB_ALIAS):
+        '''
+        Deletes the values of the deleted *instance*.
+        '''
+        raise NotImplementedError
+
+    def filter_value(self, attribute, lookup):
+        '''
+        Returns a function binding a value to the filter *lookup* (like
+        ``'gt'``, or ``''`` for ``'exact'``) on *attribute*, which returns a
+        ``pk__in`` filter value selecting the matching entities.
+        '''
+        raise NotImplementedError
+
+    def value_sql(self, attribute, entity_pk, connection):
+        '''
+        Returns the SQL and parameters of a correlated subquery selecting
+        the value of *attribute* for the entity whose primary key is the
+        SQL expression *entity_pk*. Enum values select the
+        :class:`~eav.models.EnumValue` primary key, object values the object
+        primary key.
+        '''
+        raise NotImplementedError
+
+    def pivot_sql(self, attributes, entity_pk, connection):
+        '''
+        Returns the ``LEFT OUTER JOIN`` clauses adding the values of
+        *attributes* to a query on entities, whose primary key is the SQL
+        expression *entity_pk* and which is grouped by it, with their
+        parameters, and the list of the aggregate columns selecting the
+        value of each attribute, as (SQL, parameters) pairs. Booleans are
+        selected as 1 or 0, enums and objects as in :meth:`value_sql`.
+        '''
+        raise NotImplementedError
+
+    def entity_ids_sql(self, connection):
+        '''
+        Returns the SQL and parameters of a query selecting, once each, the
+        primary keys of the entities that have values.
+        '''
+        raise NotImplementedError
+
+    def count_values(self, attribute, pks, bounds=None,
+                     using=DEFAULT_DB_ALIAS):
+        '''
+        Returns a list of (value, count) pairs counting the entities whose
+        primary keys are in the QuerySet *pks* by value of *attribute*, as
+        in :meth:`value_sql`. If *bounds* is given, values are counted by
+        the index of the first bound they are lower than, or
+        ``len(bounds)``.
+        '''
+        raise NotImplementedError
+
+
+class RowStorage(BaseStorage):
+    '''
+    The default storage, with a row per value in the
+    :class:`~eav.models.Value` table, or in the
+    :class:`~eav.models.TypedValue` tables (see
+    :func:`~eav.models.get_value_model`).
+    '''
+
+    def get_value_model(self, attribute):
+        from .models import get_value_model
+        return get_value_model(self.model_cls, attribute.datatype)
+
+    def _get_querysets(self, entity, slugs=None):
+        '''
+        Returns a QuerySet of the values of this model's entities for each
+        model storing them, restricted to the attributes *slugs* if given.
+        '''
+        from .models import Value, get_value_models, uses_typed_values
+        if uses_typed_values(self.model_cls):
+            attributes = entity.get_all_attributes()
+            if slugs is not None:
+                attributes = [a for a in attributes if a.slug in slugs]
+            value_models = get_value_models(self.model_cls, attributes)
+        else:
+            value_models = [Value]
+        querysets = []
+        for value_model in value_models:
+            related = ['attribute']
+            if hasattr(value_model, 'value_enum'):
+                related.append('value_enum')
+            qs = value_model.objects.filter(entity_ct=entity.ct) \
+                                    .select_related(*related)
+            if slugs is not None:
+                qs = qs.filter(attribute__slug__in=list(slugs))
+            querysets.append(qs)
+        return querysets
+
+    def _new_value(self, entity, attribute, new_value):
+        '''
+        Returns an unsaved value setting *attribute* to *new_value* on
+        *entity*.
+        '''
+        value_model = self.get_value_model(attribute)
+        value = value_model(entity_ct=entity.ct, entity_id=entity.model.pk,
+                            attribute=attribute)
+        value.value = new_value
+        return value
+
+    def get_values(self, entity):
+        '''
+        Returns a QuerySet of the :class:`~eav.models.Value` objects of
+        *entity*, or a list of its :class:`~eav.models.TypedValue` objects,
+        loaded with one query per datatype of the entity's attributes.
+        '''
+        from .models import Value
+        querysets = self._get_querysets(entity)
+        if len(querysets) == 1 and querysets[0].model is Value:
+            return querysets[0].filter(entity_id=entity.model.pk)
+        values = []
+        for qs in querysets:
+            values.extend(qs.filter(entity_id=entity.model.pk))
+        return values
+
+    def prefetch_values(self, entities, slugs=None):
+        from .models import PREFETCH_BATCH_SIZE
+        by_entity = dict((e.model.pk, []) for e in entities)
+        ids = by_entity.keys()
+        for qs in self._get_querysets(entities[0], slugs):
+            for i in range(0, len(ids), PREFETCH_BATCH_SIZE):
+                batch = ids[i:i + PREFETCH_BATCH_SIZE]
+                for value in qs.filter(entity_id__in=batch):
+                    by_entity[value.entity_id].append(value)
+        return by_entity
+
+    def save_values(self, entity, changes, cache):
+        '''
+        New values are inserted with one ``INSERT``, replacing the ones a
+        concurrent writer inserted first (see
+        :meth:`~eav.models.ValueManager.upsert_entity_values`), changed
+        ones are written with one ``UPDATE`` and removed ones with one
+        ``DELETE``, per table.
+        '''
+        from .models import get_value_models
+        to_insert, to_update, to_delete = [], [], []
+        for attribute, new_value in changes:
+            slug = attribute.slug
+            value = cache.get(slug)
+            if value is not None and value.attribute_id != attribute.pk:
+                value = None
+            if new_value is None or new_value == '':
+                if value is not None:
+                    to_delete.append((value.__class__, attribute.pk))
+                    del cache[slug]
+            elif value is None:
+                value = self._new_value(entity, attribute, new_value)
+                to_insert.append(value)
+                cache[slug] = value
+            elif value.value != new_value:
+                value.value = new_value
+                to_update.append(value)
+
+        complete = True
+        for value_model in get_value_models(self.model_cls,
+                                            [a for a, v in changes]):
+            value_model.objects.delete_entity_values(entity.ct,
+                entity.model.pk,
+                [pk for m, pk in to_delete if m is value_model])
+            value_model.objects.update_entity_values(entity.ct,
+                entity.model.pk,
+                [v for v in to_update if v.__class__ is value_model])
+            inserts = [v for v in to_insert if v.__class__ is value_model]
+            if inserts:
+                # a concurrent writer, or a stale cache, may have inserted
+                # some of them already
+                value_model.objects.upsert_entity_values(inserts)
+                # the primary keys aren't given back
+                complete = False
+        return complete
+
+    def create_values(self, entities, batch_size=None,
+                      using=DEFAULT_DB_ALIAS):
+        values = {}
+        rows = []
+        for entity in entities:
+            new_values = []
+            for attribute, new_value in entity._pop_changes():
+                if new_value is None or new_value == '':
+                    continue
+                new_values.append(self._new_value(entity, attribute,
+                                                  new_value))
+            for value in new_values:
+                values.setdefault(value.__class__, []).append(value)
+            rows.append((entity.model.pk,
+                         [(v.attribute, v.value) for v in new_values]))
+        for value_model, model_values in values.iteritems():
+            value_model.objects.using(using).bulk_create(model_values,
+                batch_size=_bulk_batch_size(value_model, model_values,
+                                            batch_size, using))
+        return rows
+
+    def save_value(self, instance, attribute, value):
+        '''
+        The value is written with
+        :meth:`~eav.models.ValueManager.upsert_entity_value`, so this costs
+        a single statement on databases that support upserts.
+        '''
+        ct = ContentType.objects.get_for_model(instance)
+        value_model = self.get_value_model(attribute)
+        if value == None or value == '':
+            value_model.objects.delete_entity_values(ct, instance.pk,
+                                                     [attribute.pk])
+            return None
+
+        value_obj = value_model(entity_ct=ct, entity_id=instance.pk,
+                                attribute=attribute)
+        value_obj.value = value
+        value_model.objects.upsert_entity_value(value_obj)
+        return value_obj
+
+    def update_values(self, attribute, new_value, pk_sql, pk_params,
+                      using=DEFAULT_DB_ALIAS):
+        '''
+        Existing values are changed with one ``UPDATE``, and values are
+        added to entities that don't have one with one
+        ``INSERT ... SELECT``. Removing values is one ``DELETE``.
+        '''
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        ct = self.ct
+        value_model = self.get_value_model(attribute)
+        table = qn(value_model._meta.db_table)
+        where = '%s = %%s AND %s = %%s' % (qn('entity_ct_id'),
+                                           qn('attribute_id'))
+        where_params = [ct.pk, attribute.pk]
+        cursor = connection.cursor()
+
+        if new_value is None or new_value == '':
+            cursor.execute('DELETE FROM %s WHERE %s AND %s IN (%s)' % \
+                           (table, where, qn('entity_id'), pk_sql),
+                           where_params + pk_params)
+            return cursor.rowcount
+
+        value = value_model(entity_ct=ct, attribute=attribute)
+        value.value = new_value
+        modified = value_model.objects._get_modified_field()
+        fields = value._value_fields()
+        if modified is not None:
+            fields.append(modified)
+        columns = [qn(f.column) for f in fields]
+        params = [f.get_db_prep_save(f.pre_save(value, True),
+                                     connection=connection) \
+                  for f in fields]
+
+        cursor.execute('UPDATE %s SET %s WHERE %s AND %s IN (%s)' % \
+                       (table, ', '.join(['%s = %%s' % c for c in columns]),
+                        where, qn('entity_id'), pk_sql),
+                       params + where_params + pk_params)
+        updated = cursor.rowcount
+
+        # the new rows also get their creation timestamp, if any
+        insert_columns = list(columns)
+        insert_params = list(params)
+        if modified is not None:
+            created = value_model._meta.get_field('created')
+            insert_columns.append(qn(created.column))
+            insert_params.append(created.get_db_prep_save(
+                                    created.pre_save(value, True),
+                                    connection=connection))
+        entity_pk = '%s.%s' % (qn(self.model_cls._meta.db_table),
+                               qn(self.model_cls._meta.pk.column))
+        sql = 'INSERT INTO %s (%s, %s, %s, %s) ' \
+              'SELECT %%s, %s, %%s, %s FROM %s ' \
+              'WHERE %s IN (%s) AND NOT EXISTS ' \
+              '(SELECT 1 FROM %s WHERE %s AND %s = %s)' % (
+                  table, qn('entity_ct_id'), qn('entity_id'),
+                  qn('attribute_id'), ', '.join(insert_columns),
+                  entity_pk, ', '.join(['%s'] * len(insert_columns)),
+                  qn(self.model_cls._meta.db_table),
+                  entity_pk, pk_sql,
+                  table, where, qn('entity_id'), entity_pk)
+        cursor.execute(sql, [ct.pk, attribute.pk] + insert_params + \
+                            pk_params + where_params)
+        return updated + cursor.rowcount
+
+    def delete_values(self, instance, using=DEFAULT_DB_ALIAS):
+        '''
+        The :class:`~eav.models.Value` rows are deleted through the generic
+        relation of the model, so this only deletes
+        :class:`~eav.models.TypedValue` rows.
+        '''
+        from .models import uses_typed_values
+        if not uses_typed_values(self.model_cls):
+            return
+        entity = getattr(instance, self.config_cls.eav_attr)
+        for qs in self._get_querysets(entity):
+            qs.using(using).filter(entity_id=instance.pk).delete()
+
+    def filter_value(self, attribute, lookup):
+        from .models import Attribute
+        value_model = self.get_value_model(attribute)
+        values = value_model.objects.filter(entity_ct=self.ct,
+                                            attribute=attribute)
+        if attribute.datatype == Attribute.TYPE_OBJECT and \
+           lookup in ('', 'exact'):
+            def bind(value):
+                return values.filter(
+                    generic_value_ct=ContentType.objects.get_for_model(value),
+                    generic_value_id=value.pk).values('entity_id')
+        else:
+            column = 'value_%s' % attribute.datatype
+            value_key = str('__'.join(filter(None, [column, lookup])))
+            def bind(value):
+                return values.filter(**{value_key: value}).values('entity_id')
+        return bind
+
+    def _value_field(self, value_model, attribute):
+        from .models import Attribute
+        if attribute.datatype == Attribute.TYPE_OBJECT:
+            return value_model._meta.get_field('generic_value_id')
+        return value_model._meta.get_field('value_%s' % attribute.datatype)
+
+    def value_sql(self, attribute, entity_pk, connection):
+        qn = connection.ops.quote_name
+        value_model = self.get_value_model(attribute)
+        column = qn(self._value_field(value_model, attribute).column)
+        sql = 'SELECT %s FROM %s WHERE %s = %%s AND %s = %%s AND %s = %s' % (
+            column, qn(value_model._meta.db_table), qn('entity_ct_id'),
+            qn('attribute_id'), qn('entity_id'), entity_pk)
+        return sql, [self.ct.pk, attribute.pk]
+
+    def pivot_sql(self, attributes, entity_pk, connection):
+        '''
+        Joins each table storing values, usually just
+        :class:`~eav.models.Value`, and pivots it with one
+        ``MAX(CASE ...)`` aggregate per attribute.
+        '''
+        from .models import Attribute, get_value_models
+        qn = connection.ops.quote_name
+        value_models = get_value_models(self.model_cls, attributes)
+        pivots = dict((m, qn('eav_pivot%s' % (i or ''))) \
+                      for i, m in enumerate(value_models))
+
+        columns = []
+        for attribute in attributes:
+            value_model = self.get_value_model(attribute)
+            pivot = pivots[value_model]
+            field = self._value_field(value_model, attribute)
+            value = '%s.%s' % (pivot, qn(field.column))
+            if attribute.datatype == Attribute.TYPE_BOOLEAN:
+                # not all databases have MAX() of booleans
+                value = 'CASE WHEN %s THEN 1 ELSE 0 END' % value
+            columns.append(('MAX(CASE WHEN %s.%s = %%s THEN %s END)' % \
+                            (pivot, qn('attribute_id'), value),
+                            [attribute.pk]))
+
+        joins = []
+        params = []
+        for value_model in value_models:
+            pivot = pivots[value_model]
+            attribute_ids = [a.pk for a in attributes \
+                             if value_model is self.get_value_model(a)]
+            joins.append('LEFT OUTER JOIN %s %s ON (%s.%s = %s AND '
+                         '%s.%s = %%s AND %s.%s IN (%s))' % (
+                            qn(value_model._meta.db_table), pivot,
+                            pivot, qn('entity_id'), entity_pk,
+                            pivot, qn('entity_ct_id'),
+                            pivot, qn('attribute_id'),
+                            ', '.join(['%s'] * len(attribute_ids))))
+            params.append(self.ct.pk)
+            params.extend(attribute_ids)
+        return ' '.join(joins), params, columns
+
+    def entity_ids_sql(self, connection):
+        from .models import Value, get_value_models, uses_typed_values
+        qn = connection.ops.quote_name
+        value_models = [Value]
+        if uses_typed_values(self.model_cls):
+            value_models = get_value_models(self.model_cls,
+                                    self.config_cls.get_attribute_list()) \
+                           or value_models
+        sql = ['SELECT DISTINCT %s FROM %s WHERE %s = %%s' % (
+                    qn('entity_id'), qn(m._meta.db_table),
+                    qn('entity_ct_id')) for m in value_models]
+        return ' UNION '.join(sql), [self.ct.pk] * len(sql)
+
+    def count_values(self, attribute, pks, bounds=None,
+                     using=DEFAULT_DB_ALIAS):
+        value_model = self.get_value_model(attribute)
+        qn = connections[using].ops.quote_name
+        values = value_model.objects.using(using).order_by() \
+                            .filter(entity_ct=self.ct, attribute=attribute,
+                                    entity_id__in=pks)
+        column = self._value_field(value_model, attribute).attname
+        if bounds is None:
+            return list(values.values_list(column) \
+                              .annotate(count=models.Count('pk')))
+
+        case = ' '.join(['WHEN %s < %%s THEN %d' % (qn(column), i) \
+                         for i in range(len(bounds))])
+        return list(values.extra(select={'bucket': 'CASE %s ELSE %d END' % \
+                                                   (case, len(bounds))},
+                                 select_params=bounds) \
+                          .values_list('bucket') \
+                          .annotate(count=models.Count('pk')))
+
+
+class JsonConstraint(Constraint):
+    '''
+    A ``WHERE`` constraint on a value extracted from a JSON document by
+    :meth:`JsonStorage.extract_sql`, with the lookups of *field*.
+    '''
+
+    def __init__(self, storage, attribute, key, field):
+        super(JsonConstraint, self).__init__(None, None, field)
+        self.storage = storage
+        self.attribute = attribute
+        self.key = key
+
+    def process(self, lookup_type, value, connection):
+        data, params = super(JsonConstraint, self).process(lookup_type,
+                                                           value, connection)
+        return self, params
+
+    def as_sql(self, qn, connection):
+        table = connection.ops.quote_name(self.storage.document_model \
+                                              ._meta.db_table)
+        return self.storage.extract_sql(self.attribute, table, connection,
+                                        self.key)
+
+
+class JsonSubquery(object):
+    '''
+    A ``pk__in`` filter value selecting the entities whose document matches
+    the filter *lookup* on *attribute* with *value*.
+    '''
+
+    def __init__(self, storage, attribute, lookup, value):
+        self.storage = storage
+        self.attribute = attribute
+        self.lookup = lookup
+        self.value = value
+
+    def prepare(self):
+        return self
+
+    def relabel_aliases(self, change_map):
+        # Django only passes *connection* to as_sql() for values having this
+        # method; the document table is never aliased.
+        pass
+
+    def as_sql(self, qn, connection):
+        from .models import Attribute, Value
+        storage = self.storage
+        attribute = self.attribute
+        where = WhereNode()
+        if attribute.datatype == Attribute.TYPE_OBJECT and \
+           self.lookup == 'exact':
+            field = models.IntegerField()
+            ct = ContentType.objects.get_for_model(self.value)
+            where.add((JsonConstraint(storage, attribute, None, field),
+                       'exact', self.value.pk), AND)
+            where.add((JsonConstraint(storage, attribute,
+                                      storage.ct_key(attribute), field),
+                       'exact', ct.pk), AND)
+        else:
+            field = Value._meta.get_field('value_%s' % attribute.datatype)
+            where.add((JsonConstraint(storage, attribute, None, field),
+                       self.lookup, self.value), AND)
+        sql, params = where.as_sql(qn=connection.ops.quote_name,
+                                   connection=connection)
+        qn = connection.ops.quote_name
+        return '(SELECT %s FROM %s WHERE %s = %%s AND %s)' % (
+                    qn('entity_id'),
+                    qn(storage.document_model._meta.db_table),
+                    qn('entity_ct_id'), sql), [storage.ct.pk] + list(params)
+
+
+class JsonStorage(BaseStorage):
+    '''
+    Stores the values of each entity as one JSON object in a
+    :class:`~eav.models.ValueDocument`, mapping attribute primary keys to
+    values. Enums are stored as their primary key, dates as strings, and
+    objects as their primary key, with their content type's primary key
+    under the attribute's key followed by ``_ct``.
+
+    Only SQLite, with the JSON1 functions, and PostgreSQL 9.5+ are
+    supported.
+    '''
+
+    #: The SQL type values of each datatype are cast to on PostgreSQL, where
+    #: they are extracted as text.
+    PG_CASTS = {
+        'int': 'integer',
+        'float': 'double precision',
+        'date': 'timestamp',
+        'bool': 'boolean',
+        'enum': 'integer',
+        'object': 'integer',
+    }
+
+    @property
+    def document_model(self):
+        from .models import ValueDocument
+        return ValueDocument
+
+    def ct_key(self, attribute):
+        return '%d_ct' % attribute.pk
+
+    def extract_sql(self, attribute, table, connection, key=None):
+        '''
+        Returns the SQL expression extracting the value of *attribute*, or
+        of *key*, from the document of the (quoted) *table*. Its value is
+        NULL if the document doesn't have it.
+        '''
+        data = '%s.%s' % (table, connection.ops.quote_name('data'))
+        key = key or str(attribute.pk)
+        if connection.vendor == 'sqlite':
+            return "json_extract(%s, '$.\"%s\"')" % (data, key)
+        if connection.vendor == 'postgresql':
+            sql = "(%s::jsonb ->> '%s')" % (data, key)
+            if key == str(attribute.pk) and \
+               attribute.datatype in self.PG_CASTS:
+                sql = '%s::%s' % (sql, self.PG_CASTS[attribute.datatype])
+            return sql
+        raise NotImplementedError('JsonStorage only supports SQLite and '
+                                  'PostgreSQL, not %s' % connection.vendor)
+
+    def merge_sql(self, data, connection):
+        '''
+        Returns the SQL expression merging a JSON object parameter into the
+        document column *data*, as in RFC 7396: keys with a null value are
+        removed.
+        '''
+        if connection.vendor == 'sqlite':
+            return 'json_patch(%s, %%s)' % data
+        if connection.vendor == 'postgresql':
+            return 'jsonb_strip_nulls(%s::jsonb || %%s::jsonb)::text' % data
+        raise NotImplementedError('JsonStorage only supports SQLite and '
+                                  'PostgreSQL, not %s' % connection.vendor)
+
+    def _patch(self, changes):
+        '''
+        Returns the JSON object setting *changes*, with null for the
+        removed values.
+        '''
+        from .models import Attribute
+        patch = {}
+        for attribute, value in changes:
+            key = str(attribute.pk)
+            if value is None or value == '':
+                patch[key] = None
+                if attribute.datatype == Attribute.TYPE_OBJECT:
+                    patch[self.ct_key(attribute)] = None
+            elif attribute.datatype == Attribute.TYPE_OBJECT:
+                patch[key] = value.pk
+                patch[self.ct_key(attribute)] = \
+                        ContentType.objects.get_for_model(value).pk
+            elif attribute.datatype == Attribute.TYPE_ENUM:
+                patch[key] = value.pk
+            elif attribute.datatype == Attribute.TYPE_DATE:
+                if not isinstance(value, datetime):
+                    value = datetime.combine(value, time())
+                patch[key] = unicode(value)
+            elif attribute.datatype == Attribute.TYPE_BOOLEAN:
+                patch[key] = bool(value)
+            else:
+                patch[key] = value
+        return patch
+
+    def _to_values(self, entity_id, data, slugs=None):
+        '''
+        Returns unsaved :class:`~eav.models.Value` objects holding the
+        values of the JSON document *data* of the entity *entity_id*.
+        '''
+        from .models import Attribute, Value
+        values = []
+        for key, raw in data.iteritems():
+            if raw is None or not key.isdigit():
+                continue
+            attribute = schema.get_attribute_by_pk(int(key))
+            if attribute is None or \
+               (slugs is not None and attribute.slug not in slugs):
+                continue
+            value = Value(entity_ct_id=self.ct.pk, entity_id=entity_id,
+                          attribute=attribute)
+            if attribute.datatype == Attribute.TYPE_OBJECT:
+                value.generic_value_id = raw
+                value.generic_value_ct_id = data.get(self.ct_key(attribute))
+            elif attribute.datatype == Attribute.TYPE_ENUM:
+                value.value_enum = schema.get_enum(attribute.enum_group_id,
+                                                   raw)
+                if value.value_enum is None:
+                    continue
+            else:
+                field = Value._meta.get_field('value_%s' % \
+                                              attribute.datatype)
+                value.value = field.to_python(raw)
+            values.append(value)
+        return values
+
+    def _documents(self, entity_ids, using=DEFAULT_DB_ALIAS):
+        from .models import PREFETCH_BATCH_SIZE
+        documents = self.document_model.objects.using(using) \
+                                       .filter(entity_ct=self.ct)
+        for i in range(0, len(entity_ids), PREFETCH_BATCH_SIZE):
+            batch = entity_ids[i:i + PREFETCH_BATCH_SIZE]
+            for entity_id, data in documents.filter(entity_id__in=batch) \
+                                       .values_list('entity_id', 'data'):
+                yield entity_id, simplejson.loads(data)
+
+    def get_values(self, entity):
+        '''
+        Returns a list of unsaved :class:`~eav.models.Value` objects, read
+        from the entity's document.
+        '''
+        values = []
+        for entity_id, data in self._documents([entity.model.pk]):
+            values.extend(self._to_values(entity_id, data))
+        return values
+
+    def prefetch_values(self, entities, slugs=None):
+        by_entity = dict((e.model.pk, []) for e in entities)
+        for entity_id, data in self._documents(by_entity.keys()):
+            by_entity[entity_id] = self._to_values(entity_id, data, slugs)
+        return by_entity
+
+    def _write(self, entity_id, changes, using=DEFAULT_DB_ALIAS):
+        self._write_patch(entity_id, self._patch(changes), using)
+
+    def _write_patch(self, entity_id, patch, using=DEFAULT_DB_ALIAS):
+        '''
+        Merges the JSON object *patch* into the document of *entity_id* with
+        one ``UPDATE``, or creates it if there's none. If a concurrent
+        writer creates it first, the ``UPDATE`` is retried.
+        '''
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = qn(self.document_model._meta.db_table)
+        sql = 'UPDATE %s SET %s = %s WHERE %s = %%s AND %s = %%s' % (
+                    table, qn('data'), self.merge_sql(qn('data'), connection),
+                    qn('entity_ct_id'), qn('entity_id'))
+        params = [simplejson.dumps(patch), self.ct.pk, entity_id]
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        data = dict((k, v) for k, v in patch.iteritems() if v is not None)
+        if not cursor.rowcount and data:
+            sid = transaction.savepoint(using=using)
+            try:
+                self.document_model.objects.using(using).create(
+                    entity_ct=self.ct, entity_id=entity_id,
+                    data=simplejson.dumps(data))
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=using)
+                cursor.execute(sql, params)
+            else:
+                transaction.savepoint_commit(sid, using=using)
+        transaction.commit_unless_managed(using=using)
+
+    def save_values(self, entity, changes, cache):
+        '''
+        Merges the changes into the entity's document with one ``UPDATE``,
+        or ``INSERT`` if it's the first.
+        '''
+        self._write(entity.model.pk, changes)
+        for value in self._to_values(entity.model.pk, self._patch(changes)):
+            cache[value.attribute.slug] = value
+        for attribute, value in changes:
+            if value is None or value == '':
+                cache.pop(attribute.slug, None)
+        return True
+
+    def create_values(self, entities, batch_size=None,
+                      using=DEFAULT_DB_ALIAS):
+        documents = []
+        rows = []
+        for entity in entities:
+            changes = [(a, v) for a, v in entity._pop_changes() \
+                       if v is not None and v != '']
+            rows.append((entity.model.pk, changes))
+            if changes:
+                documents.append(self.document_model(entity_ct=self.ct,
+                                    entity_id=entity.model.pk,
+                                    data=simplejson.dumps(
+                                            self._patch(changes))))
+        self.document_model.objects.using(using).bulk_create(documents,
+            batch_size=_bulk_batch_size(self.document_model, documents,
+                                        batch_size, using))
+        return rows
+
+    def save_value(self, instance, attribute, value):
+        if value is not None and value != '':
+            attribute.validate_value(value)
+        self._write(instance.pk, [(attribute, value)])
+        values = self._to_values(instance.pk,
+                                 self._patch([(attribute, value)]))
+        return values[0] if values else None
+
+    def update_values(self, attribute, value, pk_sql, pk_params,
+                      using=DEFAULT_DB_ALIAS):
+        '''
+        Merges the value into the documents of the entities with one
+        ``UPDATE``, and creates the missing documents with one
+        ``INSERT ... SELECT``.
+        '''
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = qn(self.document_model._meta.db_table)
+        patch = self._patch([(attribute, value)])
+        where = '%s = %%s AND %s IN (%s)' % (qn('entity_ct_id'),
+                                             qn('entity_id'), pk_sql)
+        params = [self.ct.pk] + pk_params
+        removed = value is None or value == ''
+        if removed:
+            where += ' AND %s IS NOT NULL' % self.extract_sql(attribute,
+                                                              table,
+                                                              connection)
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s = %s WHERE %s' % (
+                            table, qn('data'),
+                            self.merge_sql(qn('data'), connection), where),
+                       [simplejson.dumps(patch)] + params)
+        affected = cursor.rowcount
+        if removed:
+            return affected
+
+        entity_pk = '%s.%s' % (qn(self.model_cls._meta.db_table),
+                               qn(self.model_cls._meta.pk.column))
+        cursor.execute('INSERT INTO %s (%s, %s, %s) SELECT %%s, %s, %%s '
+                       'FROM %s WHERE %s IN (%s) AND NOT EXISTS '
+                       '(SELECT 1 FROM %s WHERE %s = %%s AND %s = %s)' % (
+                            table, qn('entity_ct_id'), qn('entity_id'),
+                            qn('data'), entity_pk,
+                            qn(self.model_cls._meta.db_table), entity_pk,
+                            pk_sql, table, qn('entity_ct_id'),
+                            qn('entity_id'), entity_pk),
+                       [self.ct.pk, simplejson.dumps(patch)] + pk_params + \
+                       [self.ct.pk])
+        return affected + cursor.rowcount
+
+    def delete_values(self, instance, using=DEFAULT_DB_ALIAS):
+        self.document_model.objects.using(using) \
+            .filter(entity_ct=self.ct, entity_id=instance.pk).delete()
+
+    def filter_value(self, attribute, lookup):
+        def bind(value):
+            return JsonSubquery(self, attribute, lookup or 'exact', value)
+        return bind
+
+    def value_sql(self, attribute, entity_pk, connection):
+        qn = connection.ops.quote_name
+        table = qn(self.document_model._meta.db_table)
+        return 'SELECT %s FROM %s WHERE %s = %%s AND %s = %s' % (
+                    self.extract_sql(attribute, table, connection), table,
+                    qn('entity_ct_id'), qn('entity_id'), entity_pk), \
+               [self.ct.pk]
+
+    def pivot_sql(self, attributes, entity_pk, connection):
+        '''
+        Joins the entities' documents, and extracts the value of each
+        attribute, with ``MAX()`` as the query is grouped.
+        '''
+        from .models import Attribute
+        qn = connection.ops.quote_name
+        pivot = qn('eav_document')
+        columns = []
+        for attribute in attributes:
+            value = self.extract_sql(attribute, pivot, connection)
+            if attribute.datatype == Attribute.TYPE_BOOLEAN:
+                value = 'CASE WHEN %s THEN 1 WHEN NOT %s THEN 0 END' % \
+                        (value, value)
+            columns.append(('MAX(%s)' % value, []))
+        join = 'LEFT OUTER JOIN %s %s ON (%s.%s = %s AND %s.%s = %%s)' % (
+                    qn(self.document_model._meta.db_table), pivot,
+                    pivot, qn('entity_id'), entity_pk,
+                    pivot, qn('entity_ct_id'))
+        return join, [self.ct.pk], columns
+
+    def entity_ids_sql(self, connection):
+        qn = connection.ops.quote_name
+        return 'SELECT %s FROM %s WHERE %s = %%s' % (
+                    qn('entity_id'),
+                    qn(self.document_model._meta.db_table),
+                    qn('entity_ct_id')), [self.ct.pk]
+
+    def count_values(self, attribute, pks, bounds=None,
+                     using=DEFAULT_DB_ALIAS):
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = qn(self.document_model._meta.db_table)
+        value = self.extract_sql(attribute, table, connection)
+        params = []
+        if bounds is not None:
+            case = ' '.join(['WHEN %s < %%s THEN %d' % (value, i) \
+                             for i in range(len(bounds))])
+            value = 'CASE %s ELSE %d END' % (case, len(bounds))
+            params.extend(bounds)
+        pk_sql, pk_params = pks.query.get_compiler(using=using).as_sql()
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s, COUNT(*) FROM %s WHERE %s = %%s AND '
+                       '%s IN (%s) AND %s IS NOT NULL GROUP BY 1' % (
+                            value, table, qn('entity_ct_id'),
+                            qn('entity_id'), pk_sql,
+                            self.extract_sql(attribute, table, connection)),
+                       params + [self.ct.pk] + list(pk_params))
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+_storages = {}
+
+
+def get_storage(model_cls):
+    '''
+    Returns the storage backend of the registered model *model_cls*.
+    '''
+    config_cls = model_cls._eav_config_cls
+    storage = _storages.get(model_cls)
+    if storage is None or storage.config_cls is not config_cls:
+        storage_class = getattr(config_cls, 'storage_class', None) or \
+                        RowStorage
+        storage = _storages[model_cls] = storage_class(model_cls)
+    return storage
@@ -3,4 +3,11 @@ from .limiting_attributes import *
 from .data_validation import *
 from .misc_models import *
 from .queries import *
-from .forms import *
\ No newline at end of file
+from .forms import *
+from .entity import *
+from .schema import *
+from .flat import *
+from .benchmarks import *
+from .typed import *
+from .storage import *
+from .value_cache import *
@@ -0,0 +1,223 @@
+'''
+Query plan checks and benchmarks.
+
+The plan checks always run on SQLite. The timed benchmarks only run when
+the ``EAV_BENCHMARKS`` environment variable is set, and print their
+results::
+
+    EAV_BENCHMARKS=1 python runtests.py
+
+They use ``TransactionTestCase``, as SQLite commits the test transaction
+before running ``EXPLAIN``.
+'''
+import os
+import sys
+from timeit import default_timer
+
+from django.test import TransactionTestCase
+from django.db import connection
+from django.db.models.signals import post_init
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.contrib.contenttypes.models import ContentType
+from django.utils.unittest import skipUnless
+
+import eav
+from ..models import Attribute, Value, Entity
+from ..schema import schema
+from ..managers import filter_plans
+
+from .models import Patient
+
+
+run_benchmarks = skipUnless(os.environ.get('EAV_BENCHMARKS'),
+                            'set EAV_BENCHMARKS to run benchmarks')
+sqlite_only = skipUnless(connection.vendor == 'sqlite',
+                         'query plans are checked on SQLite only')
+
+
+def explain(qs):
+    '''
+    Returns the lines of SQLite's query plan for *qs*.
+    '''
+    sql, params = qs.query.get_compiler(using=qs.db).as_sql()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def best_time(func, repeat=5):
+    '''
+    Returns the best wall clock time of *repeat* calls of *func*.
+    '''
+    times = []
+    for i in range(repeat):
+        start = default_timer()
+        func()
+        times.append(default_timer() - start)
+    return min(times)
+
+
+def report(name, **timings):
+    sys.stderr.write('\n%s: %s\n' % (name, ', '.join(
+        '%s %.2fms' % (k, v * 1000) for k, v in sorted(timings.items()))))
+
+
+class BenchmarkCase(TransactionTestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+        Value.objects.all().delete()
+        Patient.objects.all().delete()
+        Attribute.objects.all().delete()
+        schema.clear()
+
+    def seed(self, count):
+        Patient.objects.bulk_create_with_eav([
+            {'name': 'P%d' % i, 'eav__age': i % 90,
+             'eav__city': 'City %d' % (i % 50)} for i in range(count)])
+
+
+class FilterPlans(BenchmarkCase):
+
+    def old_style_filter(self, **kwargs):
+        '''
+        The generic relation join and distinct() used to filter on eav
+        values, for comparison.
+        '''
+        values = Value.objects.filter(attribute__slug='age', **kwargs)
+        return Patient.objects.filter(eav_values__in=values).distinct()
+
+    @sqlite_only
+    def test_filter_is_semijoin_without_distinct(self):
+        self.seed(100)
+        new_plan = ' '.join(explain(Patient.objects.filter(eav__age=5)))
+        old_plan = ' '.join(explain(self.old_style_filter(value_int=5)))
+        self.assertTrue('DISTINCT' in old_plan)
+        self.assertFalse('DISTINCT' in new_plan)
+        self.assertEqual(Patient.objects.filter(eav__age=5).count(),
+                         self.old_style_filter(value_int=5).count())
+
+    @run_benchmarks
+    def test_benchmark_filter(self):
+        self.seed(5000)
+        new = best_time(lambda: list(Patient.objects.filter(eav__age=5)))
+        old = best_time(lambda: list(self.old_style_filter(value_int=5)))
+        report('eav__age=5 on 5000 entities', semijoin=new, distinct_join=old)
+
+
+class FilterCompilation(BenchmarkCase):
+
+    @run_benchmarks
+    def test_benchmark_filter_compilation(self):
+        def build():
+            for i in range(1000):
+                Patient.objects.filter(eav__age=i, eav__city__startswith='C')
+
+        def build_uncached():
+            for i in range(1000):
+                filter_plans.clear()
+                Patient.objects.filter(eav__age=i, eav__city__startswith='C')
+
+        report('1000 filter() calls', cached=best_time(build),
+               uncached=best_time(build_uncached))
+
+
+class ValueIndexes(BenchmarkCase):
+    '''
+    The composite indexes of eav/sql/value.sql, created by syncdb, and the
+    unique entity and attribute index.
+    '''
+
+    def drop_indexes(self):
+        cursor = connection.cursor()
+        for sql in custom_sql_for_model(Value, no_style(), connection):
+            name = sql.split()[2]
+            cursor.execute('DROP INDEX %s' % name)
+
+    def create_indexes(self):
+        cursor = connection.cursor()
+        for sql in custom_sql_for_model(Value, no_style(), connection):
+            cursor.execute(sql)
+
+    def entity_values(self, patient):
+        return Value.objects.filter(
+                    entity_ct=ContentType.objects.get_for_model(Patient),
+                    entity_id=patient.pk)
+
+    @sqlite_only
+    def test_queries_use_composite_indexes(self):
+        self.seed(100)
+        plan = ' '.join(explain(Patient.objects.filter(eav__age=5)))
+        self.assertTrue('eav_value_attribute_int' in plan)
+        patient = Patient.objects.all()[0]
+        plan = ' '.join(explain(self.entity_values(patient)))
+        self.assertTrue('(entity_ct_id=? AND entity_id=?)' in plan)
+
+    @run_benchmarks
+    def test_benchmark_indexes(self):
+        self.seed(5000)
+
+        def find():
+            list(Patient.objects.filter(eav__age=5))
+
+        indexed = best_time(find)
+        self.drop_indexes()
+        try:
+            unindexed = best_time(find)
+        finally:
+            self.create_indexes()
+        report('eav__age=5 on 5000 entities', indexed=indexed,
+               unindexed=unindexed)
+
+
+class Instantiation(BenchmarkCase):
+    '''
+    Registered models get their :class:`~eav.models.Entity` on first access
+    to their *eav_attr*, instead of from a ``post_init`` handler.
+    '''
+
+    def test_entity_created_on_first_access(self):
+        self.seed(3)
+        patients = list(Patient.objects.all())
+        self.assertFalse('eav' in patients[0].__dict__)
+        entity = patients[0].eav
+        self.assertTrue(isinstance(entity, Entity))
+        self.assertTrue(patients[0].eav is entity)
+        self.assertTrue(entity.model is patients[0])
+
+    @run_benchmarks
+    def test_benchmark_instantiation(self):
+        self.seed(2000)
+
+        def build():
+            for i in range(10000):
+                Patient(name='P')
+
+        def load():
+            list(Patient.objects.all())
+
+        def attach(sender, instance, **kwargs):
+            instance.__dict__['eav'] = Entity(instance)
+
+        eav.unregister(Patient)
+        try:
+            unregistered = best_time(build), best_time(load)
+        finally:
+            eav.register(Patient)
+        registered = best_time(build), best_time(load)
+        # what registration used to cost
+        post_init.connect(attach, sender=Patient)
+        try:
+            with_post_init = best_time(build), best_time(load)
+        finally:
+            post_init.disconnect(attach, sender=Patient)
+        for i, name in enumerate(['10000 instances', 'loading 2000 rows']):
+            report(name, registered=registered[i],
+                   with_post_init=with_post_init[i],
+                   unregistered=unregistered[i])
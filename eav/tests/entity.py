@@ -0,0 +1,297 @@
+from django.test import TestCase
+from django.utils.unittest import skipUnless
+from django.db import connection, IntegrityError
+from django.db.models.signals import pre_save
+from django.core.exceptions import ValidationError
+from django.contrib.contenttypes.models import ContentType
+
+import eav
+from ..models import Attribute, Value, _upsert_support
+
+from .models import Patient
+
+
+class EntityValueCache(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='Age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='Height', datatype=Attribute.TYPE_FLOAT)
+        Attribute.objects.create(name='City', datatype=Attribute.TYPE_TEXT)
+
+        Patient.objects.create(name='Bob', eav__age=5, eav__height=1.2,
+                               eav__city='Nice')
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_values_loaded_once(self):
+        p = Patient.objects.get(name='Bob')
+        with self.assertNumQueries(1):
+            self.assertEqual(p.eav.age, 5)
+            self.assertEqual(p.eav.height, 1.2)
+            self.assertEqual(p.eav.city, 'Nice')
+            self.assertEqual(p.eav.get_attributes_and_values(),
+                             {'age': 5, 'height': 1.2, 'city': 'Nice'})
+
+    def test_unset_value_is_none(self):
+        Patient.objects.create(name='Jon')
+        p = Patient.objects.get(name='Jon')
+        self.assertEqual(p.eav.age, None)
+        self.assertEqual(p.eav.city, None)
+        self.assertRaises(AttributeError, getattr, p.eav, 'weight')
+
+    def test_refresh(self):
+        p = Patient.objects.get(name='Bob')
+        self.assertEqual(p.eav.age, 5)
+        Value.objects.filter(attribute__slug='age').update(value_int=7)
+        self.assertEqual(p.eav.age, 5)
+        p.eav.refresh()
+        self.assertEqual(p.eav.age, 7)
+
+    def test_cache_follows_own_writes(self):
+        p = Patient.objects.get(name='Bob')
+        p.eav.age = 6
+        p.eav.city = None
+        p.save()
+        self.assertEqual(p.eav.age, 6)
+        self.assertEqual(p.eav.city, None)
+        self.assertEqual(sorted(v.attribute.slug for v in p.eav),
+                         ['age', 'height'])
+
+
+class EntityChangeSet(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        for i in range(10):
+            Attribute.objects.create(name='attr%d' % i,
+                                     datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='City', datatype=Attribute.TYPE_TEXT)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_only_changed_slugs_recorded(self):
+        p = Patient.objects.create(name='Bob', eav__attr1=1, eav__attr2=2)
+        self.assertEqual(p.eav.get_changed_slugs(), [])
+        p.eav.attr1 = 3
+        del p.eav.attr2
+        self.assertEqual(sorted(p.eav.get_changed_slugs()),
+                         ['attr1', 'attr2'])
+        self.assertEqual(p.eav.attr1, 3)
+        self.assertEqual(p.eav.attr2, None)
+
+    def test_save_writes_only_changes(self):
+        p = Patient.objects.create(name='Bob', eav__attr1=1, eav__attr2=2,
+                                   eav__attr3=3)
+        p = Patient.objects.get(pk=p.pk)
+        list(p.eav.get_all_attributes())
+        p.eav.get_value_cache()
+        p.eav.attr1 = 10
+        p.eav.attr4 = 4
+        p.eav.city = 'Nice'
+        p.eav.attr2 = None
+        # one UPDATE, one INSERT, one DELETE
+        with self.assertNumQueries(3):
+            p.eav.save()
+
+        p = Patient.objects.get(pk=p.pk)
+        self.assertEqual(p.eav.get_attributes_and_values(),
+                         {'attr1': 10, 'attr3': 3, 'attr4': 4,
+                          'city': 'Nice'})
+
+    def test_unchanged_save_is_free(self):
+        p = Patient.objects.create(name='Bob', eav__attr1=1)
+        p = Patient.objects.get(pk=p.pk)
+        with self.assertNumQueries(0):
+            p.eav.save()
+        p.eav.attr1 = 1
+        list(p.eav.get_all_attributes())
+        p.eav.get_value_cache()
+        with self.assertNumQueries(0):
+            p.eav.save()
+
+    def test_refresh_discards_changes(self):
+        p = Patient.objects.create(name='Bob', eav__attr1=1)
+        p.eav.attr1 = 2
+        p.eav.refresh()
+        self.assertEqual(p.eav.attr1, 1)
+        p.save()
+        self.assertEqual(Patient.objects.get(pk=p.pk).eav.attr1, 1)
+
+
+class BulkCreateWithEav(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='Age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='City', datatype=Attribute.TYPE_TEXT)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_bulk_create_dicts_and_instances(self):
+        Patient.objects.create(name='Existing', eav__age=99)
+        objs = [{'name': 'P%d' % i, 'eav__age': i, 'eav__city': 'C%d' % i} \
+                for i in range(20)]
+        jon = Patient(name='Jon')
+        jon.eav.age = 40
+        objs.append(jon)
+
+        created = Patient.objects.bulk_create_with_eav(objs, batch_size=7)
+        self.assertEqual(len(created), 21)
+        self.assertTrue(created[-1] is jon)
+        self.assertEqual(Patient.objects.count(), 22)
+        self.assertEqual(Value.objects.count(), 42)
+        for i, p in enumerate(created[:20]):
+            p = Patient.objects.get(pk=p.pk)
+            self.assertEqual(p.name, 'P%d' % i)
+            self.assertEqual(p.eav.age, i)
+            self.assertEqual(p.eav.city, 'C%d' % i)
+        self.assertEqual(Patient.objects.get(pk=jon.pk).eav.age, 40)
+        self.assertEqual(Patient.objects.get(name='Existing').eav.age, 99)
+
+    def test_explicit_pks(self):
+        objs = [{'name': 'P%d' % i, 'eav__age': i} for i in range(6)]
+        objs[2]['id'] = 1000
+        created = Patient.objects.bulk_create_with_eav(objs, batch_size=4)
+        self.assertEqual(created[2].pk, 1000)
+        for i, p in enumerate(created):
+            p = Patient.objects.get(pk=p.pk)
+            self.assertEqual((p.name, p.eav.age), ('P%d' % i, i))
+
+    @skipUnless(_upsert_support(connection)[1], 'needs RETURNING')
+    def test_pks_returned_on_postgresql(self):
+        # SQLite 3.35+ runs the multi-row INSERT ... RETURNING too
+        patients = [Patient(name='P%d' % i) for i in range(3)]
+        vendor, connection.vendor = connection.vendor, 'postgresql'
+        try:
+            with self.assertNumQueries(1):
+                Patient.objects._bulk_insert_with_pks(patients)
+        finally:
+            connection.vendor = vendor
+        self.assertEqual([Patient.objects.get(pk=p.pk).name \
+                          for p in patients], ['P0', 'P1', 'P2'])
+
+    def test_pks_without_bulk_readback(self):
+        # databases other than SQLite and PostgreSQL insert the entities one
+        # by one
+        vendor, connection.vendor = connection.vendor, 'other'
+        try:
+            created = Patient.objects.bulk_create_with_eav(
+                    [{'name': 'P%d' % i, 'eav__age': i} for i in range(3)])
+        finally:
+            connection.vendor = vendor
+        self.assertEqual([Patient.objects.get(pk=p.pk).eav.age \
+                          for p in created], [0, 1, 2])
+
+    def test_query_count(self):
+        objs = [{'name': 'P%d' % i, 'eav__age': i} for i in range(10)]
+        Patient.objects.bulk_create_with_eav(objs[:1])
+        # entity INSERT, pk SELECT, value INSERT
+        with self.assertNumQueries(3):
+            Patient.objects.bulk_create_with_eav(objs[1:])
+
+    def test_validation_before_writing(self):
+        objs = [{'name': 'Bob', 'eav__age': 5},
+                {'name': 'Joe', 'eav__age': 'bad'}]
+        self.assertRaises(ValidationError,
+                          Patient.objects.bulk_create_with_eav, objs)
+        self.assertEqual(Patient.objects.count(), 0)
+        self.assertEqual(Value.objects.count(), 0)
+
+
+class SaveValueUpsert(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        self.age = Attribute.objects.create(name='Age',
+                                            datatype=Attribute.TYPE_INT)
+        self.bob = Patient.objects.create(name='Bob')
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_save_value(self):
+        value = self.age.save_value(self.bob, 5)
+        self.assertEqual(value.value, 5)
+        value = self.age.save_value(self.bob, 6)
+        self.assertEqual(Value.objects.get(attribute=self.age).value_int, 6)
+        if _upsert_support(connection)[1]:
+            self.assertEqual(value.pk, Value.objects.get().pk)
+        self.assertEqual(self.age.save_value(self.bob, None), None)
+        self.assertEqual(Value.objects.count(), 0)
+
+    @skipUnless(_upsert_support(connection)[0],
+                'needs INSERT ... ON CONFLICT DO UPDATE')
+    def test_one_statement_per_value(self):
+        ContentType.objects.get_for_model(Patient)
+        with self.assertNumQueries(1):
+            self.age.save_value(self.bob, 5)
+        with self.assertNumQueries(1):
+            self.age.save_value(self.bob, 6)
+        with self.assertNumQueries(1):
+            self.age.save_value(self.bob, None)
+
+    def test_get_or_insert_fallback(self):
+        self.age.save_value(self.bob, 5)
+        value = Value(entity=self.bob, attribute=self.age, value_int=7)
+        Value.objects._get_or_insert_entity_value(value)
+        self.assertEqual(Value.objects.get().value_int, 7)
+        self.assertEqual(Value.objects.get().pk, value.pk)
+
+    def test_get_or_insert_retries_after_conflict(self):
+        inserted = []
+
+        def insert_first(sender, instance, **kwargs):
+            # another writer inserts the value after it was looked up
+            if not inserted:
+                inserted.append(True)
+                Value.objects.bulk_create([Value(entity=self.bob,
+                                                 attribute=self.age,
+                                                 value_int=5)])
+
+        pre_save.connect(insert_first, sender=Value)
+        try:
+            value = Value(entity=self.bob, attribute=self.age, value_int=7)
+            Value.objects._get_or_insert_entity_value(value)
+        finally:
+            pre_save.disconnect(insert_first, sender=Value)
+        self.assertEqual(inserted, [True])
+        self.assertEqual(Value.objects.get().value_int, 7)
+        self.assertEqual(Value.objects.get().pk, value.pk)
+
+    def saves_creating_the_same_value(self):
+        first = Patient.objects.get(pk=self.bob.pk)
+        second = Patient.objects.get(pk=self.bob.pk)
+        # both load their values before either saves
+        self.assertEqual((first.eav.age, second.eav.age), (None, None))
+        first.eav.age = 3
+        first.save()
+        second.eav.age = 4
+        second.save()
+        self.assertEqual(Value.objects.get().value_int, 4)
+
+    def test_saves_creating_the_same_value(self):
+        self.saves_creating_the_same_value()
+
+    def test_saves_creating_the_same_value_without_upsert(self):
+        vendor, connection.vendor = connection.vendor, 'other'
+        try:
+            self.saves_creating_the_same_value()
+        finally:
+            connection.vendor = vendor
+
+    def test_unique_entity_attribute(self):
+        self.age.save_value(self.bob, 5)
+        self.assertRaises(IntegrityError, Value.objects.create,
+                          entity=self.bob, attribute=self.age, value_int=6)
+
+    def test_save_value_validates(self):
+        self.assertRaises(ValidationError, self.age.save_value, self.bob,
+                          'old')
@@ -0,0 +1,199 @@
+from django.test import TransactionTestCase
+from django.db import connection
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
+
+import eav
+from ..registry import EavConfig
+from ..models import Attribute, Value, EnumValue, EnumGroup
+from ..flat import get_flat_table
+from ..storage import JsonStorage
+from ..schema import schema
+
+from .models import Patient
+
+
+class PatientFlatConfig(EavConfig):
+    flat_table = True
+
+
+class PatientFlatTypedConfig(EavConfig):
+    flat_table = True
+    typed_values = True
+
+
+class PatientFlatJsonConfig(EavConfig):
+    flat_table = True
+    storage_class = JsonStorage
+
+
+class FlatTable(TransactionTestCase):
+    '''
+    DDL commits the transaction on SQLite, so these tests drop the flat
+    table themselves.
+    '''
+    config_cls = PatientFlatConfig
+
+    def setUp(self):
+        eav.register(Patient, self.config_cls)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        self.yes = EnumValue.objects.create(value='yes')
+        self.no = EnumValue.objects.create(value='no')
+        yn = EnumGroup.objects.create(name='Yes / No')
+        yn.enums.add(self.yes, self.no)
+        Attribute.objects.create(name='fever', datatype=Attribute.TYPE_ENUM,
+                                 enum_group=yn)
+
+        Patient.objects.create(name='Bob', eav__age=12, eav__city='Bamako',
+                               eav__fever=self.yes)
+        Patient.objects.create(name='Fred', eav__age=15, eav__city='Nice')
+        self.flat = get_flat_table(Patient)
+        call_command('rebuild_eav_flat', 'eav.Patient', verbosity=0)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+        cursor = connection.cursor()
+        cursor.execute('DROP TABLE %s' % connection.ops.quote_name(
+                                                self.flat.name))
+        schema.clear()
+
+    def rows(self):
+        cursor = connection.cursor()
+        cursor.execute('SELECT entity_id, age, city, fever FROM %s '
+                       'ORDER BY entity_id' % self.flat.name)
+        return [tuple(r) for r in cursor.fetchall()]
+
+    def pk(self, name):
+        return Patient.objects.get(name=name).pk
+
+    def test_rebuild(self):
+        self.assertEqual(self.rows(),
+                         [(self.pk('Bob'), 12, 'Bamako', self.yes.pk),
+                          (self.pk('Fred'), 15, 'Nice', None)])
+
+    def test_filters_and_ordering_use_flat_table(self):
+        qs = Patient.objects.filter(eav__age__gte=13, eav__city='Nice')
+        self.assertTrue(self.flat.name in str(qs.query))
+        self.assertFalse('eav_value' in str(qs.query))
+        self.assertEqual([p.name for p in qs], ['Fred'])
+        self.assertEqual([p.name for p in Patient.objects.exclude(
+                                                        eav__fever=self.yes)],
+                         ['Fred'])
+        qs = Patient.objects.order_by('-eav__age')
+        self.assertFalse('eav_value' in str(qs.query))
+        self.assertEqual([p.name for p in qs], ['Fred', 'Bob'])
+
+    def test_write_paths(self):
+        p = Patient.objects.get(name='Bob')
+        p.eav.age = 13
+        p.eav.city = None
+        p.save()
+        Attribute.objects.get(slug='fever').save_value(p, self.no)
+        Patient.objects.create(name='Jon', eav__age=3)
+        Patient.objects.bulk_create_with_eav([{'name': 'Joe',
+                                               'eav__city': 'Paris'}])
+        Patient.objects.filter(name='Fred').delete()
+        self.assertEqual(self.rows(),
+                         [(self.pk('Bob'), 13, None, self.no.pk),
+                          (self.pk('Jon'), 3, None, None),
+                          (self.pk('Joe'), None, 'Paris', None)])
+
+        Patient.objects.filter(eav__city='Paris').update_eav(age=40)
+        Patient.objects.filter(name='Bob').update_eav(age=None)
+        self.assertEqual(self.rows()[0], (self.pk('Bob'), None, None,
+                                          self.no.pk))
+        self.assertEqual(self.rows()[2], (self.pk('Joe'), 40, 'Paris', None))
+        self.assertEqual(list(Patient.objects.filter(eav__age=40)),
+                         list(Patient.objects.filter(name='Joe')))
+
+    def test_new_attribute(self):
+        Attribute.objects.create(name='height', datatype=Attribute.TYPE_FLOAT)
+        p = Patient.objects.create(name='Jon', eav__height=1.8)
+        # no column yet: filters use the eav values
+        self.assertEqual(list(Patient.objects.filter(eav__height=1.8)), [p])
+        call_command('rebuild_eav_flat', verbosity=0)
+        self.assertTrue('height' in self.flat.get_columns())
+        qs = Patient.objects.filter(eav__height=1.8)
+        self.assertFalse('eav_value' in str(qs.query))
+        self.assertEqual(list(qs), [p])
+
+
+    def test_columns_only_fills_new_columns(self):
+        Attribute.objects.create(name='height', datatype=Attribute.TYPE_FLOAT)
+        Attribute.objects.create(name='alive',
+                                 datatype=Attribute.TYPE_BOOLEAN)
+        # no row yet, as neither value has a column
+        jon = Patient.objects.create(name='Jon', eav__height=1.8,
+                                     eav__alive=False)
+        bob = Patient.objects.get(name='Bob')
+        bob.eav.alive = True
+        bob.save()
+        version = schema.get_shared_version()
+        call_command('rebuild_eav_flat', columns_only=True, verbosity=0)
+        # the other processes read the columns again
+        self.assertNotEqual(schema.get_shared_version(), version)
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT entity_id, height, alive FROM %s '
+                       'ORDER BY entity_id' % self.flat.name)
+        self.assertEqual([tuple(r) for r in cursor.fetchall()],
+                         [(bob.pk, None, True), (self.pk('Fred'), None, None),
+                          (jon.pk, 1.8, False)])
+        qs = Patient.objects.filter(eav__height=1.8, eav__alive=False)
+        self.assertFalse('eav_value' in str(qs.query))
+        self.assertEqual(list(qs), [jon])
+
+    def test_deleted_attribute_drops_column(self):
+        Attribute.objects.get(slug='city').delete()
+        self.assertFalse('city' in self.flat.get_columns())
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_INT)
+        call_command('rebuild_eav_flat', columns_only=True, verbosity=0)
+        self.assertTrue('city' in self.flat.get_columns())
+        jon = Patient.objects.create(name='Jon', eav__city=5)
+        self.assertEqual(list(Patient.objects.filter(eav__city__lt=10)),
+                         [jon])
+
+    def test_isnull_without_flat_table(self):
+        Patient.objects.create(name='Jon')
+        filters = [{'eav__fever__isnull': True},
+                   {'eav__fever__isnull': False},
+                   {'eav__city__isnull': True}]
+        with_flat = [sorted(p.name for p in Patient.objects.filter(**f)) \
+                     for f in filters]
+        eav.unregister(Patient)
+        eav.register(Patient, type('NoFlatConfig', (self.config_cls,),
+                                   {'flat_table': False}))
+        self.assertEqual([sorted(p.name for p in Patient.objects.filter(**f))
+                          for f in filters], with_flat)
+
+    def test_unusable_slugs_have_no_column(self):
+        Attribute.objects.create(name='entity_id',
+                                 datatype=Attribute.TYPE_INT)
+        call_command('rebuild_eav_flat', verbosity=0)
+        jon = Patient.objects.create(name='Jon', eav__entity_id=3)
+        qs = Patient.objects.filter(eav__entity_id=3)
+        self.assertFalse(self.flat.name in str(qs.query))
+        self.assertEqual(list(qs), [jon])
+
+
+class FlatTableTypedValues(FlatTable):
+    '''
+    The same, with the values in the typed value tables.
+    '''
+    config_cls = PatientFlatTypedConfig
+
+
+class FlatTableJsonStorage(FlatTable):
+    '''
+    The same, with the values in JSON documents.
+    '''
+    config_cls = PatientFlatJsonConfig
+
+    def test_failed_save_value_leaves_row(self):
+        p = Patient.objects.get(name='Bob')
+        self.assertRaises(ValidationError,
+                          Attribute.objects.get(slug='age').save_value, p,
+                          'old')
+        self.assertEqual(self.rows()[0], (p.pk, 12, 'Bamako', self.yes.pk))
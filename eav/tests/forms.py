@@ -7,9 +7,18 @@ from django.test import TestCase
 
 import eav
 from .models import Patient
+from ..registry import EavConfig
 from ..forms import BaseDynamicEntityForm
 from ..models import Attribute, EnumValue, EnumGroup
 
+class PatientByAgeConfig(EavConfig):
+
+    @classmethod
+    def get_attributes(cls, entity=None):
+        slug = 'height' if entity and entity.name == 'kid' else 'age'
+        return Attribute.objects.filter(slug=slug)
+
+
 class FormTest(TestCase):
     def setUp(self):
         eav.register(Patient)
@@ -43,3 +52,49 @@ class FormTest(TestCase):
         data = {'age': 1, 'dob_0': '2012-01-01', 'dob_1': '12:00:00', 'height': 10.1, 'city': 'Moscow', 'pregnant':True, 'fever':1}
         form = BaseDynamicEntityForm(data=data, instance=p)
         self.assertTrue(form.is_valid())
+
+    def test_initial_values(self):
+        p = Patient.objects.create(eav__age=2, eav__city='Nice',
+                                   eav__pregnant=False,
+                                   eav__fever=EnumValue.objects.get(value='no'))
+        form = BaseDynamicEntityForm(instance=p)
+        self.assertEqual(form.fields['fever'].choices,
+                         [('', '-----')] + [(e.pk, e.value) for e in
+                                  EnumValue.objects.order_by('pk')])
+        self.assertEqual(form.initial['age'], 2)
+        self.assertEqual(form.initial['city'], 'Nice')
+        self.assertEqual(form.initial['pregnant'], False)
+        self.assertEqual(form.initial['fever'],
+                         EnumValue.objects.get(value='no').pk)
+        self.assertFalse('height' in form.initial)
+
+    def test_fields_cached(self):
+        p = Patient.objects.create(eav__age=2,
+                                   eav__fever=EnumValue.objects.get(value='no'))
+        BaseDynamicEntityForm(instance=p)
+        p = Patient.objects.get(pk=p.pk)
+        # the values of the patient, in one query
+        with self.assertNumQueries(1):
+            form = BaseDynamicEntityForm(instance=p)
+        self.assertEqual(form.initial['age'], 2)
+        self.assertEqual(len(form.fields), 6)
+
+        Attribute.objects.create(name='Weight', datatype=Attribute.TYPE_FLOAT)
+        form = BaseDynamicEntityForm(instance=Patient.objects.get(pk=p.pk))
+        self.assertTrue('weight' in form.fields)
+
+    def test_fields_cached_by_attributes(self):
+        eav.unregister(Patient)
+        eav.register(Patient, PatientByAgeConfig)
+        try:
+            kid = Patient.objects.create(name='kid')
+            adult = Patient.objects.create(name='adult')
+            self.assertEqual(
+                    BaseDynamicEntityForm(instance=adult).fields.keys(),
+                    ['age'])
+            self.assertEqual(
+                    BaseDynamicEntityForm(instance=kid).fields.keys(),
+                    ['height'])
+        finally:
+            eav.unregister(Patient)
+            eav.register(Patient)
@@ -1,8 +1,10 @@
 from django.test import TestCase
+from django.core.exceptions import ValidationError
 
 import eav
 from ..registry import EavConfig
-from ..models import Attribute, Value
+from ..models import Attribute, AttributeSet, Value
+from ..forms import BaseDynamicEntityForm
 
 from .models import Patient, Encounter
 
@@ -79,3 +81,61 @@ class AttributesWithParents(TestCase):
         self.assertEqual(len(encounter_attrs), 2)
 
         
+
+
+class PatientAttributeSetConfig(EavConfig):
+    # the patient's name is the slug of its attribute set
+    attribute_set_field = 'name'
+
+
+class AttributeSets(TestCase):
+
+    def setUp(self):
+        eav.register(Patient, PatientAttributeSetConfig)
+        age = Attribute.objects.create(name='age',
+                                       datatype=Attribute.TYPE_INT)
+        height = Attribute.objects.create(name='height',
+                                          datatype=Attribute.TYPE_FLOAT)
+        weight = Attribute.objects.create(name='weight', required=True,
+                                          datatype=Attribute.TYPE_FLOAT)
+        AttributeSet.objects.create(name='Adult').attributes.add(age, weight)
+        AttributeSet.objects.create(name='Child').attributes.add(age, height)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_attributes_of_set(self):
+        self.assertEqual(Patient(name='child').eav.get_all_attribute_slugs(),
+                         ['age', 'height'])
+        self.assertEqual(Patient(name='adult').eav.get_all_attribute_slugs(),
+                         ['age', 'weight'])
+        self.assertEqual(Patient(name='').eav.get_all_attribute_slugs(),
+                         ['age', 'height', 'weight'])
+        self.assertEqual(Patient(name='baby').eav.get_all_attribute_slugs(),
+                         [])
+
+        # the set is read again when it changes
+        p = Patient(name='child')
+        p.eav.get_all_attributes()
+        p.name = 'adult'
+        self.assertEqual(p.eav.get_all_attribute_slugs(), ['age', 'weight'])
+        AttributeSet.objects.get(slug='adult').attributes.add(
+                                        Attribute.objects.get(slug='height'))
+        self.assertEqual(p.eav.get_all_attribute_slugs(),
+                         ['age', 'height', 'weight'])
+
+    def test_save_and_validate_only_the_set(self):
+        # weight is required for adults only
+        p = Patient.objects.create(name='child', eav__age=3, eav__height=0.9,
+                                   eav__weight=20.0)
+        self.assertEqual(Value.objects.count(), 2)
+        p = Patient.objects.get(pk=p.pk)
+        self.assertFalse(hasattr(p.eav, 'weight'))
+        self.assertRaises(ValidationError, Patient.objects.create,
+                          name='adult', eav__age=30)
+
+    def test_form_fields(self):
+        p = Patient.objects.create(name='child', eav__age=3)
+        form = BaseDynamicEntityForm(instance=p)
+        self.assertEqual(sorted(f for f in form.fields if f != 'name'),
+                         ['age', 'height'])
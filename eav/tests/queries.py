@@ -1,9 +1,15 @@
 from django.test import TestCase
-from django.db.models import Q
+from django.db import connection
+from django.db.models import Q, Avg, Count, Sum, Max
+from django.core.exceptions import ValidationError, FieldError
+from django.core.cache import cache
 from django.contrib.auth.models import User
 
 from ..registry import EavConfig
 from ..models import EnumValue, EnumGroup, Attribute, Value
+from ..schema import schema
+from .. import managers
+from ..managers import filter_plans, eav_value_sql
 
 import eav
 from .models import Patient, Encounter
@@ -81,7 +87,7 @@ class Queries(TestCase):
         self.assertEqual(Patient.objects.filter(Q(eav__city__contains='Y')).count(), 1)
 
         # Everyone except Bob
-        #self.assertEqual(Patient.objects.exclude(Q(eav__city__contains='Y')).count(), 4)
+        self.assertEqual(Patient.objects.exclude(Q(eav__city__contains='Y')).count(), 4)
 
 
         # Bob, Fred, Joe
@@ -93,7 +99,7 @@ class Queries(TestCase):
         self.assertEqual(Patient.objects.filter(q2).count(), 1)
 
         # Joe
-        #self.assertEqual(Patient.objects.filter(q1 & q2).count(), 1)
+        self.assertEqual(Patient.objects.filter(q1 & q2).count(), 1)
 
         # Jose
         self.assertEqual(Patient.objects.filter(name__contains='J', eav__fever=yes).count(), 1)
@@ -113,3 +119,577 @@ class Queries(TestCase):
         eav.register(User, UserEavConfig)
 
         c = User.objects.create(username='joe', email='joe@example.com')
+
+
+class CombinedQueries(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        Attribute.objects.create(name='country', datatype=Attribute.TYPE_TEXT)
+
+        data = [
+        #       Name    Age   City        Country
+            [   'Bob',  12,   'Bamako',   'Mali'  ],
+            [   'Fred', 15,   'Bamako',   'Mali'  ],
+            [   'Jose', 15,   'Kisumu',   'Kenya' ],
+            [   'Joe',  2,    'Nice',     'France'],
+            [   'Beth', None, 'Paris',    'France'],
+        ]
+        for name, age, city, country in data:
+            Patient.objects.create(name=name, eav__age=age, eav__city=city,
+                                   eav__country=country)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def names(self, qs):
+        return sorted(qs.values_list('name', flat=True))
+
+    def test_and(self):
+        q = Q(eav__country='Mali') & Q(eav__age=15)
+        self.assertEqual(self.names(Patient.objects.filter(q)), ['Fred'])
+        self.assertEqual(self.names(Patient.objects.filter(
+                            eav__country='Mali', eav__age__lt=15)), ['Bob'])
+
+    def test_or_and_not(self):
+        q = (Q(eav__city='Bamako') | Q(eav__country='France')) & \
+            ~Q(eav__age__gt=10)
+        self.assertEqual(self.names(Patient.objects.filter(q)),
+                         ['Beth', 'Joe'])
+
+    def test_exclude(self):
+        q = Q(eav__country='Mali') & Q(eav__age=15)
+        self.assertEqual(self.names(Patient.objects.exclude(q)),
+                         ['Beth', 'Bob', 'Joe', 'Jose'])
+        # entities without a value aren't matched by the condition
+        self.assertEqual(self.names(Patient.objects.exclude(eav__age__lt=13)),
+                         ['Beth', 'Fred', 'Jose'])
+
+    def test_q_is_not_modified(self):
+        q = Q(eav__country='Mali') | Q(name='Joe')
+        children = list(q.children)
+        Patient.objects.filter(q).count()
+        self.assertEqual(q.children, children)
+        self.assertEqual(Patient.objects.filter(q).count(), 3)
+
+    def test_leaves_are_semijoins(self):
+        q = (Q(eav__city='Bamako') | Q(eav__country='France')) & \
+            ~Q(eav__age__gt=10)
+        query = Patient.objects.filter(q).query
+        sql = str(query)
+        # no join: one subquery on eav_value per leaf
+        self.assertEqual(len([t for t in query.tables \
+                              if query.alias_refcount[t]]), 1)
+        self.assertEqual(sql.count('FROM "eav_value"'), 3)
+        self.assertFalse('DISTINCT' in sql)
+
+
+class OrderByEav(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        self.yes = EnumValue.objects.create(value='yes')
+        self.no = EnumValue.objects.create(value='no')
+        yn = EnumGroup.objects.create(name='Yes / No')
+        yn.enums.add(self.yes, self.no)
+        Attribute.objects.create(name='fever', datatype=Attribute.TYPE_ENUM,
+                                 enum_group=yn)
+
+        data = [
+        #       Name    Age   City        Fever
+            [   'Bob',  12,   'Bamako',   self.yes],
+            [   'Fred', 15,   'Bamako',   self.no ],
+            [   'Jose', 15,   'Kisumu',   None    ],
+            [   'Joe',  None, 'Nice',     self.yes],
+            [   'Beth', 2,    None,       self.no ],
+        ]
+        for name, age, city, fever in data:
+            Patient.objects.create(name=name, eav__age=age, eav__city=city,
+                                   eav__fever=fever)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def names(self, qs):
+        return [p.name for p in qs]
+
+    def test_order_by(self):
+        self.assertEqual(self.names(Patient.objects.order_by('eav__age',
+                                                             'name')),
+                         ['Beth', 'Bob', 'Fred', 'Jose', 'Joe'])
+        self.assertEqual(self.names(Patient.objects.order_by('-eav__age',
+                                                             '-eav__city')),
+                         ['Jose', 'Fred', 'Bob', 'Beth', 'Joe'])
+
+    def test_nulls_last(self):
+        self.assertEqual(self.names(Patient.objects.order_by('-eav__city',
+                                                             'name'))[-1],
+                         'Beth')
+        self.assertEqual(self.names(Patient.objects.order_by('eav__city',
+                                                             'name'))[-1],
+                         'Beth')
+
+    def test_enum_sorts_on_text(self):
+        self.assertEqual(self.names(Patient.objects.order_by('eav__fever',
+                                                             'name')),
+                         ['Beth', 'Fred', 'Bob', 'Joe', 'Jose'])
+
+    def test_sorted_and_sliced_in_database(self):
+        qs = Patient.objects.filter(eav__city='Bamako').order_by('-eav__age')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.names(qs[:1]), ['Fred'])
+        qs = Patient.objects.order_by('eav__age', 'name')[1:3]
+        self.assertEqual(self.names(qs), ['Bob', 'Fred'])
+
+
+class AggregateEav(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='height', datatype=Attribute.TYPE_FLOAT)
+        Attribute.objects.create(name='weight', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='country', datatype=Attribute.TYPE_TEXT)
+        self.yes = EnumValue.objects.create(value='yes')
+        self.no = EnumValue.objects.create(value='no')
+        yn = EnumGroup.objects.create(name='Yes / No')
+        yn.enums.add(self.yes, self.no)
+        Attribute.objects.create(name='fever', datatype=Attribute.TYPE_ENUM,
+                                 enum_group=yn)
+
+        data = [
+        #       Name    Height  Weight  Country  Fever
+            [   'Bob',  1.5,    50,     'Mali',  self.yes],
+            [   'Fred', 1.7,    70,     'Mali',  self.no ],
+            [   'Jose', 1.9,    None,   'Kenya', self.yes],
+            [   'Joe',  None,   20,     'Kenya', self.yes],
+        ]
+        for name, height, weight, country, fever in data:
+            Patient.objects.create(name=name, eav__height=height,
+                                   eav__weight=weight, eav__country=country,
+                                   eav__fever=fever)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_aggregate(self):
+        with self.assertNumQueries(1):
+            result = Patient.objects.aggregate(Avg('eav__height'),
+                                               Count('eav__weight'),
+                                               total=Sum('eav__weight'),
+                                               people=Count('pk'))
+        self.assertAlmostEqual(result['eav__height__avg'], 1.7)
+        self.assertEqual(result['eav__weight__count'], 3)
+        self.assertEqual(result['total'], 140)
+        self.assertEqual(result['people'], 4)
+        self.assertEqual(Patient.objects.filter(eav__country='Mali') \
+                                        .aggregate(Max('eav__weight')),
+                         {'eav__weight__max': 70})
+
+    def test_values(self):
+        rows = Patient.objects.order_by('name').values('name', 'eav__weight')
+        self.assertEqual(list(rows)[:2],
+                         [{'name': 'Bob', 'eav__weight': 50},
+                          {'name': 'Fred', 'eav__weight': 70}])
+        self.assertEqual(list(Patient.objects.order_by('name') \
+                                     .values_list('eav__fever', flat=True)),
+                         ['yes', 'no', 'yes', 'yes'])
+
+    def test_group_by(self):
+        with self.assertNumQueries(1):
+            rows = list(Patient.objects.values('eav__country') \
+                                       .annotate(Count('pk')) \
+                                       .order_by('eav__country'))
+        self.assertEqual(rows, [{'eav__country': 'Kenya', 'pk__count': 2},
+                                {'eav__country': 'Mali', 'pk__count': 2}])
+
+        rows = Patient.objects.values('eav__fever') \
+                              .annotate(weight=Sum('eav__weight')) \
+                              .order_by('eav__fever')
+        self.assertEqual(list(rows), [{'eav__fever': 'no', 'weight': 70},
+                                      {'eav__fever': 'yes', 'weight': 70}])
+
+    def test_annotate(self):
+        p = Patient.objects.annotate(Max('eav__height')).get(name='Fred')
+        self.assertAlmostEqual(p.eav__height__max, 1.7)
+
+
+class ValuesEav(TestCase):
+
+    def setUp(self):
+        eav.register(Encounter)
+        eav.register(Patient)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        Attribute.objects.create(name='alive', datatype=Attribute.TYPE_BOOLEAN)
+        self.yes = EnumValue.objects.create(value='yes')
+        self.no = EnumValue.objects.create(value='no')
+        yn = EnumGroup.objects.create(name='Yes / No')
+        yn.enums.add(self.yes, self.no)
+        Attribute.objects.create(name='fever', datatype=Attribute.TYPE_ENUM,
+                                 enum_group=yn)
+
+        self.bob = Patient.objects.create(name='Bob', eav__age=12,
+                                          eav__city='Bamako',
+                                          eav__alive=True, eav__fever=self.no)
+        self.fred = Patient.objects.create(name='Fred', eav__age=15,
+                                           eav__alive=False,
+                                           eav__fever=self.yes)
+        self.joe = Patient.objects.create(name='Joe')
+        Encounter.objects.create(num=1, patient=self.fred)
+
+    def tearDown(self):
+        eav.unregister(Encounter)
+        eav.unregister(Patient)
+
+    def test_dicts(self):
+        with self.assertNumQueries(1):
+            rows = Patient.objects.order_by('name') \
+                          .values_eav('age', 'city', 'alive', 'fever',
+                                      include=['id', 'name'])
+        self.assertEqual(rows, [
+            {'id': self.bob.pk, 'name': 'Bob', 'age': 12, 'city': 'Bamako',
+             'alive': True, 'fever': 'no'},
+            {'id': self.fred.pk, 'name': 'Fred', 'age': 15, 'city': None,
+             'alive': False, 'fever': 'yes'},
+            {'id': self.joe.pk, 'name': 'Joe', 'age': None, 'city': None,
+             'alive': None, 'fever': None}])
+
+    def test_tuples(self):
+        rows = Patient.objects.order_by('-name') \
+                      .values_eav('age', include=['name'], tuples=True)
+        self.assertEqual(rows, [('Joe', None), ('Fred', 15), ('Bob', 12)])
+
+    def test_filtered_ordered_and_sliced(self):
+        self.assertEqual(Patient.objects.filter(eav__age__gt=0) \
+                                .values_eav('age', tuples=True),
+                         [(12,), (15,)])
+        self.assertEqual(Patient.objects.filter(encounter__num=1) \
+                                .values_eav('age', tuples=True), [(15,)])
+        rows = Patient.objects.order_by('-eav__age') \
+                              .values_eav('city', include=['name'])[:2]
+        self.assertEqual(rows, [{'name': 'Fred', 'city': None},
+                                {'name': 'Bob', 'city': 'Bamako'}])
+        self.assertEqual(Patient.objects.order_by('name')[1:] \
+                                .values_eav(include=['name'], tuples=True),
+                         [('Fred',), ('Joe',)])
+        self.assertEqual(Patient.objects.filter(pk__in=[]).values_eav('age'),
+                         [])
+
+    def test_slice_by_the_compiler(self):
+        qs = Patient.objects.order_by('-eav__age', 'name')[1:3]
+        self.assertEqual(qs.values_eav('age', include=['name'], tuples=True),
+                         [('Bob', 12), ('Joe', None)])
+        self.assertEqual(Patient.objects.order_by('name')[2:] \
+                                .values_eav('age', tuples=True), [(None,)])
+
+    def test_value_sql_alias(self):
+        age = Attribute.objects.get(slug='age')
+        sql, params = eav_value_sql(Patient, age, connection, 'U0')
+        self.assertTrue('U0.%s' % connection.ops.quote_name('id') in sql)
+        self.assertFalse(Patient._meta.db_table in sql)
+
+
+class FilterPlanCaching(TestCase):
+
+    def setUp(self):
+        eav.register(Encounter)
+        eav.register(Patient)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        p = Patient.objects.create(name='Bob', eav__age=5, eav__city='Nice')
+        Encounter.objects.create(num=1, patient=p, eav__age=40)
+
+    def tearDown(self):
+        eav.unregister(Encounter)
+        eav.unregister(Patient)
+
+    def test_plans_are_reused(self):
+        Patient.objects.filter(eav__age=5, encounter__eav__age=40)
+        hits, misses = filter_plans.hits, filter_plans.misses
+        with self.assertNumQueries(0):
+            qs = Patient.objects.filter(eav__age=6, encounter__eav__age=40)
+        self.assertEqual(filter_plans.misses, misses)
+        self.assertTrue(filter_plans.hits > hits)
+        self.assertTrue(0 < filter_plans.hit_rate <= 1)
+        self.assertEqual(qs.count(), 0)
+        self.assertEqual(Patient.objects.filter(
+                            eav__age=5, encounter__eav__age=40).count(), 1)
+
+    def test_schema_change_invalidates(self):
+        self.assertEqual(Patient.objects.filter(eav__city='Nice').count(), 1)
+        Attribute.objects.get(slug='city').delete()
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_INT)
+        Patient.objects.create(name='Joe', eav__city=3)
+        self.assertEqual(Patient.objects.filter(eav__city=3).count(), 1)
+
+    def test_unregister_invalidates(self):
+        Patient.objects.filter(name='Bob', eav__age=5)
+        eav.unregister(Patient)
+        self.assertRaises(FieldError, Patient.objects.filter,
+                          eav__age=5)
+
+
+class PrefetchEav(TestCase):
+
+    def setUp(self):
+        eav.register(Encounter)
+        eav.register(Patient)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+
+        for i in range(5):
+            p = Patient.objects.create(name='P%d' % i, eav__age=i,
+                                       eav__city='City %d' % i)
+            Encounter.objects.create(num=i, patient=p, eav__age=i + 10)
+
+    def tearDown(self):
+        eav.unregister(Encounter)
+        eav.unregister(Patient)
+
+    def test_prefetch_all_values(self):
+        with self.assertNumQueries(2):
+            patients = list(Patient.objects.prefetch_eav())
+            self.assertEqual([p.eav.age for p in patients], range(5))
+            self.assertEqual([p.eav.city for p in patients],
+                             ['City %d' % i for i in range(5)])
+
+    def test_prefetch_some_values(self):
+        patients = Patient.objects.filter(name__startswith='P') \
+                                  .prefetch_eav('age')
+        with self.assertNumQueries(2):
+            self.assertEqual(sorted(p.eav.age for p in patients), range(5))
+        # city wasn't prefetched, so it is loaded per instance
+        with self.assertNumQueries(1):
+            self.assertEqual(patients[0].eav.city, 'City 0')
+
+    def test_prefetch_unset_value(self):
+        Patient.objects.create(name='Jon')
+        p = Patient.objects.filter(name='Jon').prefetch_eav('age')[0]
+        p.eav.get_all_attributes()
+        with self.assertNumQueries(0):
+            self.assertEqual(p.eav.age, None)
+
+    def test_prefetch_through_select_related(self):
+        qs = Encounter.objects.select_related('patient') \
+                              .prefetch_eav('age', 'patient__eav__age')
+        with self.assertNumQueries(3):
+            encounters = list(qs)
+            self.assertEqual([e.eav.age for e in encounters],
+                             range(10, 15))
+            self.assertEqual([e.patient.eav.age for e in encounters],
+                             range(5))
+
+    def test_prefetch_through_prefetch_related(self):
+        qs = Patient.objects.prefetch_related('encounter_set') \
+                            .prefetch_eav('encounter_set__eav')
+        with self.assertNumQueries(3):
+            ages = [e.eav.age for p in qs for e in p.encounter_set.all()]
+        self.assertEqual(sorted(ages), range(10, 15))
+
+
+class IterEav(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        Patient.objects.bulk_create_with_eav([
+            {'name': 'P%d' % i, 'eav__age': i, 'eav__city': 'City %d' % i} \
+            for i in range(10)])
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_iter_eav(self):
+        # two queries for each of the chunks of 4, 4 and 2 entities
+        with self.assertNumQueries(6):
+            ages = [p.eav.age for p in Patient.objects.order_by('-name') \
+                                                      .iter_eav(chunk_size=4)]
+        self.assertEqual(ages, range(10))
+
+    def test_iter_eav_filtered_and_some_slugs(self):
+        qs = Patient.objects.filter(eav__age__gte=5)
+        patients = list(qs.iter_eav('city', chunk_size=2))
+        self.assertEqual([p.name for p in patients],
+                         ['P%d' % i for i in range(5, 10)])
+        with self.assertNumQueries(0):
+            self.assertEqual(patients[0].eav.city, 'City 5')
+        self.assertFalse(qs._result_cache)
+
+    def test_iter_eav_slice(self):
+        self.assertRaises(AssertionError, list,
+                          Patient.objects.all()[:5].iter_eav())
+
+
+class UpdateEav(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='country', datatype=Attribute.TYPE_TEXT)
+        Attribute.objects.create(name='region', datatype=Attribute.TYPE_TEXT)
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+
+        for i in range(4):
+            Patient.objects.create(name='Mali %d' % i, eav__country='Mali')
+        p = Patient.objects.get(name='Mali 0')
+        p.eav.region = 'Sahel'
+        p.save()
+        Patient.objects.create(name='Kenya', eav__country='Kenya',
+                               eav__region='East Africa')
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_update_eav(self):
+        qs = Patient.objects.filter(eav__country='Mali')
+        self.assertEqual(qs.update_eav(region='West Africa'), 4)
+        self.assertEqual(Patient.objects.filter(
+                            eav__region='West Africa').count(), 4)
+        self.assertEqual(Patient.objects.get(name='Kenya').eav.region,
+                         'East Africa')
+        self.assertEqual(Value.objects.filter(
+                            attribute__slug='region').count(), 5)
+
+    def test_statement_count(self):
+        Patient.objects.create(name='Mali 4', eav__country='Mali')
+        qs = Patient.objects.filter(eav__country='Mali')
+        schema.get_attributes()
+        # the primary keys, UPDATE and INSERT
+        with self.assertNumQueries(3):
+            self.assertEqual(qs.update_eav(age=3), 5)
+        with self.assertNumQueries(5):
+            qs.update_eav(age=4, region='West Africa')
+        self.assertEqual([p.eav.age for p in qs], [4] * 5)
+
+    def test_update_eav_without_self_select(self):
+        # as on MySQL, the primary keys are read first
+        features = connection.features
+        features.update_can_self_select = False
+        try:
+            qs = Patient.objects.filter(eav__region='Sahel')
+            self.assertEqual(qs.update_eav(region=None, age=5), 1)
+            self.assertEqual(qs.update_eav(age=6), 0)
+        finally:
+            del features.update_can_self_select
+        self.assertEqual(Patient.objects.get(name='Mali 0').eav.age, 5)
+        self.assertEqual(Patient.objects.filter(eav__region='Sahel').count(),
+                         0)
+
+    def test_update_filtered_attribute(self):
+        qs = Patient.objects.filter(eav__region='Sahel')
+        self.assertEqual(qs.update_eav(region=None, age=5), 1)
+        self.assertEqual(Patient.objects.get(name='Mali 0').eav.age, 5)
+
+        qs = Patient.objects.filter(eav__country='Mali')
+        self.assertEqual(qs.update_eav(country='Senegal',
+                                       region='West Africa', age=7), 4)
+        self.assertEqual(Patient.objects.filter(eav__country='Senegal',
+                                                eav__region='West Africa',
+                                                eav__age=7).count(), 4)
+
+    def test_update_eav_in_batches(self):
+        qs = Patient.objects.filter(eav__country='Mali')
+        batch_size = managers.PREFETCH_BATCH_SIZE
+        managers.PREFETCH_BATCH_SIZE = 3
+        try:
+            self.assertEqual(qs.update_eav(country='Senegal', age=7), 4)
+        finally:
+            managers.PREFETCH_BATCH_SIZE = batch_size
+        self.assertEqual(Patient.objects.filter(eav__country='Senegal',
+                                                eav__age=7).count(), 4)
+
+    def test_update_eav_to_none(self):
+        self.assertEqual(Patient.objects.update_eav(region=None), 5)
+        self.assertEqual(Value.objects.filter(
+                            attribute__slug='region').count(), 0)
+        self.assertEqual(Value.objects.count(), 5)
+
+    def test_update_eav_validates(self):
+        self.assertRaises(ValidationError, Patient.objects.update_eav,
+                          age='old')
+
+
+class EavFacets(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='country', datatype=Attribute.TYPE_TEXT)
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        self.yes = EnumValue.objects.create(value='yes')
+        self.no = EnumValue.objects.create(value='no')
+        yn = EnumGroup.objects.create(name='Yes / No')
+        yn.enums.add(self.yes, self.no)
+        Attribute.objects.create(name='fever', datatype=Attribute.TYPE_ENUM,
+                                 enum_group=yn)
+
+        for i, age in enumerate([3, 12, 18, 40, 70]):
+            Patient.objects.create(name='Mali %d' % i, eav__country='Mali',
+                                   eav__age=age,
+                                   eav__fever=self.yes if i % 2 else self.no)
+        Patient.objects.create(name='Kenya', eav__country='Kenya',
+                               eav__age=30, eav__fever=self.yes)
+        Patient.objects.create(name='Nobody')
+
+    def tearDown(self):
+        eav.unregister(Patient)
+        cache.clear()
+
+    def test_eav_facets(self):
+        self.assertEqual(Patient.objects.eav_facets('country', 'fever'),
+                         {'country': {'Mali': 5, 'Kenya': 1},
+                          'fever': {'yes': 3, 'no': 3}})
+        facets = Patient.objects.filter(eav__country='Mali') \
+                                .eav_facets('fever', age=[0, 18, 65])
+        self.assertEqual(facets, {'fever': {'yes': 2, 'no': 3},
+                                  'age': {(0, 18): 2, (18, 65): 2,
+                                          (65, None): 1}})
+
+    def test_eav_facets_below_first_bound(self):
+        facets = Patient.objects.eav_facets(age=[18, 100])
+        self.assertEqual(facets['age'], {(None, 18): 2, (18, 100): 4,
+                                         (100, None): 0})
+
+    def test_eav_facets_empty(self):
+        facets = Patient.objects.filter(name='Nobody') \
+                                .eav_facets('country', age=[18])
+        self.assertEqual(facets, {'country': {},
+                                  'age': {(18, None): 0}})
+
+    def test_eav_facets_query_count(self):
+        qs = Patient.objects.filter(eav__country='Mali')
+        schema.get_attributes()
+        with self.assertNumQueries(2):
+            qs.eav_facets('country', age=[18])
+
+    def test_eav_facets_cache(self):
+        qs = Patient.objects.filter(eav__country='Mali')
+        facets = qs.eav_facets('country', age=[18], cache_timeout=60)
+        with self.assertNumQueries(0):
+            self.assertEqual(qs.eav_facets('country', age=[18],
+                                           cache_timeout=60), facets)
+        # another filter isn't read from the cache
+        self.assertEqual(Patient.objects.filter(eav__country='Kenya') \
+                                .eav_facets('country', age=[18],
+                                            cache_timeout=60),
+                         {'country': {'Kenya': 1}, 'age': {(18, None): 1}})
+
+    def test_eav_facets_cache_shared_version(self):
+        qs = Patient.objects.filter(eav__country='Mali')
+        qs.eav_facets('country', cache_timeout=60)
+        # another process changed the schema: this one hasn't synced yet
+        cache.incr('eav_schema_version')
+        with self.assertNumQueries(1):
+            qs.eav_facets('country', cache_timeout=60)
@@ -0,0 +1,216 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+from django.db import connection
+from django.core.exceptions import ValidationError
+
+import eav
+from ..models import Attribute, EnumValue, EnumGroup, Value
+from ..schema import schema, AttributeSchema
+
+from .models import Patient
+
+
+class SchemaCache(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='Age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='City', datatype=Attribute.TYPE_TEXT)
+        Patient.objects.create(name='Bob', eav__age=5, eav__city='Nice')
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_lookups_dont_query(self):
+        schema.get_attributes()
+        with self.assertNumQueries(0):
+            self.assertEqual(schema.get_attribute('age').datatype,
+                             Attribute.TYPE_INT)
+            self.assertEqual([a.slug for a in schema.get_attributes()],
+                             ['age', 'city'])
+            self.assertRaises(Attribute.DoesNotExist,
+                              schema.get_attribute, 'weight')
+
+    def test_entity_attributes_dont_query(self):
+        p = Patient.objects.get(name='Bob')
+        schema.get_attributes()
+        with self.assertNumQueries(1):
+            self.assertEqual(p.eav.age, 5)
+            self.assertEqual(p.eav.get_all_attribute_slugs(), ['age', 'city'])
+        p = Patient.objects.create(name='Jon')
+        with self.assertNumQueries(1):
+            self.assertEqual(p.eav.age, None)
+            self.assertEqual(p.eav.city, None)
+
+    def test_filter_doesnt_query_schema(self):
+        schema.get_attributes()
+        with self.assertNumQueries(1):
+            self.assertEqual(Patient.objects.filter(eav__age=5).count(), 1)
+
+    def test_invalidation(self):
+        version = schema.version
+        self.assertEqual(len(schema.get_attributes()), 2)
+        a = Attribute.objects.create(name='Weight',
+                                     datatype=Attribute.TYPE_FLOAT)
+        self.assertTrue(schema.version > version)
+        self.assertEqual(len(schema.get_attributes()), 3)
+        a.delete()
+        self.assertEqual(len(schema.get_attributes()), 2)
+
+        group = EnumGroup.objects.create(name='Yes / No')
+        a = Attribute.objects.create(name='Fever', enum_group=group,
+                                     datatype=Attribute.TYPE_ENUM)
+        self.assertEqual(schema.get_attribute('fever').enum_group.name,
+                         'Yes / No')
+        group.name = 'Yes or No'
+        group.save()
+        self.assertEqual(schema.get_attribute('fever').enum_group.name,
+                         'Yes or No')
+
+    def test_parent_attributes(self):
+        Attribute.objects.create(name='Age', parent=Patient,
+                                 datatype=Attribute.TYPE_FLOAT)
+        self.assertEqual(schema.get_attribute('age').datatype,
+                         Attribute.TYPE_INT)
+        self.assertEqual(schema.get_attribute('age', Patient).datatype,
+                         Attribute.TYPE_FLOAT)
+        self.assertEqual(len(schema.get_attributes(Patient)), 3)
+
+
+class EnumChoicesCache(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        self.yes = EnumValue.objects.create(value='yes')
+        self.no = EnumValue.objects.create(value='no')
+        self.maybe = EnumValue.objects.create(value='maybe')
+        self.ynu = EnumGroup.objects.create(name='Yes / No')
+        self.ynu.enums.add(self.yes, self.no)
+        self.fever = Attribute.objects.create(name='Fever',
+                                              datatype=Attribute.TYPE_ENUM,
+                                              enum_group=self.ynu)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_enum_maps(self):
+        self.assertEqual(schema.get_enum_ids(self.ynu.pk),
+                         frozenset([self.yes.pk, self.no.pk]))
+        self.assertEqual(schema.get_enum_values(self.ynu.pk),
+                         {'yes': self.yes, 'no': self.no})
+        self.assertEqual(schema.get_enum(self.ynu.pk, self.no.pk), self.no)
+        self.assertEqual(schema.get_enum(self.ynu.pk, self.maybe.pk), None)
+
+    def test_validation_doesnt_query(self):
+        fever = schema.get_attribute('fever')
+        fever.validate_value(self.yes)
+        with self.assertNumQueries(0):
+            fever.validate_value(self.no)
+            self.assertRaises(ValidationError, fever.validate_value,
+                              self.maybe)
+
+    def test_invalidated_by_m2m_changes(self):
+        fever = schema.get_attribute('fever')
+        self.assertRaises(ValidationError, fever.validate_value, self.maybe)
+        self.ynu.enums.add(self.maybe)
+        fever.validate_value(self.maybe)
+        self.ynu.enums.remove(self.maybe)
+        self.assertRaises(ValidationError, fever.validate_value, self.maybe)
+        self.ynu.enums.clear()
+        self.assertEqual(schema.get_enum_ids(self.ynu.pk), frozenset())
+
+    def test_value_clean(self):
+        p = Patient.objects.create(name='Bob', eav__fever=self.yes)
+        v = Value(entity=p, attribute=self.fever, value_enum=self.maybe)
+        self.assertRaises(ValidationError, v.clean)
+        v.value_enum = self.no
+        v.clean()
+
+
+class SharedSchemaVersion(TestCase):
+    '''
+    The schema of another process is played by another AttributeSchema
+    sharing the (local memory) cache.
+    '''
+
+    def setUp(self):
+        Attribute.objects.create(name='Age', datatype=Attribute.TYPE_INT)
+        self.other = AttributeSchema()
+
+    def slugs(self, other):
+        return [a.slug for a in other.get_attributes()]
+
+    @override_settings(EAV_SCHEMA_CHECK_INTERVAL=None)
+    def test_sync_reloads_only_when_changed(self):
+        self.assertEqual(self.slugs(self.other), ['age'])
+        version = self.other.version
+        self.other.sync()
+        self.assertEqual(self.other.version, version)
+
+        Attribute.objects.create(name='City', datatype=Attribute.TYPE_TEXT)
+        self.assertEqual(self.slugs(self.other), ['age'])
+        self.other.sync()
+        self.assertEqual(self.slugs(self.other), ['age', 'city'])
+        # this process' own change doesn't reload it
+        self.assertEqual(schema.shared_version, self.other.shared_version)
+        version = schema.version
+        schema.sync()
+        self.assertEqual(schema.version, version)
+
+    @override_settings(EAV_SCHEMA_CHECK_INTERVAL=0)
+    def test_check_interval(self):
+        self.assertEqual(self.slugs(self.other), ['age'])
+        Attribute.objects.create(name='City', datatype=Attribute.TYPE_TEXT)
+        self.assertEqual(self.slugs(self.other), ['age', 'city'])
+
+    def test_request_started(self):
+        schema.get_attributes()
+        version = schema.version
+        request_started.send(sender=None)
+        self.assertEqual(schema.version, version)
+        self.other.clear()
+        request_started.send(sender=None)
+        self.assertEqual(schema.version, version + 1)
+
+    @override_settings(EAV_SCHEMA_CHECK_INTERVAL=None)
+    def test_evicted_version(self):
+        self.assertEqual(self.slugs(self.other), ['age'])
+        cache.delete('eav_schema_version')
+        version = self.other.version
+        self.other.sync()
+        self.assertEqual(self.other.version, version + 1)
+
+    @override_settings(EAV_SCHEMA_CHECK_INTERVAL=None)
+    def test_published_after_commit(self):
+        self.assertEqual(self.slugs(self.other), ['age'])
+        Attribute.objects.create(name='City', datatype=Attribute.TYPE_TEXT)
+        # the other process syncs before the change is committed
+        self.other.sync()
+        self.other.get_attributes()
+        version = self.other.version
+        request_finished.send(sender=None)
+        self.other.sync()
+        self.assertEqual(self.other.version, version)
+
+        # as if the test's transaction had been committed
+        connection.transaction_state.append(False)
+        try:
+            request_finished.send(sender=None)
+        finally:
+            connection.transaction_state.pop()
+        self.other.sync()
+        self.assertEqual(self.other.version, version + 1)
+        version = schema.version
+        schema.publish()
+        self.assertEqual(schema.version, version)
+
+    @override_settings(EAV_SCHEMA_CHECK_INTERVAL=None, EAV_SCHEMA_MAX_AGE=0)
+    def test_max_age(self):
+        self.assertEqual(self.slugs(self.other), ['age'])
+        version = self.other.version
+        self.other.sync()
+        self.assertEqual(self.other.version, version + 1)
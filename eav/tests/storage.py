@@ -0,0 +1,231 @@
+from datetime import datetime
+
+from django.test import TestCase
+from django.db import connection
+from django.db.models.signals import pre_save
+from django.core.management import call_command
+from django.db.models import Avg
+from django.utils import simplejson
+from django.utils.unittest import skipUnless
+
+import eav
+from ..registry import EavConfig
+from ..models import Attribute, Value, EnumValue, EnumGroup, ValueDocument
+from ..storage import JsonStorage, RowStorage, get_storage
+
+from .models import Patient
+
+
+class PatientJsonConfig(EavConfig):
+    storage_class = JsonStorage
+
+
+class Storage(TestCase):
+
+    def test_default_storage(self):
+        eav.register(Patient)
+        try:
+            self.assertTrue(isinstance(get_storage(Patient), RowStorage))
+        finally:
+            eav.unregister(Patient)
+        eav.register(Patient, PatientJsonConfig)
+        try:
+            self.assertTrue(isinstance(get_storage(Patient), JsonStorage))
+        finally:
+            eav.unregister(Patient)
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'),
+            'JsonStorage needs SQLite or PostgreSQL')
+class JsonValues(TestCase):
+
+    def setUp(self):
+        eav.register(Patient, PatientJsonConfig)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        Attribute.objects.create(name='height', datatype=Attribute.TYPE_FLOAT)
+        Attribute.objects.create(name='seen', datatype=Attribute.TYPE_DATE)
+        Attribute.objects.create(name='alive',
+                                 datatype=Attribute.TYPE_BOOLEAN)
+        Attribute.objects.create(name='doctor',
+                                 datatype=Attribute.TYPE_OBJECT)
+        self.yes = EnumValue.objects.create(value='yes')
+        self.no = EnumValue.objects.create(value='no')
+        yn = EnumGroup.objects.create(name='Yes / No')
+        yn.enums.add(self.yes, self.no)
+        Attribute.objects.create(name='fever', datatype=Attribute.TYPE_ENUM,
+                                 enum_group=yn)
+
+        self.doc = Patient.objects.create(name='Doc')
+        Patient.objects.create(name='Bob', eav__age=12, eav__city='Bamako',
+                               eav__height=1.5, eav__alive=True,
+                               eav__seen=datetime(2012, 3, 4),
+                               eav__fever=self.yes, eav__doctor=self.doc)
+        Patient.objects.create(name='Fred', eav__age=15, eav__city='Nice',
+                               eav__alive=False)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def names(self, qs):
+        return sorted(p.name for p in qs)
+
+    def test_values_stored_in_documents(self):
+        self.assertEqual(Value.objects.count(), 0)
+        self.assertEqual(ValueDocument.objects.count(), 2)
+        data = simplejson.loads(ValueDocument.objects.get(
+                    entity_id=Patient.objects.get(name='Fred').pk).data)
+        self.assertEqual(sorted(data.values()), [False, 15, 'Nice'])
+
+        p = Patient.objects.get(name='Bob')
+        # all the values are one row
+        with self.assertNumQueries(1):
+            self.assertEqual(p.eav.age, 12)
+            self.assertEqual(p.eav.city, 'Bamako')
+            self.assertEqual(p.eav.height, 1.5)
+            self.assertEqual(p.eav.seen, datetime(2012, 3, 4))
+            self.assertEqual(p.eav.alive, True)
+            self.assertEqual(p.eav.fever, self.yes)
+        self.assertEqual(p.eav.doctor, self.doc)
+
+    def test_save(self):
+        p = Patient.objects.get(name='Bob')
+        self.assertEqual(p.eav.age, 12)
+        p.eav.age = 13
+        p.eav.city = None
+        p.eav.fever = self.no
+        # one UPDATE merging the changes into the loaded document
+        with self.assertNumQueries(1):
+            p.eav.save()
+        self.assertEqual((p.eav.age, p.eav.city, p.eav.fever),
+                         (13, None, self.no))
+        p = Patient.objects.get(name='Bob')
+        self.assertEqual((p.eav.age, p.eav.city, p.eav.fever),
+                         (13, None, self.no))
+
+        self.assertEqual(Attribute.objects.get(slug='age') \
+                                          .save_value(p, 14).value, 14)
+        self.assertEqual(Attribute.objects.get(slug='age') \
+                                          .save_value(p, None), None)
+        p.eav.refresh()
+        self.assertEqual(p.eav.age, None)
+
+        self.doc.eav.city = 'Paris'
+        self.doc.save()
+        self.assertEqual(ValueDocument.objects.count(), 3)
+
+    def test_create_merges_into_a_concurrent_document(self):
+        ann = Patient.objects.create(name='Ann')
+        city = Attribute.objects.get(slug='city')
+
+        def create_first(sender, instance, **kwargs):
+            pre_save.disconnect(create_first, sender=ValueDocument)
+            ValueDocument.objects.bulk_create([ValueDocument(
+                    entity_ct=instance.entity_ct, entity_id=ann.pk,
+                    data=simplejson.dumps({str(city.pk): 'Paris'}))])
+
+        pre_save.connect(create_first, sender=ValueDocument)
+        try:
+            ann.eav.age = 5
+            ann.save()
+        finally:
+            pre_save.disconnect(create_first, sender=ValueDocument)
+        ann = Patient.objects.get(name='Ann')
+        self.assertEqual((ann.eav.age, ann.eav.city), (5, 'Paris'))
+        self.assertEqual(ValueDocument.objects.filter(entity_id=ann.pk) \
+                                              .count(), 1)
+
+    def test_migrate_to_rows_and_back(self):
+        def values(name):
+            # dates are naive in documents and aware in rows
+            return dict((v.attribute.slug, v.value.replace(tzinfo=None) \
+                         if isinstance(v.value, datetime) else v.value)
+                        for v in Patient.objects.get(name=name).eav)
+
+        bob = values('Bob')
+        eav.unregister(Patient)
+        eav.register(Patient)
+        call_command('migrate_eav_values', 'eav.Patient', batch_size=1,
+                     verbosity=0)
+        self.assertEqual(ValueDocument.objects.count(), 0)
+        self.assertEqual(Value.objects.count(), 10)
+        self.assertEqual(values('Bob'), bob)
+
+        eav.unregister(Patient)
+        eav.register(Patient, PatientJsonConfig)
+        fred = Patient.objects.get(name='Fred')
+        fred.eav.age = 40
+        fred.save()
+        call_command('migrate_eav_values', 'eav.Patient', batch_size=3,
+                     verbosity=0)
+        self.assertEqual(Value.objects.count(), 0)
+        self.assertEqual(ValueDocument.objects.count(), 2)
+        self.assertEqual(values('Bob'), bob)
+        fred = Patient.objects.get(name='Fred')
+        self.assertEqual((fred.eav.age, fred.eav.city, fred.eav.alive),
+                         (40, 'Nice', False))
+
+    def test_filters(self):
+        self.assertEqual(self.names(Patient.objects.filter(eav__age__gt=12)),
+                         ['Fred'])
+        self.assertEqual(self.names(Patient.objects.filter(
+                                        eav__city__startswith='Ba')), ['Bob'])
+        self.assertEqual(self.names(Patient.objects.filter(
+                                        eav__height__lte=2.0)), ['Bob'])
+        self.assertEqual(self.names(Patient.objects.filter(
+                                        eav__seen__year=2012)), ['Bob'])
+        self.assertEqual(self.names(Patient.objects.filter(
+                                        eav__alive=False)), ['Fred'])
+        self.assertEqual(self.names(Patient.objects.filter(
+                                        eav__fever=self.yes)), ['Bob'])
+        self.assertEqual(self.names(Patient.objects.exclude(
+                                        eav__fever=self.yes)),
+                         ['Doc', 'Fred'])
+        self.assertEqual(self.names(Patient.objects.filter(
+                                        eav__doctor=self.doc)), ['Bob'])
+        self.assertEqual(self.names(Patient.objects.filter(
+                                        eav__age__in=[12, 15],
+                                        eav__city='Nice')), ['Fred'])
+
+    @skipUnless(connection.vendor == 'sqlite', 'checks the SQLite SQL')
+    def test_filter_uses_json_extract(self):
+        sql = str(Patient.objects.filter(eav__age__gt=5).query)
+        self.assertTrue('json_extract' in sql)
+        self.assertFalse('eav_value"' in sql)
+
+    def test_queries(self):
+        qs = Patient.objects.exclude(name='Doc')
+        self.assertEqual([p.name for p in qs.order_by('-eav__age')],
+                         ['Fred', 'Bob'])
+        self.assertEqual(qs.aggregate(Avg('eav__age')),
+                         {'eav__age__avg': 13.5})
+        self.assertEqual(qs.order_by('name').values_eav(
+                            'age', 'city', 'alive', 'fever', tuples=True),
+                         [(12, 'Bamako', True, 'yes'),
+                          (15, 'Nice', False, None)])
+        self.assertEqual(qs.eav_facets('city', 'fever', age=[13]),
+                         {'city': {'Bamako': 1, 'Nice': 1},
+                          'fever': {'yes': 1},
+                          'age': {(None, 13): 1, (13, None): 1}})
+
+    def test_prefetch(self):
+        patients = list(Patient.objects.order_by('name').prefetch_eav())
+        with self.assertNumQueries(0):
+            self.assertEqual([p.eav.age for p in patients], [12, None, 15])
+
+    def test_bulk_writes(self):
+        Patient.objects.bulk_create_with_eav([{'name': 'Jon', 'eav__age': 3,
+                                               'eav__city': 'Paris'}])
+        self.assertEqual(Patient.objects.get(eav__city='Paris').name, 'Jon')
+        self.assertEqual(Patient.objects.update_eav(age=40), 4)
+        self.assertEqual(ValueDocument.objects.count(), 4)
+        self.assertEqual(Patient.objects.filter(eav__age=40).count(), 4)
+        self.assertEqual(Patient.objects.filter(name='Jon') \
+                                        .update_eav(city=None), 1)
+        self.assertEqual(Patient.objects.get(name='Jon').eav.city, None)
+        self.assertEqual(Patient.objects.get(name='Jon').eav.age, 40)
+
+    def test_delete(self):
+        Patient.objects.get(name='Bob').delete()
+        self.assertEqual(ValueDocument.objects.count(), 1)
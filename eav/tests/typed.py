@@ -0,0 +1,139 @@
+from django.test import TestCase
+from django.db.models import Avg
+from django.core.management import call_command
+
+import eav
+from ..registry import EavConfig
+from ..models import Attribute, Value, EnumValue, EnumGroup, ValueInt, \
+                     ValueText, ValueEnum
+
+from .models import Patient
+
+
+class PatientTypedConfig(EavConfig):
+    typed_values = True
+
+
+class TypedValues(TestCase):
+
+    def setUp(self):
+        eav.register(Patient, PatientTypedConfig)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        self.yes = EnumValue.objects.create(value='yes')
+        self.no = EnumValue.objects.create(value='no')
+        yn = EnumGroup.objects.create(name='Yes / No')
+        yn.enums.add(self.yes, self.no)
+        Attribute.objects.create(name='fever', datatype=Attribute.TYPE_ENUM,
+                                 enum_group=yn)
+
+        Patient.objects.create(name='Bob', eav__age=12, eav__city='Bamako',
+                               eav__fever=self.yes)
+        Patient.objects.create(name='Fred', eav__age=15, eav__city='Nice')
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_values_stored_in_typed_tables(self):
+        self.assertEqual(Value.objects.count(), 0)
+        self.assertEqual(ValueInt.objects.count(), 2)
+        self.assertEqual(ValueText.objects.count(), 2)
+        self.assertEqual(ValueEnum.objects.get().value_enum, self.yes)
+
+        p = Patient.objects.get(name='Bob')
+        # one query per datatype
+        with self.assertNumQueries(3):
+            self.assertEqual(p.eav.age, 12)
+            self.assertEqual(p.eav.city, 'Bamako')
+            self.assertEqual(p.eav.fever, self.yes)
+
+    def test_save(self):
+        p = Patient.objects.get(name='Bob')
+        p.eav.age = 13
+        p.eav.city = None
+        p.eav.fever = self.no
+        p.save()
+        p = Patient.objects.get(name='Bob')
+        self.assertEqual((p.eav.age, p.eav.city, p.eav.fever),
+                         (13, None, self.no))
+        self.assertEqual(ValueText.objects.count(), 1)
+
+        Attribute.objects.get(slug='age').save_value(p, 14)
+        self.assertEqual(ValueInt.objects.get(entity_id=p.pk).value_int, 14)
+
+    def test_queries(self):
+        self.assertEqual([p.name for p in Patient.objects.filter(
+                                            eav__age__gt=12)], ['Fred'])
+        self.assertEqual([p.name for p in Patient.objects.exclude(
+                                            eav__fever=self.yes)], ['Fred'])
+        self.assertEqual([p.name for p in Patient.objects.order_by(
+                                            '-eav__age')], ['Fred', 'Bob'])
+        self.assertEqual(Patient.objects.aggregate(Avg('eav__age')),
+                         {'eav__age__avg': 13.5})
+        self.assertEqual(Patient.objects.order_by('name').values_eav(
+                                'age', 'city', 'fever', tuples=True),
+                         [(12, 'Bamako', 'yes'), (15, 'Nice', None)])
+        self.assertEqual(Patient.objects.eav_facets('city', age=[13]),
+                         {'city': {'Bamako': 1, 'Nice': 1},
+                          'age': {(None, 13): 1, (13, None): 1}})
+
+    def test_bulk_writes(self):
+        Patient.objects.bulk_create_with_eav([{'name': 'Jon', 'eav__age': 3,
+                                               'eav__city': 'Paris'}])
+        self.assertEqual(Patient.objects.get(eav__city='Paris').name, 'Jon')
+        self.assertEqual(Patient.objects.update_eav(age=40), 3)
+        self.assertEqual(list(ValueInt.objects.values_list('value_int',
+                                                           flat=True)),
+                         [40] * 3)
+        Patient.objects.filter(name='Jon').update_eav(city=None)
+        self.assertEqual(ValueText.objects.count(), 2)
+
+    def test_delete(self):
+        Patient.objects.get(name='Bob').delete()
+        self.assertEqual(ValueInt.objects.count(), 1)
+        self.assertEqual(ValueEnum.objects.count(), 0)
+
+
+class MigrateEavValues(TestCase):
+
+    def setUp(self):
+        eav.register(Patient)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        for i in range(5):
+            Patient.objects.create(name='P%d' % i, eav__age=i,
+                                   eav__city='City %d' % i)
+
+    def tearDown(self):
+        eav.unregister(Patient)
+
+    def test_migrate_both_ways(self):
+        eav.unregister(Patient)
+        eav.register(Patient, PatientTypedConfig)
+        call_command('migrate_eav_values', 'eav.Patient', batch_size=3,
+                     verbosity=0)
+        self.assertEqual(Value.objects.count(), 0)
+        self.assertEqual(ValueInt.objects.count(), 5)
+        self.assertEqual(ValueText.objects.count(), 5)
+        self.assertEqual(Patient.objects.get(eav__age=3).eav.city, 'City 3')
+
+        eav.unregister(Patient)
+        eav.register(Patient)
+        call_command('migrate_eav_values', verbosity=0)
+        self.assertEqual(ValueInt.objects.count(), 0)
+        self.assertEqual(Value.objects.count(), 10)
+        self.assertEqual(Patient.objects.get(eav__age=3).eav.city, 'City 3')
+
+    def test_values_written_after_the_switch_are_kept(self):
+        eav.unregister(Patient)
+        eav.register(Patient, PatientTypedConfig)
+        p = Patient.objects.get(name='P1')
+        p.eav.age = 40
+        p.save()
+        call_command('migrate_eav_values', 'eav.Patient', batch_size=3,
+                     verbosity=0)
+        self.assertEqual(Value.objects.count(), 0)
+        self.assertEqual(ValueInt.objects.count(), 5)
+        self.assertEqual(Patient.objects.get(name='P1').eav.age, 40)
@@ -0,0 +1,111 @@
+from django.test import TestCase
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import connection
+
+import eav
+from ..registry import EavConfig
+from ..models import Attribute, Value, EnumValue, EnumGroup
+from ..schema import schema
+from ..value_cache import get_value_cache
+
+from .models import Patient
+
+
+class PatientValueCacheConfig(EavConfig):
+    value_cache = True
+
+
+class ValueCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        eav.register(Patient, PatientValueCacheConfig)
+
+        Attribute.objects.create(name='age', datatype=Attribute.TYPE_INT)
+        Attribute.objects.create(name='city', datatype=Attribute.TYPE_TEXT)
+        self.yes = EnumValue.objects.create(value='yes')
+        yn = EnumGroup.objects.create(name='Yes / No')
+        yn.enums.add(self.yes)
+        Attribute.objects.create(name='fever', datatype=Attribute.TYPE_ENUM,
+                                 enum_group=yn)
+
+        Patient.objects.create(name='Bob', eav__age=12, eav__city='Bamako',
+                               eav__fever=self.yes)
+        Patient.objects.create(name='Fred', eav__age=15)
+        schema.get_attributes()
+
+    def tearDown(self):
+        eav.unregister(Patient)
+        cache.clear()
+
+    def load(self, name, queries):
+        p = Patient.objects.get(name=name)
+        with self.assertNumQueries(queries):
+            return dict((v.attribute.slug, v.value) for v in p.eav)
+
+    def test_read_through(self):
+        cache.clear()
+        self.assertEqual(self.load('Bob', 1),
+                         {'age': 12, 'city': 'Bamako', 'fever': self.yes})
+        self.assertEqual(self.load('Bob', 0),
+                         {'age': 12, 'city': 'Bamako', 'fever': self.yes})
+
+    def test_save_updates_cache(self):
+        p = Patient.objects.get(name='Bob')
+        p.eav.age = 13
+        p.eav.city = None
+        p.save()
+        self.assertEqual(self.load('Bob', 0), {'age': 13, 'fever': self.yes})
+
+        p = Patient.objects.get(name='Bob')
+        p.eav.age = 14
+        p.save()
+        self.assertEqual(self.load('Bob', 0), {'age': 14, 'fever': self.yes})
+
+    def test_writes_invalidate(self):
+        self.load('Bob', 1)
+        self.load('Bob', 0)
+        Patient.objects.update_eav(age=40)
+        self.assertEqual(self.load('Bob', 1)['age'], 40)
+        self.assertEqual(self.load('Fred', 1), {'age': 40})
+
+        Attribute.objects.get(slug='age').save_value(
+                                    Patient.objects.get(name='Fred'), 41)
+        self.assertEqual(self.load('Fred', 1), {'age': 41})
+
+        Value.objects.filter(attribute__slug='city').delete()
+        self.assertEqual(self.load('Bob', 1),
+                         {'age': 40, 'fever': self.yes})
+
+    def test_multi_get(self):
+        cache.clear()
+        list(Patient.objects.prefetch_eav())
+        with self.assertNumQueries(1):
+            patients = list(Patient.objects.order_by('name').prefetch_eav())
+            self.assertEqual([p.eav.age for p in patients], [12, 15])
+
+    def test_no_revision_until_written(self):
+        cache.clear()
+        list(Patient.objects.prefetch_eav())
+        prefix = get_value_cache(Patient).prefix
+        keys = ['%s:%s:rev' % (prefix, p.pk) for p in Patient.objects.all()]
+        self.assertEqual(cache.get_many(keys), {})
+        self.assertEqual(self.load('Fred', 0), {'age': 15})
+
+    def test_revisions_published_after_commit(self):
+        self.load('Bob', 1)
+        p = Patient.objects.get(name='Bob')
+        p.eav.age = 13
+        p.save()
+        self.load('Bob', 0)
+        request_finished.send(sender=None)
+        self.load('Bob', 0)
+
+        # as if the test's transaction had been committed
+        connection.transaction_state.append(False)
+        try:
+            request_finished.send(sender=None)
+        finally:
+            connection.transaction_state.pop()
+        self.assertEqual(self.load('Bob', 1)['age'], 13)
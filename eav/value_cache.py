@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+#
+#    This software is derived from EAV-Django originally written and
+#    copyrighted by Andrey Mikhaylenko <http://pypi.python.org/pypi/eav-django>
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+'''
+###########
+value_cache
+###########
+
+This module caches the eav values of each entity in the default Django
+cache, for registered models whose config sets
+:attr:`~eav.registry.EavConfig.value_cache`::
+
+    class ProductEavConfig(EavConfig):
+        value_cache = True
+        value_cache_timeout = 600
+
+    eav.register(Product, ProductEavConfig)
+
+The values of an :class:`~eav.models.Entity` are then read from the cache
+when they are first needed, or loaded with one query and cached on a miss.
+:meth:`Entity.prefetch_values() <eav.models.Entity.prefetch_values>` (and
+so :meth:`~eav.managers.EntityQuerySet.prefetch_eav`) reads all the
+entities from the cache at once, with ``get_many()``.
+
+The cache keys include a revision of the entity and one of its model,
+kept in the cache too. Writes don't delete the cached values, they
+increment the revision instead, so that a reader that loaded the values
+before the write can't cache them under the new revision:
+
+* :meth:`Entity.save() <eav.models.Entity.save>` increments the entity's
+  revision, and caches its new values if they are all loaded,
+* :meth:`Attribute.save_value() <eav.models.Attribute.save_value>`, the
+  deletion of the entity or of one of its values increment the entity's
+  revision,
+* :meth:`~eav.managers.EntityQuerySet.update_eav` and the
+  ``migrate_eav_values`` management command increment the model's
+  revision, which discards the cached values of all its entities.
+
+An entity that was never written since its model's revision was set has
+no revision of its own: its values are cached under the model's revision
+alone, so reading the values of any number of entities costs two cache
+round trips, or three on a miss. The revisions are kept for
+:data:`REVISION_TIMEOUT`, longer than the values, so that values cached
+before an entity's first write don't outlive its revision.
+
+A write made inside a transaction increments the revision before it is
+committed, and a reader in between would cache the old values under the
+new revision. The revisions incremented inside a transaction are
+therefore incremented again once it has ended, by :func:`publish`, which
+is called when the request finishes and whenever the same thread reads
+from a value cache. Code writing values in a transaction outside of a
+request, like a management command, should call it after committing.
+
+Classes and Functions
+---------------------
+'''
+
+from time import time
+from threading import local
+
+from django.core.cache import cache
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_model
+from django.contrib.contenttypes.models import ContentType
+
+from .schema import schema, SHARED_VERSION_TIMEOUT
+
+#: How long the revisions are kept in the cache, in seconds.
+REVISION_TIMEOUT = SHARED_VERSION_TIMEOUT
+
+
+class ValueCache(object):
+    '''
+    Caches the values of the entities of the registered model *model_cls*.
+    Use :func:`get_value_cache` to get it.
+    '''
+
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        self.config_cls = model_cls._eav_config_cls
+        self.timeout = self.config_cls.value_cache_timeout
+
+    @property
+    def prefix(self):
+        return 'eav_values:%d' % \
+               ContentType.objects.get_for_model(self.model_cls).pk
+
+    def _get_keys(self, pks):
+        '''
+        Returns a dict mapping each of *pks* to the key of its cached
+        values.
+        '''
+        prefix = self.prefix
+        model_key = '%s:rev' % prefix
+        keys = dict((pk, '%s:%s:rev' % (prefix, pk)) for pk in pks)
+        revisions = cache.get_many([model_key] + keys.values())
+        if model_key not in revisions:
+            revisions.update(_get_revisions([model_key]))
+        # the entities without a revision of their own have revision 0
+        return dict((pk, '%s:%s:%s:%s' % (prefix, pk,
+                                          revisions.get(model_key),
+                                          revisions.get(key, 0))) \
+                    for pk, key in keys.iteritems())
+
+    def get_many(self, pks):
+        '''
+        Returns a dict mapping those of *pks* whose values are cached to
+        the list of their values, and a dict mapping the others to their
+        cache key, to pass to :meth:`set_many`.
+        '''
+        publish()
+        keys = self._get_keys(pks)
+        cached = cache.get_many(keys.values())
+        values = {}
+        missing = {}
+        for pk, key in keys.iteritems():
+            if key in cached:
+                values[pk] = filter(None, [self._load(v) \
+                                           for v in cached[key]])
+            else:
+                missing[pk] = key
+        return values, missing
+
+    def set_many(self, keys, values):
+        '''
+        Caches *values*, a dict mapping entity primary keys to lists of
+        values, under their *keys*, as returned by :meth:`get_many`.
+        '''
+        cache.set_many(dict((keys[pk], [self._dump(v) for v in pk_values]) \
+                            for pk, pk_values in values.iteritems()),
+                       self.timeout)
+
+    def store(self, pk, values, using=DEFAULT_DB_ALIAS):
+        '''
+        Increments the revision of the entity *pk*, and caches its new
+        *values*.
+        '''
+        self.invalidate(pk, using)
+        keys = self._get_keys([pk])
+        self.set_many(keys, {pk: values})
+
+    def invalidate(self, pk, using=DEFAULT_DB_ALIAS):
+        '''
+        Discards the cached values of the entity *pk*, written to the
+        database *using*.
+        '''
+        _increment('%s:%s:rev' % (self.prefix, pk), using)
+
+    def invalidate_all(self, using=DEFAULT_DB_ALIAS):
+        '''
+        Discards the cached values of all the entities of the model,
+        written to the database *using*.
+        '''
+        _increment('%s:rev' % self.prefix, using)
+
+    def _dump(self, value):
+        '''
+        Returns the field values of the :class:`~eav.models.Value` (or
+        :class:`~eav.models.TypedValue`) *value*, without the related
+        objects it has loaded.
+        '''
+        opts = value._meta
+        return (opts.object_name,
+                tuple(getattr(value, f.attname) for f in opts.fields))
+
+    def _load(self, data):
+        '''
+        Returns the value dumped by :meth:`_dump`, with its attribute and
+        enum value taken from the :data:`~eav.schema.schema`, or None if its
+        attribute was deleted since.
+        '''
+        object_name, field_values = data
+        value = get_model('eav', object_name)(*field_values)
+        attribute = schema.get_attribute_by_pk(value.attribute_id)
+        if attribute is None:
+            return None
+        value.attribute = attribute
+        if getattr(value, 'value_enum_id', None) is not None:
+            enum = schema.get_enum(attribute.enum_group_id,
+                                   value.value_enum_id)
+            if enum is not None:
+                value.value_enum = enum
+        return value
+
+
+def _get_revisions(keys):
+    '''
+    Returns a dict of the revisions stored under *keys*, setting the
+    missing (or evicted) ones to a fresh value, unlike any that was in the
+    cache before.
+    '''
+    revisions = cache.get_many(keys)
+    missing = [k for k in keys if k not in revisions]
+    if missing:
+        fresh = int(time() * 1000)
+        for key in missing:
+            cache.add(key, fresh, REVISION_TIMEOUT)
+        revisions.update(cache.get_many(missing))
+    return revisions
+
+
+_pending = local()
+
+
+def _increment(key, using=DEFAULT_DB_ALIAS):
+    '''
+    Increments the revision stored under *key*, and again in
+    :func:`publish` if the database *using* is in a transaction.
+    '''
+    if using is not None and transaction.is_managed(using=using):
+        if not hasattr(_pending, 'keys'):
+            _pending.keys = {}
+        _pending.keys.setdefault(using, set()).add(key)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        _get_revisions([key])
+        try:
+            return cache.incr(key)
+        except ValueError:
+            return None
+
+
+def publish(*args, **kwargs):
+    '''
+    Increments again the revisions this thread incremented inside
+    transactions that have ended since, discarding the values cached
+    before they were committed (or rolled back). It is connected to the
+    ``request_finished`` signal, and can be connected to other signals.
+    '''
+    pending = getattr(_pending, 'keys', None)
+    if not pending:
+        return
+    for using in pending.keys():
+        if not transaction.is_managed(using=using):
+            for key in pending.pop(using):
+                _increment(key, None)
+
+
+_value_caches = {}
+
+
+def get_value_cache(model_cls):
+    '''
+    Returns the :class:`ValueCache` of *model_cls*, or None if it isn't
+    registered with eav with :attr:`~eav.registry.EavConfig.value_cache`.
+    '''
+    config_cls = getattr(model_cls, '_eav_config_cls', None)
+    if config_cls is None or not config_cls.value_cache:
+        return None
+    value_cache = _value_caches.get(model_cls)
+    if value_cache is None or value_cache.config_cls is not config_cls:
+        value_cache = _value_caches[model_cls] = ValueCache(model_cls)
+    return value_cache
+
+
+def value_delete_handler(sender, instance, **kwargs):
+    '''
+    Post delete handler of the value models: discards the cached values of
+    the entity *instance* belonged to.
+    '''
+    model_cls = ContentType.objects.get_for_id(instance.entity_ct_id) \
+                                   .model_class()
+    value_cache = get_value_cache(model_cls)
+    if value_cache is not None:
+        value_cache.invalidate(instance.entity_id,
+                               kwargs.get('using', DEFAULT_DB_ALIAS))
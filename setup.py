@@ -33,6 +33,7 @@ setup(
     url='http://github.com/mivanov/django-eav',
 
     packages=find_packages(),
+    package_data={'eav': ['sql/*.sql']},
 
     zip_safe=False,
 